@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+
+
+def _get_cache():
+    # セッションと同じキャッシュに置き、1回のリクエストの認証をこのキャッシュだけで済ませる
+    return caches[settings.SESSION_CACHE_ALIAS]
+
+
+def _user_cache_key(user_id):
+    return f"accounts:user:{user_id}"
+
+
+def cache_user(user):
+    _get_cache().set(_user_cache_key(user.pk), user, settings.USER_CACHE_TIMEOUT)
+
+
+def invalidate_users(*user_ids):
+    _get_cache().delete_many([_user_cache_key(user_id) for user_id in user_ids])
+
+
+class CachedModelBackend(ModelBackend):
+    # リクエストごとのrequest.userの読み込み（セッションに保存したidからget_userを呼ぶ）で、Userの行をキャッシュから返す。
+    # 保存・削除・ログアウトで消すため（accounts.signals）、パスワードの変更はセッションのハッシュの確認ですぐに反映される
+    def get_user(self, user_id):
+        user = _get_cache().get(_user_cache_key(user_id))
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache_user(user)
+        return user
@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from mysite import conditional, metrics
+
+from . import usernames
+from .backends import invalidate_users
+from .models import FriendShip, User
+
+
+def _following_cache_key(user_id):
+    return f"accounts:following:{user_id}"
+
+
+def get_following_ids(user):
+    # フォローしているユーザーidの集合。フォロー数が多すぎるユーザーはキャッシュせずNoneを返す
+    if user.following_count > settings.FOLLOWING_CACHE_MAX_SIZE:
+        return None
+    key = _following_cache_key(user.pk)
+    following_ids = cache.get(key)
+    if following_ids is None:
+        following_ids = frozenset(
+            FriendShip.objects.filter(follower_id=user.pk).values_list("following_id", flat=True)
+        )
+        cache.set(key, following_ids, settings.FOLLOWING_CACHE_TIMEOUT)
+    return following_ids
+
+
+def invalidate_following(*user_ids):
+    cache.delete_many([_following_cache_key(user_id) for user_id in user_ids])
+
+
+def is_following(user, other_id):
+    following_ids = get_following_ids(user)
+    if following_ids is not None:
+        return other_id in following_ids
+    return FriendShip.objects.filter(follower_id=user.pk, following_id=other_id).exists()
+
+
+def following_among(user, user_ids):
+    # user_idsのうちuserがフォローしているidの集合を返す
+    user_ids = set(user_ids)
+    following_ids = get_following_ids(user)
+    if following_ids is not None:
+        return following_ids & user_ids
+    return set(
+        FriendShip.objects.filter(follower_id=user.pk, following_id__in=user_ids).values_list(
+            "following_id", flat=True
+        )
+    )
+
+
+def _add_follow_counts(follower_id, following_id, delta):
+    # ずれがあっても負にならないようにする（ずれはreconcile_follow_countsで修正する）
+    User.objects.filter(pk=follower_id, following_count__gte=-delta).update(
+        following_count=F("following_count") + delta
+    )
+    User.objects.filter(pk=following_id, follower_count__gte=-delta).update(follower_count=F("follower_count") + delta)
+    # update()は保存のシグナルを送らないため、キャッシュしたrequest.userのフォロー数を消す
+    invalidate_users(follower_id, following_id)
+
+
+def follow(follower, following):
+    # フォローを追加した場合はTrueを返す
+    metrics.follow_operations.inc("follow")
+    try:
+        with transaction.atomic():
+            FriendShip.objects.create(follower=follower, following=following)
+            _add_follow_counts(follower.pk, following.pk, 1)
+    except IntegrityError:
+        # friendship_uniqueに違反した場合は既にフォローしている
+        return False
+    invalidate_following(follower.pk)
+    usernames.invalidate(follower.username, following.username)
+    conditional.bump(conditional.user_key(follower.pk), conditional.user_key(following.pk))
+    return True
+
+
+def unfollow(follower, following):
+    # フォローを解除した場合はTrueを返す
+    metrics.follow_operations.inc("unfollow")
+    with transaction.atomic():
+        deleted, _ = FriendShip.objects.filter(follower=follower, following=following).delete()
+        if deleted:
+            _add_follow_counts(follower.pk, following.pk, -deleted)
+    invalidate_following(follower.pk)
+    if deleted:
+        usernames.invalidate(follower.username, following.username)
+        conditional.bump(conditional.user_key(follower.pk), conditional.user_key(following.pk))
+    return bool(deleted)
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from accounts.models import FriendShip, User
+
+
+class Command(BaseCommand):
+    help = "User.follower_count/following_countとFriendShipの実際の件数のずれを修正する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="修正せずにずれている件数だけを表示する")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        follower_counts = (
+            FriendShip.objects.filter(following=OuterRef("pk")).values("following").annotate(c=Count("id"))
+        )
+        following_counts = (
+            FriendShip.objects.filter(follower=OuterRef("pk")).values("follower").annotate(c=Count("id"))
+        )
+        actual_follower_count = Coalesce(Subquery(follower_counts.values("c")), 0)
+        actual_following_count = Coalesce(Subquery(following_counts.values("c")), 0)
+        drifted_ids = list(
+            User.objects.annotate(
+                actual_follower_count=actual_follower_count, actual_following_count=actual_following_count
+            )
+            .filter(~Q(follower_count=F("actual_follower_count")) | ~Q(following_count=F("actual_following_count")))
+            .values_list("id", flat=True)
+        )
+        if not options["dry_run"]:
+            batch_size = options["batch_size"]
+            for i in range(0, len(drifted_ids), batch_size):
+                User.objects.filter(id__in=drifted_ids[i : i + batch_size]).update(
+                    follower_count=actual_follower_count, following_count=actual_following_count
+                )
+        action = "見つかりました" if options["dry_run"] else "修正しました"
+        self.stdout.write(self.style.SUCCESS(f"フォロー数のずれが{len(drifted_ids)}件{action}"))
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("accounts", "0003_alter_friendship_follower_alter_friendship_following_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="friendship",
+            index=models.Index(fields=["follower", "created_at", "id"], name="friendship_follower_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="friendship",
+            index=models.Index(fields=["following", "created_at", "id"], name="friendship_following_idx"),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:34
+
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_follow_counts(apps, schema_editor):
+    User = apps.get_model("accounts", "User")
+    FriendShip = apps.get_model("accounts", "FriendShip")
+    follower_counts = FriendShip.objects.filter(following=OuterRef("pk")).values("following").annotate(count=Count("id"))
+    following_counts = FriendShip.objects.filter(follower=OuterRef("pk")).values("follower").annotate(count=Count("id"))
+    User.objects.update(
+        follower_count=Coalesce(Subquery(follower_counts.values("count")), 0),
+        following_count=Coalesce(Subquery(following_counts.values("count")), 0),
+    )
+
+
+class Migration(migrations.Migration):
+    # スキーマの変更（0005_user_follow_counts）とは別のトランザクションで行を更新する。
+    # PostgreSQLでは、行を変更したトランザクションの中でALTER TABLEを実行できない（pending trigger events）
+
+    dependencies = [
+        ("accounts", "0005_user_follow_counts"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_follow_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:37
+
+from django.db import migrations
+from django.db.models import Count, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def dedupe_friendships(apps, schema_editor):
+    User = apps.get_model("accounts", "User")
+    FriendShip = apps.get_model("accounts", "FriendShip")
+    # 同じフォロー関係が複数ある場合は最も古いものだけを残す
+    duplicates = (
+        FriendShip.objects.values("follower", "following")
+        .annotate(first_id=Min("id"), count=Count("id"))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        FriendShip.objects.filter(follower=duplicate["follower"], following=duplicate["following"]).exclude(
+            id=duplicate["first_id"]
+        ).delete()
+    follower_counts = FriendShip.objects.filter(following=OuterRef("pk")).values("following").annotate(count=Count("id"))
+    following_counts = FriendShip.objects.filter(follower=OuterRef("pk")).values("follower").annotate(count=Count("id"))
+    User.objects.update(
+        follower_count=Coalesce(Subquery(follower_counts.values("count")), 0),
+        following_count=Coalesce(Subquery(following_counts.values("count")), 0),
+    )
+
+
+class Migration(migrations.Migration):
+    # 一意制約を張り替えるスキーマの変更（0006_friendship_unique_edge）とは別のトランザクションで行を整理する。
+    # PostgreSQLでは、行を変更したトランザクションの中でALTER TABLEを実行できない（pending trigger events）
+
+    dependencies = [
+        ("accounts", "0005_backfill_follow_counts"),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_friendships, migrations.RunPython.noop),
+    ]
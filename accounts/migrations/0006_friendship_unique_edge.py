@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("accounts", "0006_dedupe_friendships"),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="friendship",
+            name="friendship_unique",
+        ),
+        migrations.AlterField(
+            model_name="friendship",
+            name="follower",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="followings",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="friendship",
+            name="following",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="followers",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="friendship",
+            constraint=models.UniqueConstraint(fields=("follower", "following"), name="friendship_unique"),
+        ),
+    ]
@@ -5,11 +5,19 @@ from django.db import models
 
 class User(AbstractUser):
     email = models.EmailField()
+    # FriendShipの件数を非正規化して保持する。accounts.followsで同じトランザクション内で更新する
+    follower_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
 
 
 class FriendShip(models.Model):
-    follower = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="followings", on_delete=models.CASCADE)
-    following = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="followers", on_delete=models.CASCADE)
+    # 単独のインデックスは下の複合インデックスで代用できるため作成しない
+    follower = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name="followings", on_delete=models.CASCADE, db_index=False
+    )
+    following = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name="followers", on_delete=models.CASCADE, db_index=False
+    )
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -17,5 +25,9 @@ class FriendShip(models.Model):
 
     class Meta:
         constraints = [
-            models.UniqueConstraint(fields=["follower", "following", "created_at"], name="friendship_unique"),
+            models.UniqueConstraint(fields=["follower", "following"], name="friendship_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["follower", "created_at", "id"], name="friendship_follower_idx"),
+            models.Index(fields=["following", "created_at", "id"], name="friendship_following_idx"),
         ]
@@ -0,0 +1,98 @@
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from mysite import conditional
+from tweets import pages
+
+from . import usernames
+from .backends import cache_user, invalidate_users
+from .follows import invalidate_following
+from .models import FriendShip, User
+
+
+@receiver(pre_delete, sender=User)
+def release_follow_counts(sender, instance, **kwargs):
+    # ユーザー削除でFriendShipがCASCADE削除される前に、相手側のフォロー数・フォロワー数を減らす
+    following_ids = FriendShip.objects.filter(follower=instance).values("following_id")
+    User.objects.filter(pk__in=following_ids, follower_count__gt=0).update(follower_count=F("follower_count") - 1)
+    follower_ids = FriendShip.objects.filter(following=instance).values("follower_id")
+    User.objects.filter(pk__in=follower_ids, following_count__gt=0).update(following_count=F("following_count") - 1)
+    follower_ids = list(follower_ids.values_list("follower_id", flat=True))
+    invalidate_following(instance.pk, *follower_ids)
+    # 相手側のフォロー数とフォローの一覧が変わる。キャッシュしたUser（ユーザー名から引いたものとrequest.user）も消す
+    counterpart_ids = [*following_ids.values_list("following_id", flat=True), *follower_ids]
+    if counterpart_ids:
+        conditional.bump(*(conditional.user_key(user_id) for user_id in counterpart_ids))
+        usernames.invalidate(*User.objects.filter(pk__in=counterpart_ids).values_list("username", flat=True))
+        invalidate_users(*counterpart_ids)
+
+
+@receiver(post_save, sender=User)
+def reset_following_cache(sender, instance, created, **kwargs):
+    # idが再利用されても以前のユーザーのフォロー情報を引き継がないようにする
+    if created:
+        invalidate_following(instance.pk)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_cache(sender, instance, **kwargs):
+    # プロフィールやパスワード、is_activeの変更をリクエストのrequest.userにすぐに反映する
+    invalidate_users(instance.pk)
+
+
+@receiver(user_logged_in)
+def warm_user_cache(sender, request, user, **kwargs):
+    # last_loginの更新（保存でキャッシュが消える）の後に呼ばれるため、ログイン直後のリクエストからキャッシュを使う
+    cache_user(user)
+
+
+@receiver(user_logged_out)
+def clear_user_cache(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_users(user.pk)
+
+
+@receiver(pre_save, sender=User)
+def invalidate_old_username(sender, instance, update_fields=None, **kwargs):
+    # ユーザー名を変更した場合、変更前の名前で引けないようにする
+    if instance.pk is None or (update_fields is not None and "username" not in update_fields):
+        return
+    old_username = User.objects.filter(pk=instance.pk).values_list("username", flat=True).first()
+    if old_username is not None and old_username != instance.username:
+        usernames.invalidate(old_username)
+        # フォローの一覧などに並ぶユーザー名が変わる
+        conditional.bump(conditional.USERNAMES)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_username(sender, instance, **kwargs):
+    # 新しいユーザーの名前は、存在しないユーザーとして覚えていることがある
+    usernames.invalidate(instance.username)
+
+
+@receiver(post_save, sender=User)
+def invalidate_author_pages(sender, instance, created, update_fields=None, **kwargs):
+    # ツイートの詳細とプロフィールには投稿者のユーザー名を含めてキャッシュしている。
+    # last_loginの更新のようにユーザー名を含まない保存では、ツイートを問い合わせずにプロフィールだけを消す
+    if created or (update_fields is not None and "username" not in update_fields):
+        pages.invalidate_profile(instance.pk)
+    else:
+        pages.invalidate_author(instance.pk)
+    conditional.bump(conditional.user_key(instance.pk))
+
+
+@receiver(post_delete, sender=User)
+def invalidate_profile_page(sender, instance, **kwargs):
+    # idが再利用されても以前のユーザーのツイートを表示しないようにする
+    pages.invalidate_profile(instance.pk)
+    conditional.bump(conditional.user_key(instance.pk))
+
+
+@receiver(post_delete, sender=User)
+def bump_usernames(sender, instance, **kwargs):
+    # 削除したユーザーはフォローの一覧などから消える
+    conditional.bump(conditional.USERNAMES)
@@ -1,10 +1,18 @@
+from io import StringIO
+from unittest import mock
+
 from django.conf import settings
 from django.contrib.auth import SESSION_KEY, get_user_model
+from django.core.management import call_command
+from django.db import connection
 from django.shortcuts import get_object_or_404
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
+from accounts import follows, usernames
 from accounts.models import FriendShip
+from tweets.likes import like_tweet
 from tweets.models import Tweet
 
 User = get_user_model()
@@ -303,6 +311,145 @@ class TestLogoutView(TestCase):
         self.assertNotIn(SESSION_KEY, self.client.session)
 
 
+class TestSessionUserCache(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.login(username="tester", password="testpassword")
+        self.tweet = Tweet.objects.create(user=self.user, content="tweet")
+
+    def get_auth_queries(self, method, url):
+        # セッションの行とログイン中のユーザーの行を読むクエリ
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url)
+        queries = [
+            query["sql"]
+            for query in context
+            if "django_session" in query["sql"] or '"accounts_user"."id" = ' in query["sql"]
+        ]
+        return response, queries
+
+    def test_no_queries_for_session_and_user(self):
+        for method, url in (
+            ("get", reverse("tweets:home")),
+            ("post", reverse("tweets:like", kwargs={"pk": self.tweet.pk})),
+        ):
+            with self.subTest(url=url):
+                response, queries = self.get_auth_queries(method, url)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(queries, [])
+
+    def test_profile_edit(self):
+        self.client.get(reverse("tweets:home"))
+        self.user.first_name = "edited"
+        self.user.save()
+        response = self.client.get(reverse("tweets:home"))
+        self.assertEqual(response.context["user"].first_name, "edited")
+
+    def test_password_change(self):
+        self.client.get(reverse("tweets:home"))
+        self.user.set_password("newpassword")
+        self.user.save()
+        # 変更前のパスワードでログインしたセッションは無効になる
+        response = self.client.get(reverse("tweets:home"))
+        self.assertRedirects(response, f"{reverse(settings.LOGIN_URL)}?next={reverse('tweets:home')}")
+
+    def test_logout(self):
+        self.client.get(reverse("tweets:home"))
+        self.client.post(reverse(settings.LOGOUT_URL))
+        response = self.client.get(reverse("tweets:home"))
+        self.assertEqual(response.status_code, 302)
+
+    def test_session_with_model_backend(self):
+        # キャッシュを導入する前にログインしたセッションも、ログイン中のままにする
+        session = self.client.session
+        session["_auth_user_backend"] = "django.contrib.auth.backends.ModelBackend"
+        session.save()
+        response = self.client.get(reverse("tweets:home"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["user"], self.user)
+
+    def test_follow_counts(self):
+        other = User.objects.create_user(username="other", password="testpassword")
+        self.client.get(reverse("tweets:home"))
+        self.client.post(reverse("accounts:follow", kwargs={"username": other.username}))
+        response = self.client.get(reverse("tweets:home"))
+        self.assertEqual(response.context["user"].following_count, 1)
+
+
+class TestUsernameCache(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.other = User.objects.create_user(username="other", password="testpassword")
+        self.client.login(username="tester", password="testpassword")
+
+    def get_profile(self, username):
+        # ユーザー名でユーザーを引いたクエリの数も返す
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("accounts:user_profile", kwargs={"username": username}))
+        return response, sum('"accounts_user"."username" = ' in query["sql"] for query in context)
+
+    def test_cached(self):
+        self.assertEqual(self.get_profile("other")[1], 1)
+        response, queries = self.get_profile("other")
+        self.assertEqual(response.context["profile_user"], self.other)
+        self.assertEqual(queries, 0)
+
+    def test_unknown_username(self):
+        self.assertEqual(self.get_profile("nobody")[0].status_code, 404)
+        response, queries = self.get_profile("nobody")
+        self.assertEqual((response.status_code, queries), (404, 0))
+        # 作成されたユーザーはすぐに引ける
+        User.objects.create_user(username="nobody", password="testpassword")
+        self.assertEqual(self.get_profile("nobody")[0].status_code, 200)
+
+    def test_rename_and_delete(self):
+        self.get_profile("other")
+        self.other.username = "renamed"
+        self.other.save()
+        self.assertEqual(self.get_profile("other")[0].status_code, 404)
+        self.assertEqual(self.get_profile("renamed")[0].status_code, 200)
+        self.other.delete()
+        self.assertEqual(self.get_profile("renamed")[0].status_code, 404)
+
+    def test_follow_counts(self):
+        self.get_profile("other")
+        self.client.post(reverse("accounts:follow", kwargs={"username": "other"}))
+        self.assertEqual(self.get_profile("other")[0].context["follower_number"], 1)
+        self.client.post(reverse("accounts:unfollow", kwargs={"username": "other"}))
+        self.assertEqual(self.get_profile("other")[0].context["follower_number"], 0)
+
+    def test_follow_counts_after_delete(self):
+        follows.follow(self.user, self.other)
+        follows.follow(self.other, self.user)
+        self.get_profile("tester")
+        # 削除したユーザーのフォローとフォロワーの分だけ、相手側のフォロー数が減ったものをすぐに表示する
+        self.other.delete()
+        context = self.get_profile("tester")[0].context
+        self.assertEqual((context["following_number"], context["follower_number"]), (0, 0))
+
+    def test_lru(self):
+        cache = usernames.LRUCache(max_size=2)
+        cache.set("a", 1, 60)
+        cache.set("b", 2, 60)
+        cache.get("a")
+        cache.set("c", 3, 60)
+        # 最も長く使われていないものから追い出される
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        cache.set("d", 4, 0)
+        self.assertIsNone(cache.get("d"))
+
+    @override_settings(USERNAME_CACHE_ALIAS="default")
+    def test_shared_cache(self):
+        self.get_profile("other")
+        # 他のプロセス（プロセス内のキャッシュが空）からも共有のキャッシュで引ける
+        usernames.local_cache.clear()
+        self.assertEqual(self.get_profile("other")[1], 0)
+        # 他のプロセスで削除されたユーザーは、このプロセスのキャッシュに残らずすぐに引けなくなる
+        with mock.patch.object(usernames.local_cache, "delete"):
+            self.other.delete()
+        self.assertEqual(self.get_profile("other")[0].status_code, 404)
+
+
 class TestUserProfileView(TestCase):
     def setUp(self):
         self.dummy_user = User.objects.create_user(username="dummy", password="dummypassword1")
@@ -329,6 +476,59 @@ class TestUserProfileView(TestCase):
         self.assertEqual(context_following_number, db_user_following_number)
         self.assertEqual(context_follower_number, db_user_follower_number)
 
+    def test_cached_first_page(self):
+        self.client.get(self.url)
+        # 新しいツイートと削除したツイートは、キャッシュした最初のページにもすぐに反映される
+        tweet = Tweet.objects.create(user=self.user, content="new tweet")
+        self.assertEqual(list(self.client.get(self.url).context["tweets"]), [tweet, self.tweet2])
+        tweet.delete()
+        self.assertEqual(list(self.client.get(self.url).context["tweets"]), [self.tweet2])
+        # 閲覧者のいいねの状態だけを問い合わせる
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url)
+        self.assertFalse(any('FROM "tweets_tweet"' in query["sql"] for query in context))
+        self.assertFalse(response.context["tweets"][0].liked)
+
+    def test_conditional_get(self):
+        url = reverse("accounts:user_profile", kwargs={"username": self.dummy_user})
+        etag = self.client.get(url)["ETag"]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(any("tweets_" in query["sql"] for query in context))
+        # フォローするとフォロー数と閲覧者のフォローの状態が変わる
+        self.client.post(reverse("accounts:follow", kwargs={"username": self.dummy_user}))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["is_following"])
+        # いいねした閲覧者には、いいねの状態を反映したページを返す
+        etag = response["ETag"]
+        like_tweet(self.user, self.tweet1.pk)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["tweets"][0].liked)
+
+    def test_follow_state(self):
+        url = reverse("accounts:user_profile", kwargs={"username": self.dummy_user})
+        self.assertFalse(self.client.get(url).context["is_following"])
+        # フォロー・フォロー解除の結果がすぐに反映される
+        self.client.post(reverse("accounts:follow", kwargs={"username": self.dummy_user}))
+        self.assertTrue(self.client.get(url).context["is_following"])
+        self.client.post(reverse("accounts:unfollow", kwargs={"username": self.dummy_user}))
+        self.assertFalse(self.client.get(url).context["is_following"])
+
+    def test_follow_state_without_cache(self):
+        follows.follow(self.user, self.dummy_user)
+        others = User.objects.bulk_create([User(username=f"other{i}") for i in range(3)])
+        # フォロー数が多いユーザーはキャッシュを使わずに問い合わせる
+        with self.settings(FOLLOWING_CACHE_MAX_SIZE=0):
+            self.assertTrue(follows.is_following(self.user, self.dummy_user.pk))
+            self.assertFalse(follows.is_following(self.user, others[0].pk))
+            self.assertEqual(
+                follows.following_among(self.user, [self.dummy_user.pk, *(other.pk for other in others)]),
+                {self.dummy_user.pk},
+            )
+
 
 # class TestUserProfileEditView(TestCase):
 #     def test_success_get(self):
@@ -340,6 +540,28 @@ class TestUserProfileView(TestCase):
 #     def test_failure_post_with_incorrect_user(self):
 
 
+class TestUserTweetsFragmentView(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword1")
+        self.tweets = [Tweet.objects.create(user=self.user, content=f"tweet {i}") for i in range(3)]
+        self.client.login(username="tester", password="testpassword1")
+        self.url = reverse("accounts:user_tweets_fragment", kwargs={"username": self.user})
+
+    def test_success_get(self):
+        with mock.patch("accounts.views.UserProfileView.paginate_by", 2):
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotContains(response, "<html")
+            self.assertContains(response, 'class="tweet-container"', count=2)
+            # 無限スクロールで追加する行は、プロフィールのページに描画した行と同じ
+            profile = self.client.get(reverse("accounts:user_profile", kwargs={"username": self.user}))
+            self.assertContains(profile, response.content.decode(), html=False)
+            next_url = response["Link"].removeprefix("<").removesuffix('>; rel="next"')
+            response = self.client.get(f"{next_url}&format=json")
+        self.assertEqual([tweet["id"] for tweet in response.json()["tweets"]], [self.tweets[0].pk])
+        self.assertFalse(response.has_header("Link"))
+
+
 class TestFollowView(TestCase):
     def setUp(self):
         self.dummy_user = User.objects.create_user(username="dummy1", password="dummypassword1")
@@ -359,6 +581,17 @@ class TestFollowView(TestCase):
         # DBにデータが追加されている
         following_user = get_object_or_404(User, username="dummy1")
         self.assertTrue(FriendShip.objects.all().filter(follower=self.user, following=following_user).exists())
+        # フォロー数・フォロワー数が更新されている
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.following_count, 1)
+        self.assertEqual(following_user.follower_count, 1)
+
+    def test_success_post_with_followed_user(self):
+        self.client.post(reverse(self.url, kwargs={"username": "dummy1"}))
+        self.client.post(reverse(self.url, kwargs={"username": "dummy1"}))
+        # 二重にフォローしても件数は1のまま
+        self.assertEqual(FriendShip.objects.filter(follower=self.user).count(), 1)
+        self.assertEqual(User.objects.get(username="dummy1").follower_count, 1)
 
     def test_failure_post_with_not_exist_user(self):
         response = self.client.post(reverse(self.url, kwargs={"username": "not_exist_user"}))
@@ -375,11 +608,32 @@ class TestFollowView(TestCase):
         self.assertFalse(FriendShip.objects.all().filter(follower=self.user).exists())
 
 
+class TestAsyncFollowView(TestCase):
+    def setUp(self):
+        self.dummy_user = User.objects.create_user(username="dummy1", password="dummypassword1")
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.async_client.force_login(self.user)
+
+    async def test_success_post(self):
+        response = await self.async_client.post(reverse("accounts:follow", kwargs={"username": "dummy1"}))
+        # ASGI経由でもフォローが追加され、Homeにリダイレクトしている
+        self.assertRedirects(response, reverse(settings.LOGIN_REDIRECT_URL), fetch_redirect_response=False)
+        self.assertTrue(await FriendShip.objects.filter(follower=self.user, following=self.dummy_user).aexists())
+        response = await self.async_client.post(reverse("accounts:unfollow", kwargs={"username": "dummy1"}))
+        self.assertRedirects(response, reverse(settings.LOGIN_REDIRECT_URL), fetch_redirect_response=False)
+        self.assertFalse(await FriendShip.objects.filter(follower=self.user).aexists())
+
+    async def test_failure_post_with_not_exist_user(self):
+        response = await self.async_client.post(reverse("accounts:follow", kwargs={"username": "not_exist_user"}))
+        # Response Status Code: 404
+        self.assertEqual(response.status_code, 404)
+
+
 class TestUnfollowView(TestCase):
     def setUp(self):
         self.dummy_user = User.objects.create_user(username="dummy1", password="dummypassword1")
         self.user = User.objects.create_user(username="tester", password="testpassword")
-        FriendShip.objects.create(follower=self.user, following=self.dummy_user)
+        follows.follow(self.user, self.dummy_user)
         self.client.login(username="tester", password="testpassword")
         self.url = "accounts:unfollow"
 
@@ -395,6 +649,16 @@ class TestUnfollowView(TestCase):
         # DBにデータが削除されている
         following_user = get_object_or_404(User, username="dummy1")
         self.assertFalse(FriendShip.objects.all().filter(follower=self.user, following=following_user).exists())
+        # フォロー数・フォロワー数が更新されている
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.following_count, 0)
+        self.assertEqual(following_user.follower_count, 0)
+
+    def test_success_delete_followed_user(self):
+        self.dummy_user.delete()
+        # CASCADE削除されたフォローの分だけフォロー数が減っている
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.following_count, 0)
 
     def test_failure_post_with_not_exist_user(self):
         response = self.client.post(reverse(self.url, kwargs={"username": "not_exist_user"}))
@@ -411,6 +675,19 @@ class TestUnfollowView(TestCase):
         self.assertTrue(FriendShip.objects.all().filter(follower=self.user).exists())
 
 
+class TestReconcileFollowCountsCommand(TestCase):
+    def test_reconcile(self):
+        user = User.objects.create(username="tester")
+        dummy_user = User.objects.create(username="dummy1", follower_count=3)
+        FriendShip.objects.create(follower=user, following=dummy_user)
+        call_command("reconcile_follow_counts", stdout=StringIO())
+        # 実際のFriendShipの件数に修正されている
+        user.refresh_from_db()
+        dummy_user.refresh_from_db()
+        self.assertEqual((user.following_count, user.follower_count), (1, 0))
+        self.assertEqual((dummy_user.following_count, dummy_user.follower_count), (0, 1))
+
+
 class TestFollowingListView(TestCase):
     def setUp(self):
         self.user = User.objects.create_user(username="tester", password="testpassword")
@@ -422,6 +699,32 @@ class TestFollowingListView(TestCase):
         # Response Status Code: 200
         self.assertEqual(response.status_code, 200)
 
+    def test_follow_state(self):
+        dummy_user = User.objects.create(username="dummy")
+        other_user = User.objects.create(username="other")
+        follows.follow(dummy_user, self.user)
+        follows.follow(dummy_user, other_user)
+        follows.follow(self.user, other_user)
+        response = self.client.get(reverse("accounts:following_list", kwargs={"username": "dummy"}))
+        # 閲覧しているユーザーがフォローしているユーザーだけが含まれている
+        self.assertEqual(response.context["viewer_following_ids"], {other_user.pk})
+        self.assertContains(response, "フォロー中", count=1)
+
+    def test_conditional_get(self):
+        other_user = User.objects.create(username="other")
+        follows.follow(self.user, other_user)
+        etag = self.client.get(self.url)["ETag"]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(any("accounts_friendship" in query["sql"] for query in context))
+        # 一覧に並ぶユーザーの名前が変わると検証子も変わる
+        other_user.username = "renamed"
+        other_user.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "renamed")
+
 
 class TestFollowerListView(TestCase):
     def setUp(self):
@@ -433,3 +736,25 @@ class TestFollowerListView(TestCase):
         response = self.client.get(self.url)
         # Response Status Code: 200
         self.assertEqual(response.status_code, 200)
+
+    def test_cursor_pagination(self):
+        followers = User.objects.bulk_create([User(username=f"follower{i}") for i in range(25)])
+        for follower in followers:
+            FriendShip.objects.create(follower=follower, following=self.user)
+        response = self.client.get(self.url)
+        first_page = list(response.context["friendships"])
+        self.assertEqual(len(first_page), 20)
+        self.assertFalse(response.context["page_obj"].has_previous())
+        # 次のページには残りの5件が新しい順に含まれている
+        response = self.client.get(self.url, {"cursor": response.context["page_obj"].next_cursor})
+        second_page = list(response.context["friendships"])
+        self.assertEqual([f.follower for f in second_page], followers[4::-1])
+        self.assertFalse(response.context["page_obj"].has_next())
+        # 前のページに戻ると1ページ目と同じ内容になる
+        response = self.client.get(self.url, {"cursor": response.context["page_obj"].previous_cursor})
+        self.assertEqual(list(response.context["friendships"]), first_page)
+
+    def test_failure_get_with_invalid_cursor(self):
+        response = self.client.get(self.url, {"cursor": "invalid"})
+        # Response Status Code: 400
+        self.assertEqual(response.status_code, 400)
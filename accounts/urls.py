@@ -10,6 +10,7 @@ urlpatterns = [
     path("login/", views.CustomLoginView.as_view(), name="login"),
     path("logout/", auth_views.LogoutView.as_view(), name="logout"),
     path("<str:username>/", views.UserProfileView.as_view(), name="user_profile"),
+    path("<str:username>/tweets/", views.UserTweetsFragmentView.as_view(), name="user_tweets_fragment"),
     path("<str:username>/follow/", views.FollowView.as_view(), name="follow"),
     path("<str:username>/unfollow/", views.UnFollowView.as_view(), name="unfollow"),
     path("<str:username>/following_list/", views.FollowingListView.as_view(), name="following_list"),
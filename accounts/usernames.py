@@ -0,0 +1,116 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import Http404
+
+from mysite.db_router import PRIMARY
+
+from .models import User
+
+# ユーザー名からユーザーを引く（accounts.urlsのすべてのURL）。プロセス内のLRUに保持し、
+# USERNAME_CACHE_ALIASを指定すればLRUの代わりにプロセス間で共有するキャッシュを使う。
+# LRUの値は他のプロセスでの変更（名前の変更や削除）では消せないため、共有のキャッシュと併用しない。
+# 存在しないユーザー名も短い時間だけ覚えておく
+FIELDS = ("id", "username", "follower_count", "following_count")
+MISSING = False
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        # 無い・期限切れのときはNone
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+local_cache = LRUCache(settings.USERNAME_CACHE_MAX_SIZE)
+
+
+def _shared_cache():
+    alias = settings.USERNAME_CACHE_ALIAS
+    return None if alias is None else caches[alias]
+
+
+def _shared_key(username):
+    # URLのユーザー名は任意の文字列のため、キーに使える文字にする
+    return f"accounts:username:{hashlib.md5(username.encode()).hexdigest()}"
+
+
+def _timeout(values):
+    return settings.USERNAME_CACHE_TIMEOUT if values is not MISSING else settings.USERNAME_CACHE_NEGATIVE_TIMEOUT
+
+
+def _lookup(username):
+    shared = _shared_cache()
+    cache, key = (local_cache, username) if shared is None else (shared, _shared_key(username))
+    values = cache.get(key)
+    if values is None:
+        row = User.objects.filter(username=username).values_list(*FIELDS).first()
+        values = MISSING if row is None else tuple(row)
+        cache.set(key, values, _timeout(values))
+    return values
+
+
+def _to_user(values):
+    # FIELDS以外の項目は参照したときに読み込まれる（only()と同じ）
+    return User.from_db(PRIMARY, FIELDS, values)
+
+
+def get_user_or_404(username):
+    values = _lookup(username)
+    if values is MISSING:
+        raise Http404("ユーザーが見つかりません")
+    return _to_user(values)
+
+
+async def aget_user_or_404(username):
+    # プロセス内のキャッシュにあればスレッドを切り替えずに返す
+    values = local_cache.get(username) if settings.USERNAME_CACHE_ALIAS is None else None
+    if values is None:
+        return await sync_to_async(get_user_or_404)(username)
+    if values is MISSING:
+        raise Http404("ユーザーが見つかりません")
+    return _to_user(values)
+
+
+def invalidate(*usernames):
+    for username in usernames:
+        local_cache.delete(username)
+    shared = _shared_cache()
+    if shared is not None:
+        shared.delete_many([_shared_key(username) for username in usernames])
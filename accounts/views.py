@@ -1,17 +1,22 @@
+from asgiref.sync import sync_to_async
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView
-from django.db.models import Count, Exists, OuterRef
+from django.db.models import Exists, OuterRef
 from django.http import HttpResponseBadRequest, HttpResponseRedirect
-from django.shortcuts import get_object_or_404
 from django.urls import reverse_lazy
 from django.views import View
 from django.views.generic import CreateView, ListView, TemplateView
 
-from accounts.models import FriendShip, User
+from accounts.models import FriendShip
+from mysite import conditional
+from mysite.mixins import AsyncLoginRequiredMixin, ConditionalGetMixin, ReplicaReadMixin
+from mysite.pagination import CursorPaginationMixin, paginate
+from tweets import fragments, pages, sharding, timeline
 from tweets.models import Like, Tweet
 
+from . import follows, usernames
 from .forms import SignupForm
 
 
@@ -34,69 +39,113 @@ class CustomLoginView(LoginView):
     template_name = "accounts/login.html"
 
 
-class UserProfileView(LoginRequiredMixin, TemplateView):
+class UserProfileView(ReplicaReadMixin, LoginRequiredMixin, ConditionalGetMixin, TemplateView):
     template_name = "accounts/profile.html"
+    paginate_by = 20
+    # 最初のページのキャッシュが無いときは、ツイートといいねの状態を別々に問い合わせる
+    query_budget = 6
+
+    def get_validators(self):
+        # 表示はプロフィールのユーザー（フォロー数）、ツイート（最初のページはキャッシュした版数）、
+        # 閲覧者のいいねとフォローの状態で決まる
+        self.profile_user = usernames.get_user_or_404(self.kwargs["username"])
+        self.cursor = self.request.GET.get("cursor")
+        self.page = None
+        keys = [conditional.user_key(self.request.user.pk)]
+        if self.cursor:
+            keys.append(conditional.user_key(self.profile_user.pk))
+            versions = conditional.get_versions(*keys)
+        else:
+            # 最初のページは多くの閲覧者で共有するキャッシュから返す
+            version, self.page = pages.get_profile_page(self.profile_user.pk, self.paginate_by)
+            versions = conditional.get_versions(*keys) + [version]
+        profile_user = self.profile_user
+        return (profile_user.username, profile_user.follower_count, profile_user.following_count), versions
 
     def get_context_data(self, username):
         context = super().get_context_data()
-        profile_user = get_object_or_404(User, username=username)
-        user_following_friendships = FriendShip.objects.all().filter(follower=self.request.user)
-        context["user_following"] = [friendship.following for friendship in user_following_friendships]
-        context["following_number"] = FriendShip.objects.all().filter(follower=profile_user).count()
-        context["follower_number"] = FriendShip.objects.all().filter(following=profile_user).count()
+        if not hasattr(self, "profile_user"):
+            self.get_validators()
+        profile_user = self.profile_user
+        context["is_following"] = follows.is_following(self.request.user, profile_user.pk)
+        context["following_number"] = profile_user.following_count
+        context["follower_number"] = profile_user.follower_count
         context["profile_user"] = profile_user
-        context["tweets"] = (
-            Tweet.objects.select_related("user")
-            .filter(user=profile_user)
-            .annotate(
-                liked=Exists(Like.objects.filter(user=self.request.user, tweet=OuterRef("id"))),
-                like_count=Count("likes"),
+        # 投稿者のツイートはすべて投稿者のバケットのシャードにある
+        database = sharding.db_for_user(profile_user.pk)
+        page = self.page
+        if page is None:
+            tweets = (
+                sharding.select_user(Tweet.objects.using(database))
+                .filter(user=profile_user)
+                .annotate(liked=Exists(Like.objects.filter(user=self.request.user, tweet=OuterRef("id"))))
             )
-        )
+            page = paginate(tweets, self.cursor, self.paginate_by)
+        else:
+            pages.overlay_liked(page.object_list, self.request.user, database)
+        context["page_obj"] = page
+        context["tweets"] = page.object_list
         return context
 
 
-class FollowView(LoginRequiredMixin, View):
-    def post(self, request, username):
-        following_user = get_object_or_404(User, username=username)
+class UserTweetsFragmentView(UserProfileView):
+    # プロフィールのツイート一覧の無限スクロールの続き。ツイートの<li>だけを返す
+    def render_to_response(self, context, **response_kwargs):
+        return fragments.fragment_response(
+            self.request,
+            context["tweets"],
+            "tweets/fragments/profile_tweet.html",
+            fragments.next_page_url(self.request, context["page_obj"]),
+        )
+
+
+class FollowView(AsyncLoginRequiredMixin, View):
+    async def post(self, request, username):
+        following_user = await usernames.aget_user_or_404(username)
         if request.user == following_user:
             messages.error(self.request, "自分自身をフォローすることはできません。")
             return HttpResponseBadRequest()
-        # 既にフォローしているかチェック
-        is_following = FriendShip.objects.filter(follower=request.user, following=following_user).exists()
-        # 既にフォローしている場合、プロフィール画面にリダイレクト
-        if is_following:
+        # FriendShipの作成。既にフォローしている場合、プロフィール画面にリダイレクト
+        if not await sync_to_async(follows.follow)(request.user, following_user):
             return HttpResponseRedirect(reverse_lazy("accounts:user_profile", kwargs={"username": username}))
-        # FriendShipの作成
-        follow_instance = FriendShip(follower=request.user, following=following_user)
-        follow_instance.save()
+        await sync_to_async(timeline.backfill_author)(request.user, following_user)
 
         return HttpResponseRedirect(reverse_lazy("tweets:home"))
 
 
-class UnFollowView(LoginRequiredMixin, View):
-    def post(self, request, username):
-        unfollowing_user = get_object_or_404(User, username=username)
-        follow_instance = FriendShip.objects.filter(follower=request.user, following=unfollowing_user)
+class UnFollowView(AsyncLoginRequiredMixin, View):
+    async def post(self, request, username):
+        unfollowing_user = await usernames.aget_user_or_404(username)
         if request.user == unfollowing_user:
             return HttpResponseBadRequest()
-        # フォローしていなければリダイレクト、していればフォロー解除
-        if not follow_instance:
+        # フォローしていればフォロー解除、していなければリダイレクト
+        if not await sync_to_async(follows.unfollow)(request.user, unfollowing_user):
             return HttpResponseRedirect(reverse_lazy("accounts:user_profile", kwargs={"username": username}))
-        else:
-            follow_instance.delete()
+        await sync_to_async(timeline.remove_author)(request.user, unfollowing_user)
 
         return HttpResponseRedirect(reverse_lazy("tweets:home"))
 
 
-class FollowingListView(LoginRequiredMixin, ListView):
+class FriendShipListConditionalMixin(ConditionalGetMixin):
+    def get_validators(self):
+        # 表示は一覧のユーザーのフォロー、一覧に並ぶユーザー名、閲覧者のフォローの状態で決まる
+        user = usernames.get_user_or_404(self.kwargs["username"])
+        return user.username, conditional.get_versions(
+            conditional.user_key(user.pk), conditional.user_key(self.request.user.pk), conditional.USERNAMES
+        )
+
+
+class FollowingListView(
+    ReplicaReadMixin, LoginRequiredMixin, FriendShipListConditionalMixin, CursorPaginationMixin, ListView
+):
     model = FriendShip
     template_name = "accounts/followingList.html"
     context_object_name = "friendships"
+    query_budget = 5
 
     def get_queryset(self):
         self.username = self.kwargs.get("username")
-        following_user = get_object_or_404(User, username=self.username)
+        following_user = usernames.get_user_or_404(self.username)
         return (
             FriendShip.objects.all()
             .filter(follower=following_user)
@@ -107,17 +156,23 @@ class FollowingListView(LoginRequiredMixin, ListView):
     def get_context_data(self):
         context = super().get_context_data()
         context["username"] = self.username
+        context["viewer_following_ids"] = follows.following_among(
+            self.request.user, [friendship.following_id for friendship in context["friendships"]]
+        )
         return context
 
 
-class FollowerListView(LoginRequiredMixin, ListView):
+class FollowerListView(
+    ReplicaReadMixin, LoginRequiredMixin, FriendShipListConditionalMixin, CursorPaginationMixin, ListView
+):
     model = FriendShip
     template_name = "accounts/followerList.html"
     context_object_name = "friendships"
+    query_budget = 5
 
     def get_queryset(self):
         self.username = self.kwargs.get("username")
-        follower_user = get_object_or_404(User, username=self.username)
+        follower_user = usernames.get_user_or_404(self.username)
         return (
             FriendShip.objects.all().filter(following=follower_user).select_related("follower").order_by("-created_at")
         )
@@ -125,4 +180,7 @@ class FollowerListView(LoginRequiredMixin, ListView):
     def get_context_data(self):
         context = super().get_context_data()
         context["username"] = self.username
+        context["viewer_following_ids"] = follows.following_among(
+            self.request.user, [friendship.follower_id for friendship in context["friendships"]]
+        )
         return context
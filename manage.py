@@ -6,7 +6,9 @@ import sys
 
 def main():
     """Run administrative tasks."""
-    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+    # テストはテスト用の設定（レプリカとシャードのテスト用DB、query_budgetの厳密な確認）で実行する
+    default_settings = "mysite.test_settings" if sys.argv[1:2] == ["test"] else "mysite.settings"
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", default_settings)
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
@@ -9,8 +9,11 @@ https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+
+from mysite.handlers import StreamingASGIHandler
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+application = StreamingASGIHandler()
@@ -0,0 +1,26 @@
+from django.core.cache.backends.locmem import LocMemCache
+
+from mysite import metrics
+from mysite.performance import record_cache
+
+
+class CacheStatsMixin:
+    # キャッシュのヒット数・ミス数をリクエストごとの計測（mysite.performance）とメトリクスに記録する。
+    # get_manyやget_or_setもgetを経由するため、getだけを数える
+    _stats_missing = object()
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        # メトリクスのラベル。LOCATIONを指定していないキャッシュは"default"とする
+        self.stats_name = name or "default"
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, self._stats_missing, version)
+        hit = value is not self._stats_missing
+        record_cache(hit)
+        metrics.cache_requests.inc(self.stats_name, "hit" if hit else "miss")
+        return default if value is self._stats_missing else value
+
+
+class InstrumentedLocMemCache(CacheStatsMixin, LocMemCache):
+    pass
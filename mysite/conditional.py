@@ -0,0 +1,78 @@
+import hashlib
+import math
+import time
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import caches
+from django.middleware.csrf import get_token
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+# 条件付きGET（If-None-Match・If-Modified-Since）の検証子の材料になる版数。
+# ページの内容を決めるオブジェクトごとに、変更した時刻（ナノ秒）を版数としてキャッシュに置く。
+# キャッシュから消えた版数は読み込んだときに現在の時刻で作り直すため、古い検証子と一致することはない。
+# 複数のプロセスで動かす場合は、どのプロセスの変更も反映されるよう共有のキャッシュにする
+USERNAMES = "version:usernames"
+
+
+def get_cache():
+    return caches[settings.CONDITIONAL_GET_CACHE]
+
+
+def tweet_key(tweet_id):
+    # ツイートの本文といいね数
+    return f"version:tweet:{tweet_id}"
+
+
+def user_key(user_id):
+    # ユーザーの行（ユーザー名・フォロー数）、ツイートの投稿と削除、ツイートへのいいね、
+    # そのユーザー自身のいいねとフォロー（閲覧者ごとに変わる表示）
+    return f"version:user:{user_id}"
+
+
+def get_versions(*keys):
+    cache = get_cache()
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            version = time.time_ns()
+            # 同時に作られた場合は先に保存された版数を使う
+            if not cache.add(key, version, None):
+                version = cache.get(key, version)
+            versions[key] = version
+    return [versions[key] for key in keys]
+
+
+def bump(*keys):
+    version = time.time_ns()
+    get_cache().set_many({key: version for key in keys}, None)
+
+
+def validators(request, parts, versions):
+    # (ETag, Last-Modified)。表示が変わる条件（閲覧者、CSRFトークンの元になる値）もETagに含める。
+    # CSRFトークンの元は初めてのリクエストではget_token()で作られ、Cookieに保存される。
+    # 同じ秒のうちの変更をIf-Modified-Sinceで区別できないため、1秒以内に変わった版数ではLast-Modifiedを返さない。
+    # ログインすると閲覧者の版数が新しくなるため、別の利用者が保存したページにIf-Modified-Sinceで304を返すこともない
+    get_token(request)
+    material = repr((request.user.pk, request.META["CSRF_COOKIE"], parts, versions))
+    etag = quote_etag(hashlib.md5(material.encode()).hexdigest())
+    last_modified = math.ceil(max(versions) / 1e9) if versions else None
+    if last_modified is not None and last_modified > time.time() - 1:
+        last_modified = None
+    return etag, last_modified
+
+
+def has_messages(request):
+    # 表示待ちのメッセージはページに一度だけ表示するため、そのページは検証子を付けずに描画する
+    return len(get_messages(request)) > 0
+
+
+def patch_response(response, etag, last_modified):
+    if response.status_code in (200, 304):
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+    # ブラウザに保存したページを使う前に必ず問い合わせさせる
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ["Cookie"])
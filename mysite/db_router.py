@@ -0,0 +1,112 @@
+import random
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core import signing
+
+PRIMARY = "default"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+PRIMARY_ONLY_APPS = ("sessions",)
+STICKY_COOKIE_NAME = "primary_until"
+STICKY_COOKIE_SALT = "mysite.db_router"
+
+_current_state = ContextVar("db_routing_state", default=None)
+
+
+class RoutingState:
+    def __init__(self, sticky):
+        # stickyは直前に書き込んだ利用者のリクエスト。レプリカに反映される前の古いデータを読まないようプライマリから読む
+        self.sticky = sticky
+        self.read_alias = None
+        self.wrote = False
+
+
+def use_replica(request):
+    # ReplicaReadMixinのビューから呼ばれ、このリクエストの読み込みを1つのレプリカに送る
+    state = _current_state.get()
+    if state is None or state.sticky or request.method not in SAFE_METHODS or not settings.DATABASE_REPLICAS:
+        return None
+    state.read_alias = random.choice(settings.DATABASE_REPLICAS)
+    return state.read_alias
+
+
+class PrimaryReplicaRouter:
+    # 書き込みは常にプライマリ。読み込みはReplicaReadMixinのビューだけレプリカに送り、それ以外はプライマリから読む。
+    # 同じリクエストの中で書き込んだ後の読み込みもプライマリに送る
+    def db_for_read(self, model, **hints):
+        state = _current_state.get()
+        # ログイン直後のセッションがまだレプリカに無い場合でもログアウト扱いにならないよう、セッションはプライマリから読む
+        if model._meta.app_label in PRIMARY_ONLY_APPS:
+            return PRIMARY
+        if state is not None and state.read_alias is not None and not state.wrote:
+            return state.read_alias
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        state = _current_state.get()
+        if state is not None:
+            state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリの複製のため、どちらから読み込んだオブジェクトも関連付けられる
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db == PRIMARY
+
+
+class ReplicaRoutingMiddleware:
+    # 書き込みのあったリクエストの応答に、プライマリから読む期限を署名付きのCookieで付ける。
+    # セッションの保存も書き込みとして扱うため、SessionMiddlewareより前に置く
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = self.start(request)
+        token = _current_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_state.reset(token)
+        return self.finish(request, response, state)
+
+    async def __acall__(self, request):
+        state = self.start(request)
+        token = _current_state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_state.reset(token)
+        return self.finish(request, response, state)
+
+    def start(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return None
+        try:
+            until = float(request.get_signed_cookie(STICKY_COOKIE_NAME, salt=STICKY_COOKIE_SALT))
+        except (KeyError, ValueError, signing.BadSignature):
+            until = 0
+        return RoutingState(sticky=until > time.time())
+
+    def finish(self, request, response, state):
+        if state is not None and (state.wrote or request.method not in SAFE_METHODS):
+            seconds = settings.DATABASE_PRIMARY_STICKY_SECONDS
+            response.set_signed_cookie(
+                STICKY_COOKIE_NAME,
+                str(time.time() + seconds),
+                salt=STICKY_COOKIE_SALT,
+                max_age=seconds,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
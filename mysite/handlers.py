@@ -0,0 +1,12 @@
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+
+
+class StreamingASGIHandler(ASGIHandler):
+    # ASGIHandlerはリクエストごとに同期処理用のスレッドを用意し、レスポンスを返し終えるまで保持する。
+    # SSEのように長く保持する接続でそれを避けるため、STREAM_PATHSへのリクエストはプロセス共通のスレッドで処理する
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in settings.STREAM_PATHS:
+            await self.handle(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
@@ -0,0 +1,32 @@
+import atexit
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+class QueuedRotatingFileHandler(QueueHandler):
+    # ログの行をキューに積むだけで返し、ファイルへの書き込みとローテーションは別スレッドで行う。
+    # リクエストを処理するスレッドがディスクの書き込みを待たないようにする
+    def __init__(self, filename, maxBytes=0, backupCount=0, encoding="utf-8"):
+        super().__init__(queue.SimpleQueue())
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.file_handler = RotatingFileHandler(
+            filename, maxBytes=maxBytes, backupCount=backupCount, encoding=encoding, delay=True
+        )
+        self.listener = QueueListener(self.queue, self.file_handler)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.file_handler.setFormatter(fmt)
+
+    def prepare(self, record):
+        # 整形は書き込み側のスレッドで行うため、レコードをそのまま渡す
+        return record
+
+    def close(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+        self.file_handler.close()
+        super().close()
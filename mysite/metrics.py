@@ -0,0 +1,279 @@
+import atexit
+import glob
+import json
+import math
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+from django.conf import settings
+
+# 記録はスレッドごとの領域（シャード）に書き込むだけで、ロックを取らない。集計はPrometheusが/metricsを読み込んだときに行う。
+# 複数のワーカープロセスで動かす場合は、各プロセスがMETRICS_MULTIPROCESS_DIRに自分の値を定期的に書き出し、
+# /metricsを処理したプロセスが全プロセス分を合計する
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name}: ラベル{self.labelnames}の値が必要です")
+        return (self.name, tuple(str(value) for value in labelvalues))
+
+    def merge(self, current, value):
+        return current + value
+
+    def expose(self, samples):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for labelvalues, value in sorted(samples.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        shard = self.registry.shard()
+        key = self._key(labelvalues)
+        shard[key] = shard.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        # 値は[各バケットの件数（累積しない）..., 上限を超えた件数, 合計, 件数]
+        shard = self.registry.shard()
+        key = self._key(labelvalues)
+        values = shard.get(key)
+        if values is None:
+            values = shard[key] = [0] * (len(self.buckets) + 3)
+        values[bisect_left(self.buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def merge(self, current, value):
+        return [a + b for a, b in zip(current, value)]
+
+    def expose(self, samples):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for labelvalues, values in sorted(samples.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), values):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(values[-2])}")
+            lines.append(f"{self.name}_count{labels} {values[-1]}")
+        return lines
+
+
+class Gauge(Metric):
+    # 読み込み時にfunctionを呼んで現在の値を得る。複数プロセスでは生存しているプロセスの値を合計する
+    type = "gauge"
+
+    def __init__(self, registry, name, documentation, function):
+        super().__init__(registry, name, documentation)
+        self.function = function
+
+    def collect(self):
+        return {(self.name, ()): self.function()}
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (スレッドへの弱参照, シャード)の一覧。終了したスレッドのシャードは集計時にretiredへまとめる
+        self._shards = []
+        self._retired = {}
+        self._flushed_at = 0.0
+        atexit.register(self.flush, force=True)
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"{metric.name}は登録済みです")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, function):
+        return self._register(Gauge(self, name, documentation, function))
+
+    def shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+            return shard
+
+    def _merge_into(self, result, values):
+        for key, value in values.items():
+            metric = self.metrics.get(key[0])
+            if metric is None:
+                continue
+            if key in result:
+                result[key] = metric.merge(result[key], value)
+            else:
+                # 書き込み中のスレッドと共有しないよう、ヒストグラムのリストは複製する
+                result[key] = list(value) if isinstance(value, list) else value
+
+    def snapshot(self):
+        # このプロセスの全スレッド分を合計した{(名前, ラベルの値): 値}
+        with self._lock:
+            alive = []
+            for ref, shard in self._shards:
+                thread = ref()
+                if thread is not None and thread.is_alive():
+                    alive.append((ref, shard))
+                else:
+                    self._merge_into(self._retired, shard.copy())
+            self._shards = alive
+            result = {}
+            self._merge_into(result, self._retired)
+        for _, shard in alive:
+            self._merge_into(result, shard.copy())
+        return result
+
+    def collect_gauges(self):
+        result = {}
+        for metric in self.metrics.values():
+            if isinstance(metric, Gauge):
+                result.update(metric.collect())
+        return result
+
+    def _path(self, pid):
+        return os.path.join(settings.METRICS_MULTIPROCESS_DIR, f"{pid}.json")
+
+    def flush(self, force=False):
+        # 他のプロセスが集計できるよう、このプロセスの値をファイルに書き出す。リクエストごとに呼ばれるため間隔を空ける
+        directory = settings.METRICS_MULTIPROCESS_DIR
+        now = time.monotonic()
+        if directory is None or (not force and now - self._flushed_at < settings.METRICS_FLUSH_INTERVAL):
+            return
+        self._flushed_at = now
+        os.makedirs(directory, exist_ok=True)
+        samples = [[name, list(labels), value] for (name, labels), value in self.snapshot().items()]
+        gauges = [[name, list(labels), value] for (name, labels), value in self.collect_gauges().items()]
+        path = self._path(os.getpid())
+        # 読み込み側が書きかけのファイルを読まないよう、別名で書いてから置き換える
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump({"samples": samples, "gauges": gauges}, f)
+        os.replace(temporary_path, path)
+
+    def collect(self):
+        result = self.snapshot()
+        gauges = self.collect_gauges()
+        directory = settings.METRICS_MULTIPROCESS_DIR
+        if directory is not None:
+            for path in glob.glob(os.path.join(directory, "*.json")):
+                pid = int(os.path.basename(path)[: -len(".json")])
+                if pid == os.getpid():
+                    continue
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                self._merge_into(result, {(name, tuple(labels)): value for name, labels, value in data["samples"]})
+                # カウンターとヒストグラムは終了したプロセスの分も残し、ゲージは生存しているプロセスの分だけを合計する
+                if _is_alive(pid):
+                    for name, labels, value in data["gauges"]:
+                        key = (name, tuple(labels))
+                        gauges[key] = gauges.get(key, 0) + value
+        result.update(gauges)
+        return result
+
+    def expose(self):
+        samples = {}
+        for (name, labelvalues), value in self.collect().items():
+            samples.setdefault(name, {})[labelvalues] = value
+        lines = []
+        for name, metric in self.metrics.items():
+            lines += metric.expose(samples.get(name, {}))
+        return "\n".join(lines) + "\n"
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    "http_requests_total", "Total HTTP requests by URL name, method and status.", ["view", "method", "status"]
+)
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by URL name.", ["view", "method"]
+)
+db_queries_per_request = registry.histogram(
+    "db_queries_per_request", "Database queries per request by URL name.", ["view"], QUERY_COUNT_BUCKETS
+)
+like_operations = registry.counter("like_operations_total", "Like and unlike operations applied.", ["action"])
+follow_operations = registry.counter("follow_operations_total", "Follow and unfollow operations applied.", ["action"])
+cache_requests = registry.counter("cache_requests_total", "Cache lookups by cache and result.", ["cache", "result"])
+
+
+def observe_request(request, response, stats):
+    # URLの名前（"tweets:home"など）ごとに記録する。URLに一致しなかったリクエストはまとめて"unresolved"とする
+    match = request.resolver_match
+    if match is None:
+        view = "unresolved"
+    else:
+        view = match.view_name if match.url_name else match.route
+    http_requests.inc(view, request.method, response.status_code)
+    http_request_duration.observe(stats.total_time, view, request.method)
+    db_queries_per_request.observe(stats.queries, view)
+    registry.flush()
@@ -0,0 +1,45 @@
+from asgiref.sync import sync_to_async
+from django.contrib.auth.mixins import AccessMixin
+from django.utils.cache import get_conditional_response
+
+from mysite import conditional, db_router
+
+
+def _is_authenticated(request):
+    return request.user.is_authenticated
+
+
+class AsyncLoginRequiredMixin(AccessMixin):
+    # LoginRequiredMixinの非同期版。セッションとユーザーの読み込みを1回のスレッド切り替えで済ませ、
+    # 以降はrequest.userを非同期のコードからそのまま参照できる
+    async def dispatch(self, request, *args, **kwargs):
+        if not await sync_to_async(_is_authenticated)(request):
+            return self.handle_no_permission()
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class ReplicaReadMixin:
+    # GETなどの読み込みだけのリクエストでは、このビューのクエリをリードレプリカに送る（mysite.db_router）
+    def dispatch(self, request, *args, **kwargs):
+        db_router.use_replica(request)
+        return super().dispatch(request, *args, **kwargs)
+
+
+class ConditionalGetMixin:
+    # get_validators()が返す(表示に使う値, 版数のリスト)から検証子を作り、前回から変化がなければ
+    # ビューの主なクエリとテンプレートの描画の前に304を返す（mysite.conditional）
+    def get_validators(self):
+        # Noneのときは検証子を付けずに描画する
+        return None
+
+    def get(self, request, *args, **kwargs):
+        validators = None if conditional.has_messages(request) else self.get_validators()
+        if validators is None:
+            return super().get(request, *args, **kwargs)
+        parts, versions = validators
+        etag, last_modified = conditional.validators(request, parts, versions)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        conditional.patch_response(response, etag, last_modified)
+        return response
@@ -0,0 +1,107 @@
+from datetime import datetime
+
+from django.core import signing
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+
+CURSOR_SALT = "mysite.pagination.cursor"
+
+
+class Cursor:
+    def __init__(self, created_at, pk, reverse=False):
+        self.created_at = created_at
+        self.pk = pk
+        # Trueのときは前のページ（より新しい側）へ戻る
+        self.reverse = reverse
+
+
+def encode_cursor(created_at, pk, reverse=False):
+    return signing.dumps([created_at.isoformat(), pk, int(reverse)], salt=CURSOR_SALT)
+
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        created_at, pk, reverse = signing.loads(token, salt=CURSOR_SALT)
+        return Cursor(datetime.fromisoformat(created_at), int(pk), bool(reverse))
+    except (signing.BadSignature, TypeError, ValueError):
+        raise BadRequest("不正なカーソルです。")
+
+
+class CursorPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def keyset_queryset(queryset, cursor, keys=("created_at", "id")):
+    # (作成日時, id)の降順で並べ、カーソルの位置から続きを取得する。OFFSETを使わないので深いページでもコストが変わらない
+    time_key, id_key = keys
+    if cursor is None:
+        return queryset.order_by(f"-{time_key}", f"-{id_key}")
+    # 先頭の条件でインデックスの範囲を絞り、同じ作成日時の行だけをidで比較する
+    if cursor.reverse:
+        return (
+            queryset.filter(**{f"{time_key}__gte": cursor.created_at})
+            .filter(Q(**{f"{time_key}__gt": cursor.created_at}) | Q(**{f"{id_key}__gt": cursor.pk}))
+            .order_by(time_key, id_key)
+        )
+    return (
+        queryset.filter(**{f"{time_key}__lte": cursor.created_at})
+        .filter(Q(**{f"{time_key}__lt": cursor.created_at}) | Q(**{f"{id_key}__lt": cursor.pk}))
+        .order_by(f"-{time_key}", f"-{id_key}")
+    )
+
+
+def build_page(rows, cursor, per_page, position):
+    # rowsは進行方向の順にper_page + 1件まで取得したもの
+    rows = list(rows)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if cursor is not None and cursor.reverse:
+        rows.reverse()
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, cursor is not None
+    if not rows:
+        return CursorPage(rows)
+    next_cursor = encode_cursor(*position(rows[-1])) if has_next else None
+    previous_cursor = encode_cursor(*position(rows[0]), reverse=True) if has_previous else None
+    return CursorPage(rows, next_cursor, previous_cursor)
+
+
+def paginate(queryset, token, per_page, keys=("created_at", "id")):
+    cursor = decode_cursor(token)
+    rows = keyset_queryset(queryset, cursor, keys)[: per_page + 1]
+    time_key, id_key = keys
+    return build_page(rows, cursor, per_page, lambda obj: (getattr(obj, time_key), getattr(obj, id_key)))
+
+
+class CursorPaginationMixin:
+    paginate_by = 20
+    cursor_keys = ("created_at", "id")
+    cursor_query_param = "cursor"
+
+    def get_cursor_token(self):
+        return self.request.GET.get(self.cursor_query_param)
+
+    def paginate_queryset(self, queryset, page_size):
+        page = paginate(queryset, self.get_cursor_token(), page_size, self.cursor_keys)
+        return None, page, page.object_list, page.has_other_pages()
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils import timezone
+
+from mysite import metrics
+
+logger = logging.getLogger("mysite.performance")
+slow_query_logger = logging.getLogger("mysite.performance.slow_queries")
+
+_current_stats = ContextVar("performance_stats", default=None)
+
+# トランザクションの入れ子（テストではTestCaseの中のatomic）で発行されるセーブポイントはクエリ数に数えない
+SAVEPOINT_STATEMENTS = ("SAVEPOINT ", "RELEASE SAVEPOINT ", "ROLLBACK TO SAVEPOINT ")
+
+# 値だけが違うクエリを同じものとしてまとめるための正規化（文字列・数値・プレースホルダー、IN句とVALUESの個数）
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|\?")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_REPEATED_LIST = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_WHITESPACE = re.compile(r"\s+")
+SLOW_QUERY_MAX_PARAMS = 20
+SLOW_QUERY_MAX_PARAM_LENGTH = 100
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class RequestStats:
+    def __init__(self, request=None):
+        self.request = request
+        self.started_at = time.perf_counter()
+        self.total_time = 0.0
+        self.db_time = 0.0
+        self.queries = 0
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.view_name = None
+        self.query_budget = None
+
+    def resolve_view(self):
+        # URLの解決後であれば、ビューの名前とquery_budgetを設定する
+        match = getattr(self.request, "resolver_match", None)
+        if match is not None and self.view_name is None:
+            view = getattr(match.func, "view_class", match.func)
+            self.view_name = f"{view.__module__}.{view.__qualname__}"
+            self.query_budget = getattr(view, "query_budget", None)
+        return self.view_name
+
+    def server_timing(self):
+        # 時間はミリ秒。テンプレートの描画時間には描画中に評価されたクエリの時間も含む
+        return ", ".join(
+            [
+                f"total;dur={self.total_time * 1000:.1f}",
+                f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"',
+                f"template;dur={self.template_time * 1000:.1f}",
+                f'cache;desc="hit={self.cache_hits} miss={self.cache_misses}"',
+            ]
+        )
+
+    def as_dict(self):
+        return {
+            "view": self.view_name,
+            "total_ms": round(self.total_time * 1000, 2),
+            "db_ms": round(self.db_time * 1000, 2),
+            "queries": self.queries,
+            "query_budget": self.query_budget,
+            "template_ms": round(self.template_time * 1000, 2),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+
+    def over_budget(self):
+        return self.query_budget is not None and self.queries > self.query_budget
+
+
+def record_cache(hit):
+    stats = _current_stats.get()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+def _record_query(execute, sql, params, many, context):
+    # sync_to_asyncで別スレッドから実行されたクエリも、contextvarsを通じて元のリクエストに記録される
+    stats = _current_stats.get()
+    start = time.perf_counter()
+    try:
+        result = execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        if stats is not None:
+            stats.db_time += duration
+            if not sql.startswith(SAVEPOINT_STATEMENTS):
+                stats.queries += 1
+    threshold = settings.SLOW_QUERY_THRESHOLD_MS
+    if threshold is not None and duration * 1000 >= threshold and random.random() < settings.SLOW_QUERY_SAMPLE_RATE:
+        log_slow_query(context["connection"], sql, params, many, duration, stats)
+    return result
+
+
+def fingerprint(sql):
+    sql = _PLACEHOLDER.sub("?", _NUMBER.sub("?", _STRING.sub("?", sql)))
+    sql = _REPEATED_LIST.sub("(...)", _LIST.sub("(...)", sql))
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+def _shorten(value):
+    if isinstance(value, (bytes, str)) and len(value) > SLOW_QUERY_MAX_PARAM_LENGTH:
+        return value[:SLOW_QUERY_MAX_PARAM_LENGTH] + "..."
+    return value
+
+
+def explain(connection, sql, params):
+    # 実行計画を取得するクエリ自体は計測しないよう、この接続のラッパーを外して実行する。
+    # 接続はスレッドごとのため、外している間に他のリクエストのクエリが素通りすることはない
+    wrappers = connection.execute_wrappers
+    connection.execute_wrappers = []
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f"{connection.ops.explain_query_prefix()} {sql}", params)
+            return [str(row[-1]) for row in cursor.fetchall()]
+    except DatabaseError:
+        return None
+    finally:
+        connection.execute_wrappers = wrappers
+
+
+def log_slow_query(connection, sql, params, many, duration, stats):
+    normalized = fingerprint(sql)
+    if many or params is None:
+        logged_params = []
+    elif isinstance(params, dict):
+        logged_params = {key: _shorten(value) for key, value in list(params.items())[:SLOW_QUERY_MAX_PARAMS]}
+    else:
+        logged_params = [_shorten(value) for value in list(params)[:SLOW_QUERY_MAX_PARAMS]]
+    record = {
+        "time": timezone.now().isoformat(),
+        "duration_ms": round(duration * 1000, 2),
+        "fingerprint_id": hashlib.md5(normalized.encode()).hexdigest()[:12],
+        "fingerprint": normalized,
+        "sql": sql,
+        "params": logged_params,
+        "many": many,
+        "database": connection.alias,
+        "view": stats.resolve_view() if stats is not None else None,
+        "path": stats.request.path if stats is not None and stats.request is not None else None,
+        # 書き込みを実行し直さないよう、実行計画はSELECTだけ取得する
+        "explain": (
+            explain(connection, sql, params) if not many and sql.lstrip().upper().startswith("SELECT") else None
+        ),
+    }
+    slow_query_logger.warning(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def _install(connection):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    _install(connection)
+
+
+class PerformanceMiddleware:
+    # リクエストごとの処理時間・DBの時間とクエリ数・テンプレートの描画時間・キャッシュのヒット数を計測し、
+    # Server-Timingヘッダーと"mysite.performance"ロガーへのJSONの行として出力する
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        # 計測を始める前に作られた接続にも記録用のラッパーを付ける
+        for connection in connections.all(initialized_only=True):
+            _install(connection)
+        stats = RequestStats(request)
+        token = _current_stats.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_stats.reset(token)
+        return self.finish(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = RequestStats(request)
+        token = _current_stats.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_stats.reset(token)
+        return self.finish(request, response, stats)
+
+    def process_template_response(self, request, response):
+        stats = _current_stats.get()
+        if stats is not None:
+            render = response.render
+
+            def timed_render():
+                start = time.perf_counter()
+                try:
+                    return render()
+                finally:
+                    stats.template_time += time.perf_counter() - start
+
+            response.render = timed_render
+        return response
+
+    def finish(self, request, response, stats):
+        stats.total_time = time.perf_counter() - stats.started_at
+        stats.resolve_view()
+        response.performance = stats
+        metrics.observe_request(request, response, stats)
+        if settings.PERFORMANCE_SERVER_TIMING:
+            response["Server-Timing"] = stats.server_timing()
+        record = {"method": request.method, "path": request.path, "status": response.status_code, **stats.as_dict()}
+        if stats.over_budget():
+            logger.warning(json.dumps(record))
+            if settings.QUERY_BUDGET_STRICT:
+                raise QueryBudgetExceeded(
+                    f"{stats.view_name}: {stats.queries} queries (budget {stats.query_budget}) for {request.path}"
+                )
+        elif logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(record))
+        return response
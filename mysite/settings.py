@@ -46,6 +46,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # 他のミドルウェアの処理時間やクエリも含めて計測するため、最初に置く
+    "mysite.performance.PerformanceMiddleware",
+    "mysite.db_router.ReplicaRoutingMiddleware",
+    "tweets.sharding.ShardUnavailableMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -83,9 +87,103 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # 同時書き込みでロック待ちになったときに待つ秒数
+        "OPTIONS": {"timeout": 20},
+        # 複数スレッドからの同時書き込みをテストできるよう、テスト用DBもファイルに作成する
+        "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
     }
 }
 
+# リードレプリカとして使うDBの別名（mysite.db_router）。ローカルでは環境変数でDATABASE_REPLICAS=2のように指定すると、
+# db_replica1.sqlite3などのSQLiteのファイルをレプリカとして使う。プライマリからの反映はsync_replicasコマンドで行う
+DATABASE_REPLICAS = [f"replica{i}" for i in range(1, int(os.environ.get("DATABASE_REPLICAS", "0")) + 1)]
+for alias in DATABASE_REPLICAS:
+    DATABASES[alias] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / f"db_{alias}.sqlite3",
+        "OPTIONS": {"timeout": 20},
+        "TEST": {"MIRROR": "default"},
+    }
+# TweetとLikeを分散して置くシャードとして、defaultに加えて使うDBの別名（tweets.sharding）。
+# ローカルでは環境変数でDATABASE_SHARDS=2のように指定すると、db_shard1.sqlite3などのSQLiteのファイルをシャードとして使う。
+# テーブルはmigrate --database=shard1のようにシャードごとに作成する
+DATABASE_SHARDS = [f"shard{i}" for i in range(1, int(os.environ.get("DATABASE_SHARDS", "0")) + 1)]
+for alias in DATABASE_SHARDS:
+    DATABASES[alias] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / f"db_{alias}.sqlite3",
+        "OPTIONS": {"timeout": 20},
+        "TEST": {"NAME": BASE_DIR / f"test_db_{alias}.sqlite3"},
+    }
+# バケットを初めに割り当てるシャードの並び（以降の移動はreshardコマンドで行う）。空ならシャーディングせず、すべてdefaultに置く。
+# 既存のツイートのあるDBで有効にする前にprepare_shardingコマンドを実行する（未実行ならmigrateとcheck --databaseがエラーにする）
+TWEET_SHARDS = ["default", *DATABASE_SHARDS] if DATABASE_SHARDS else []
+# バケットの割り当てをプロセスごとに保持する秒数。reshardコマンドは割り当てを変えた後この秒数より長く待つ
+SHARD_DIRECTORY_CACHE_SECONDS = 1
+# 移動中のバケットへの書き込みには503を返す。再試行までの秒数としてRetry-Afterで伝える
+SHARD_RETRY_AFTER_SECONDS = 5
+# シャードをまたいで一意なidを、プロセスごとにこの個数ずつ予約する
+SHARD_ID_BLOCK_SIZE = 100
+DATABASE_ROUTERS = ["tweets.sharding.ShardRouter", "mysite.db_router.PrimaryReplicaRouter"]
+# 書き込んだ利用者の読み込みを、この秒数の間はプライマリに送る。レプリカの反映の遅れより長くする
+DATABASE_PRIMARY_STICKY_SECONDS = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    "default": {
+        # ヒット数・ミス数をリクエストごとに計測するLocMemCache
+        "BACKEND": "mysite.cache.InstrumentedLocMemCache",
+    },
+    # 描画済みのツイートのHTML（tweets.fragments）。1ページ分で数十件を使うため、上限を大きくする
+    "fragments": {
+        "BACKEND": "mysite.cache.InstrumentedLocMemCache",
+        "LOCATION": "fragments",
+        "OPTIONS": {"MAX_ENTRIES": 20000},
+    },
+    # セッション（SESSION_ENGINEのcached_db）とログイン中のUser（accounts.backends）。ログイン中の利用者の数だけ保持する。
+    # 複数のプロセスで動かす場合は、ログアウトが全プロセスに反映されるようRedisなどの共有のキャッシュにする
+    "sessions": {
+        "BACKEND": "mysite.cache.InstrumentedLocMemCache",
+        "LOCATION": "sessions",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+    # 条件付きGETの検証子の材料になる版数（mysite.conditional）。変更が全プロセスに反映されるよう、
+    # 複数のプロセスで動かす場合は共有のキャッシュにする
+    "versions": {
+        "BACKEND": "mysite.cache.InstrumentedLocMemCache",
+        "LOCATION": "versions",
+        "OPTIONS": {"MAX_ENTRIES": 50000},
+    },
+    # 多くの利用者が同時に開くページ（tweets.pages）。複数のプロセスで動かす場合は共有のキャッシュにすると、
+    # キャッシュに無い値の計算がプロセスをまたいで1回にまとまる
+    "pages": {
+        "BACKEND": "mysite.cache.InstrumentedLocMemCache",
+        "LOCATION": "pages",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+# セッションはDBに書き込むと同時にキャッシュにも保存し、読み込みはキャッシュから行う
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
+SESSION_CACHE_ALIAS = "sessions"
+
+# request.userの読み込みでUserの行をキャッシュする（accounts.backends）。
+# 導入前のセッションにはModelBackendが記録されているため、ログアウトさせないよう後ろに残す
+AUTHENTICATION_BACKENDS = ["accounts.backends.CachedModelBackend", "django.contrib.auth.backends.ModelBackend"]
+# キャッシュしたUserを使う秒数。保存などでは消すが、update()で更新した値（フォロー数の修正など）はこの秒数だけ遅れる
+USER_CACHE_TIMEOUT = 5 * 60
+
+# ユーザー名からユーザーを引くキャッシュ（accounts.usernames）。プロセス内のLRUに保持する件数と秒数、
+# 存在しないユーザー名を覚えておく秒数。USERNAME_CACHE_ALIASにキャッシュの別名を指定すると、LRUの代わりにそのキャッシュを
+# 使ってプロセス間で共有する（複数のプロセスで動かす場合は、名前の変更や削除が全プロセスにすぐ反映されるよう指定する）
+USERNAME_CACHE_MAX_SIZE = 10000
+USERNAME_CACHE_TIMEOUT = 60
+USERNAME_CACHE_NEGATIVE_TIMEOUT = 10
+USERNAME_CACHE_ALIAS = None
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -143,11 +241,26 @@ LOGGING = {
             "level": "DEBUG",
             "class": "logging.StreamHandler",
         },
+        # 遅いクエリの記録は別スレッドでファイルに書き込む（mysite.log_handlers）
+        "slow_query_file": {
+            "class": "mysite.log_handlers.QueuedRotatingFileHandler",
+            "filename": BASE_DIR / "logs" / "slow_queries.log",
+            "maxBytes": 10 * 1024 * 1024,
+            "backupCount": 5,
+        },
     },
     "loggers": {
-        "django.db.backends": {
+        # 全てのSQLを出力するとクエリごとに整形と書き込みの負荷がかかるため、遅いクエリだけを記録する
+        "mysite.performance.slow_queries": {
+            "handlers": ["slow_query_file"],
+            "level": "WARNING",
+            "propagate": False,
+        },
+        # query_budgetを超えたリクエストだけを出力する。リクエストごとの計測値を出力するにはINFOにする
+        "mysite.performance": {
             "handlers": ["console"],
-            "level": "DEBUG",
+            "level": "WARNING",
+            "propagate": False,
         },
     },
 }
@@ -164,3 +277,78 @@ if SQL_DEBUG:
     DEBUG_TOOLBAR_CONFIG = {
         "SHOW_TOOLBAR_CALLBACK": show_toolbar,
     }
+
+# Timeline
+# ホームタイムラインとして保持するツイート数の上限
+TIMELINE_MAX_LENGTH = 800
+TIMELINE_PAGE_SIZE = 50
+# フォロワー数がこれを超えるユーザーのツイートは書き込み時に配信せず、読み込み時に取得する
+TIMELINE_FANOUT_MAX_FOLLOWERS = 10000
+TIMELINE_FANOUT_BATCH_SIZE = 1000
+# 配信先のタイムラインをおおよそこの件数の書き込みごとに上限まで切り詰める
+TIMELINE_TRIM_INTERVAL = 50
+
+# Follow
+# フォローしているユーザーidの集合をキャッシュする上限の件数と秒数
+FOLLOWING_CACHE_MAX_SIZE = 5000
+FOLLOWING_CACHE_TIMEOUT = 60 * 60
+
+# Stream
+# ライブ配信のイベントの配信方法。複数のワーカープロセスで共有する場合は"tweets.streaming.DatabaseBackend"
+STREAM_BACKEND = "tweets.streaming.LocalBackend"
+# 接続ごとに溜めておくイベント数の上限。溢れた場合は古いものから捨てる
+STREAM_QUEUE_SIZE = 100
+STREAM_KEEPALIVE_INTERVAL = 15
+# 切断を検知できない接続が残り続けないよう、この秒数で接続を終えてクライアントに再接続させる
+STREAM_MAX_DURATION = 5 * 60
+STREAM_RETRY_MS = 3000
+# 同期処理用のスレッドを接続ごとに作らず、プロセス共通のスレッドで処理するパス（mysite.handlers）
+STREAM_PATHS = ["/tweets/stream/"]
+# DatabaseBackendの設定
+STREAM_POLL_INTERVAL = 0.5
+STREAM_EVENT_RETENTION = 10000
+
+# Search
+# PostgreSQLでは"tweets.search.PostgreSQLSearchBackend"（pg_trgmのGINインデックスを使用）
+SEARCH_BACKEND = "tweets.search.SQLiteSearchBackend"
+# 一致したツイートのうち新しいものからこの件数までを関連度順に並べて返す
+SEARCH_MAX_RESULTS = 1000
+SEARCH_PAGE_SIZE = 20
+
+# Tweet fragments
+TWEET_FRAGMENT_CACHE = "fragments"
+TWEET_FRAGMENT_CACHE_TIMEOUT = 60 * 60
+
+# Conditional GET
+CONDITIONAL_GET_CACHE = "versions"
+
+# Hot pages
+# 同時に多数のリクエストが読む値のキャッシュ（mysite.stampede）。値を新しいものとして返す秒数と、その後も古い値を返しながら
+# 作り直す秒数。期限の前から確率的に作り直す度合い（大きいほど早め）。計算を1つにまとめるロックの秒数。
+# 作り直しを行うスレッドの数（0のときは古い値を見つけたリクエストが自分で作り直す）
+HOT_CACHE_ALIAS = "pages"
+HOT_CACHE_TIMEOUT = 5
+HOT_CACHE_STALE_SECONDS = 30
+HOT_CACHE_EARLY_BETA = 1.0
+HOT_CACHE_LOCK_TIMEOUT = 5
+HOT_CACHE_REFRESH_WORKERS = 4
+
+# Performance
+# レスポンスにServer-Timingヘッダーを付けて、ブラウザの開発者ツールで処理時間の内訳を見られるようにする
+PERFORMANCE_SERVER_TIMING = True
+# ビューのquery_budgetを超えたクエリ数をエラーにする（テスト用の設定mysite.test_settingsで有効にする）。無効のときは警告のログだけ出す
+QUERY_BUDGET_STRICT = False
+# 実行にこのミリ秒数以上かかったクエリを、実行計画とともにlogs/slow_queries.logに記録する。Noneで無効
+SLOW_QUERY_THRESHOLD_MS = 100
+# 遅いクエリのうち記録する割合。遅いクエリが大量に発生したときにログの書き込みが負荷にならないよう間引く
+SLOW_QUERY_SAMPLE_RATE = 1.0
+
+# Metrics
+# /metricsを取得できるアドレス（REMOTE_ADDR）。プロキシの後ろではプロキシのアドレスになるため、METRICS_TOKENを使う
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+# 設定すると、Authorization: Bearer <トークン>を付けた取得は他のアドレスからでも許す
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# 複数のワーカープロセスで動かす場合に、各プロセスのメトリクスを書き出して共有するディレクトリ。Noneならプロセス内だけで集計する
+METRICS_MULTIPROCESS_DIR = None
+# 各プロセスがメトリクスを書き出す間隔（秒）
+METRICS_FLUSH_INTERVAL = 5
@@ -0,0 +1,158 @@
+import copy
+import logging
+import math
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+logger = logging.getLogger("mysite.stampede")
+
+# 多数のリクエストが同時に読む値（人気のユーザーのプロフィールやツイートの詳細）のキャッシュ。
+# 値と一緒に期限と計算にかかった時間を保存し、期限が切れた瞬間に全員が計算し直す（キャッシュのスタンピード）ことを防ぐ。
+# - キャッシュに無いときは、同じキーの計算を1つにまとめ、他のリクエストはその結果を待つ
+# - 期限の少し前から確率的に作り直す。計算に時間がかかる値ほど早めに作り直す（XFetch）
+# - 期限が切れてもHOT_CACHE_STALE_SECONDSの間は古い値を返し、作り直しはスレッドプールで行う
+# 計算するリクエストは、プロセス内ではキーごとのFuture、プロセス間ではcache.addによるロックで1つに決める
+_MISSING = object()
+
+_lock = threading.Lock()
+# {キー: 計算中のFuture}
+_flights = {}
+_executor = None
+
+
+def get_cache():
+    return caches[settings.HOT_CACHE_ALIAS]
+
+
+def _lock_key(key):
+    return f"{key}:lock"
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(settings.HOT_CACHE_REFRESH_WORKERS, thread_name_prefix="hot-cache")
+        return _executor
+
+
+def _store(key, future, compute, timeout):
+    start = time.monotonic()
+    value = compute()
+    delta = time.monotonic() - start
+    # 計算中に無効にされた値は、無効にする前のデータから作った可能性があるため保存しない
+    if not future.invalidated:
+        get_cache().set(key, (value, time.time() + timeout, delta), timeout + settings.HOT_CACHE_STALE_SECONDS)
+    return value
+
+
+def _compute(key, future, compute, timeout, stale):
+    cache = get_cache()
+    if cache.add(_lock_key(key), True, settings.HOT_CACHE_LOCK_TIMEOUT):
+        try:
+            return _store(key, future, compute, timeout)
+        finally:
+            cache.delete(_lock_key(key))
+    if stale is not _MISSING:
+        # 他のプロセスが作り直している
+        return stale
+    # 他のプロセスの計算が終わるのを待つ。ロックの期限までに終わらなければ自分で計算する
+    deadline = time.monotonic() + settings.HOT_CACHE_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+    return _store(key, future, compute, timeout)
+
+
+def _join(key):
+    # (Future, 自分が計算するか)。同じキーを計算中であれば、そのFutureを返す
+    with _lock:
+        future = _flights.get(key)
+        if future is not None:
+            return future, False
+        future = _flights[key] = Future()
+        future.invalidated = False
+        return future, True
+
+
+def _lead(key, future, compute, timeout, stale=_MISSING):
+    try:
+        value = _compute(key, future, compute, timeout, stale)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(value)
+        return value
+    finally:
+        with _lock:
+            _flights.pop(key, None)
+
+
+def _refresh(key, future, compute, timeout, stale):
+    try:
+        _lead(key, future, compute, timeout, stale)
+    except Exception:
+        logger.exception("%sの作り直しに失敗しました", key)
+    finally:
+        # プールのスレッドはリクエストの外で動くため、使った接続を自分で閉じる
+        connections.close_all()
+
+
+def _is_fresh(expires_at, delta):
+    # 残り時間が計算時間 * beta * -log(乱数)を下回ったら作り直す。乱数は(0, 1]
+    return time.time() - delta * settings.HOT_CACHE_EARLY_BETA * math.log(1.0 - random.random()) < expires_at
+
+
+def get_or_compute(key, compute, timeout=None):
+    # keyの値を返す。無ければcompute()の結果を保存して返す。computeの例外（Http404など）は待っていた全員に伝わる
+    if timeout is None:
+        timeout = settings.HOT_CACHE_TIMEOUT
+    entry = get_cache().get(key)
+    if entry is not None:
+        value, expires_at, delta = entry
+        if not _is_fresh(expires_at, delta):
+            future, leader = _join(key)
+            if leader:
+                if not settings.HOT_CACHE_REFRESH_WORKERS:
+                    return _lead(key, future, compute, timeout, value)
+                _get_executor().submit(_refresh, key, future, compute, timeout, value)
+        return value
+    future, leader = _join(key)
+    if leader:
+        return _lead(key, future, compute, timeout)
+    # 計算したリクエストと同じオブジェクトを変更し合わないよう、複製して返す
+    return copy.deepcopy(future.result())
+
+
+def wait(key, timeout=None):
+    # keyを計算中・作り直し中であれば、終わるまで待つ
+    with _lock:
+        future = _flights.get(key)
+    if future is not None:
+        wait_futures([future], timeout)
+
+
+def expire(key):
+    # 値を古いものとして残す。次に読んだリクエストは古い値を受け取り、作り直しが始まる
+    cache = get_cache()
+    entry = cache.get(key)
+    if entry is not None:
+        cache.set(key, (entry[0], 0, entry[2]), settings.HOT_CACHE_STALE_SECONDS)
+
+
+def invalidate(*keys):
+    with _lock:
+        for key in keys:
+            if key in _flights:
+                _flights[key].invalidated = True
+    get_cache().delete_many(keys)
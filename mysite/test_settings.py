@@ -0,0 +1,27 @@
+import copy
+
+from mysite.settings import *  # noqa: F401,F403
+from mysite.settings import BASE_DIR, DATABASES, LOGGING
+
+# テスト用の設定。manage.py testはこの設定で実行する。他のテストランナーではDJANGO_SETTINGS_MODULEに指定する
+
+# 振り分けのテスト用に、プライマリと同じDBを指すレプリカと、別のファイルのシャードを用意する。テストで指定したときだけ使う
+DATABASES["replica"] = {**DATABASES["default"], "TEST": {"MIRROR": "default"}}
+DATABASE_REPLICAS = []
+DATABASE_SHARDS = ["shard1", "shard2"]
+for alias in DATABASE_SHARDS:
+    DATABASES[alias] = {
+        **DATABASES["default"],
+        "NAME": BASE_DIR / f"db_{alias}.sqlite3",
+        "TEST": {"NAME": BASE_DIR / f"test_db_{alias}.sqlite3"},
+    }
+TWEET_SHARDS = []
+
+# ビューのquery_budgetを超えたクエリ数をエラーにする
+QUERY_BUDGET_STRICT = True
+
+# 計測値のログと遅いクエリの記録はassertLogsで確認し、コンソールやlogs/slow_queries.logには出力しない
+LOGGING = copy.deepcopy(LOGGING)
+LOGGING["handlers"]["null"] = {"class": "logging.NullHandler"}
+LOGGING["handlers"]["slow_query_file"] = {"class": "logging.NullHandler"}
+LOGGING["loggers"]["mysite.performance"]["handlers"] = ["null"]
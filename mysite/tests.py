@@ -0,0 +1,475 @@
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts import follows
+from accounts.views import UserProfileView
+from mysite import db_router, metrics, stampede
+from mysite.log_handlers import QueuedRotatingFileHandler
+from mysite.performance import QueryBudgetExceeded, fingerprint
+from tweets import entities, timeline
+from tweets.likes import like_tweet
+from tweets.models import Tweet
+from tweets.views import HomeView
+
+User = get_user_model()
+
+
+@skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLANの結果はSQLite前提")
+class TestQueryPlans(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.other_user = User.objects.create_user(username="other", password="testpassword")
+        self.client.login(username="tester", password="testpassword")
+        follows.follow(self.user, self.other_user)
+        follows.follow(self.other_user, self.user)
+        for i in range(110):
+            tweet = Tweet.objects.create(
+                user=self.other_user if i % 2 else self.user, content=f"tweet {i} #tag{i % 3} @tester"
+            )
+            entities.index_tweets([tweet])
+            timeline.fan_out_tweet(tweet)
+            like_tweet(self.other_user, tweet.pk)
+        self.tweet = tweet
+
+    def get_full_scans(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+            details = [row[-1] for row in cursor.fetchall()]
+        # インデックスを使わない"SCAN <table>"が全件走査。VALUESの行や件数を絞ったサブクエリの走査と、
+        # 条件を渡せている仮想テーブル（FTS5のMATCHなど、"INDEX <番号>:<条件>"）は除く
+        return [
+            detail
+            for detail in details
+            if detail.startswith("SCAN ")
+            and "USING" not in detail
+            and not re.fullmatch(r"SCAN (\d+ )?CONSTANT ROWS?", detail)
+            and not detail.startswith("SCAN (subquery-")
+            and not re.search(r"VIRTUAL TABLE INDEX \d+:\S", detail)
+        ]
+
+    def assertNoFullTableScan(self, method, url, data=None):
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url, data or {})
+        self.assertLess(response.status_code, 400)
+        statements = [
+            query["sql"]
+            for query in context.captured_queries
+            if query["sql"].split(" ", 1)[0] in ("SELECT", "INSERT", "UPDATE", "DELETE")
+        ]
+        self.assertTrue(statements)
+        for sql in statements:
+            with self.subTest(sql=sql):
+                self.assertEqual(self.get_full_scans(sql), [])
+        return response
+
+    def test_detects_full_table_scan(self):
+        sql = "SELECT id FROM tweets_tweet WHERE content = 'tweet 0'"
+        self.assertEqual(self.get_full_scans(sql), ["SCAN tweets_tweet"])
+
+    def test_home(self):
+        response = self.assertNoFullTableScan("get", reverse("tweets:home"), {})
+        self.assertNoFullTableScan("get", reverse("tweets:home"), {"cursor": response.context["page_obj"].next_cursor})
+
+    def test_home_with_pull_author(self):
+        with self.settings(TIMELINE_FANOUT_MAX_FOLLOWERS=0):
+            self.assertNoFullTableScan("get", reverse("tweets:home"))
+
+    def test_tweet_detail(self):
+        self.assertNoFullTableScan("get", reverse("tweets:detail", kwargs={"pk": self.tweet.pk}))
+
+    def test_user_profile(self):
+        url = reverse("accounts:user_profile", kwargs={"username": "other"})
+        response = self.assertNoFullTableScan("get", url)
+        self.assertNoFullTableScan("get", url, {"cursor": response.context["page_obj"].next_cursor})
+
+    def test_following_list(self):
+        self.assertNoFullTableScan("get", reverse("accounts:following_list", kwargs={"username": "other"}))
+
+    def test_follower_list(self):
+        self.assertNoFullTableScan("get", reverse("accounts:follower_list", kwargs={"username": "other"}))
+
+    def test_like_and_unlike(self):
+        self.assertNoFullTableScan("post", reverse("tweets:like", kwargs={"pk": self.tweet.pk}))
+        self.assertNoFullTableScan("post", reverse("tweets:unlike", kwargs={"pk": self.tweet.pk}))
+
+    def test_hashtag(self):
+        url = reverse("tweets:hashtag", kwargs={"name": "tag1"})
+        response = self.assertNoFullTableScan("get", url)
+        self.assertNoFullTableScan("get", url, {"cursor": response.context["page_obj"].next_cursor})
+
+    def test_mentions(self):
+        response = self.assertNoFullTableScan("get", reverse("tweets:mentions"))
+        self.assertNoFullTableScan(
+            "get", reverse("tweets:mentions"), {"cursor": response.context["page_obj"].next_cursor}
+        )
+
+    def test_tweet_create(self):
+        self.assertNoFullTableScan("post", reverse("tweets:create"), {"content": "new #tag0 @other"})
+
+    def test_tweet_search(self):
+        self.assertNoFullTableScan("get", reverse("tweets:search"), {"q": "tweet 1"})
+
+    def test_detects_full_virtual_table_scan(self):
+        self.assertEqual(
+            self.get_full_scans("SELECT rowid FROM tweets_tweet_fts"), ["SCAN tweets_tweet_fts VIRTUAL TABLE INDEX 0:"]
+        )
+
+    def test_follow_and_unfollow(self):
+        User.objects.create(username="dummy")
+        self.assertNoFullTableScan("post", reverse("accounts:follow", kwargs={"username": "dummy"}))
+        self.assertNoFullTableScan("post", reverse("accounts:unfollow", kwargs={"username": "dummy"}))
+
+
+class TestPerformanceMiddleware(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.login(username="tester", password="testpassword")
+        self.async_client.force_login(self.user)
+        self.tweet = Tweet.objects.create(user=self.user, content="tweet")
+
+    def test_server_timing(self):
+        response = self.client.get(reverse("tweets:home"))
+        stats = response.performance
+        self.assertEqual(stats.view_name, "tweets.views.HomeView")
+        self.assertEqual(stats.query_budget, HomeView.query_budget)
+        self.assertGreater(stats.queries, 0)
+        self.assertGreater(stats.template_time, 0)
+        self.assertRegex(
+            response["Server-Timing"], rf'^total;dur=[\d.]+, db;dur=[\d.]+;desc="{stats.queries} queries"'
+        )
+
+    async def test_async_view(self):
+        response = await self.async_client.post(reverse("tweets:like", kwargs={"pk": self.tweet.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.performance.view_name, "tweets.views.LikeView")
+        self.assertGreater(response.performance.queries, 0)
+
+    def test_cache(self):
+        # フォロー中のユーザーidの一覧は1回目で読み込まれ、2回目はキャッシュから返る
+        self.client.get(reverse("accounts:user_profile", kwargs={"username": "tester"}))
+        response = self.client.get(reverse("accounts:user_profile", kwargs={"username": "tester"}))
+        self.assertGreater(response.performance.cache_hits, 0)
+
+    def test_log(self):
+        with self.assertLogs("mysite.performance", "INFO") as logs:
+            self.client.get(reverse("tweets:home"))
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["path"], reverse("tweets:home"))
+        self.assertEqual(record["status"], 200)
+        self.assertEqual(record["view"], "tweets.views.HomeView")
+
+    def test_query_budget_exceeded(self):
+        with mock.patch.object(UserProfileView, "query_budget", 0):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(reverse("accounts:user_profile", kwargs={"username": "tester"}))
+            with self.settings(QUERY_BUDGET_STRICT=False), self.assertLogs("mysite.performance", "WARNING"):
+                response = self.client.get(reverse("accounts:user_profile", kwargs={"username": "tester"}))
+        self.assertEqual(response.status_code, 200)
+
+
+class TestStampede(TestCase):
+    def setUp(self):
+        self.cache = stampede.get_cache()
+        self.cache.clear()
+
+    def test_cached(self):
+        self.assertEqual(stampede.get_or_compute("key", lambda: 1), 1)
+        self.assertEqual(stampede.get_or_compute("key", lambda: 2), 1)
+        stampede.invalidate("key")
+        self.assertEqual(stampede.get_or_compute("key", lambda: 3), 3)
+
+    def test_stale_while_revalidate(self):
+        stampede.get_or_compute("key", lambda: 1)
+        stampede.expire("key")
+        # 期限切れの値をすぐに返し、作り直しはスレッドプールで行う
+        self.assertEqual(stampede.get_or_compute("key", lambda: 2), 1)
+        stampede.wait("key", timeout=5)
+        self.assertEqual(stampede.get_or_compute("key", lambda: 3), 2)
+
+    @override_settings(HOT_CACHE_REFRESH_WORKERS=0)
+    def test_probabilistic_early_expiration(self):
+        # 計算に10秒かかった値は、期限の1秒前でも乱数によっては作り直す
+        self.cache.set("key", (1, time.time() + 1, 10.0))
+        with mock.patch("random.random", return_value=0.0):
+            self.assertEqual(stampede.get_or_compute("key", lambda: 2), 1)
+        with mock.patch("random.random", return_value=0.5):
+            self.assertEqual(stampede.get_or_compute("key", lambda: 2), 2)
+
+    @override_settings(HOT_CACHE_REFRESH_WORKERS=0)
+    def test_refreshing_in_other_process(self):
+        stampede.get_or_compute("key", lambda: 1)
+        stampede.expire("key")
+        # 他のプロセスがロックを持っていれば、古い値を返して作り直さない
+        self.cache.add("key:lock", True)
+        self.assertEqual(stampede.get_or_compute("key", lambda: 2), 1)
+        self.assertEqual(self.cache.get("key")[0], 1)
+
+    def test_invalidated_while_computing(self):
+        # 計算中に無効にされた値は保存しない
+        def compute():
+            stampede.invalidate("key")
+            return 1
+
+        self.assertEqual(stampede.get_or_compute("key", compute), 1)
+        self.assertIsNone(self.cache.get("key"))
+
+
+class TestSlowQueryLog(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.login(username="tester", password="testpassword")
+        Tweet.objects.create(user=self.user, content="tweet")
+
+    def get_slow_queries(self, url):
+        with self.settings(SLOW_QUERY_THRESHOLD_MS=0):
+            with self.assertLogs("mysite.performance.slow_queries", "WARNING") as logs:
+                response = self.client.get(url)
+        return response, [json.loads(record.getMessage()) for record in logs.records]
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE id IN (%s, %s,  %s) AND name = 'it''s'\n LIMIT 21"),
+            "SELECT * FROM t WHERE id IN (...) AND name = ? LIMIT ?",
+        )
+        self.assertEqual(
+            fingerprint("INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s)"),
+            fingerprint("INSERT INTO t (a, b) VALUES (%s, %s)"),
+        )
+
+    def test_log(self):
+        response, records = self.get_slow_queries(reverse("tweets:home"))
+        self.assertEqual(len(records), response.performance.queries)
+        selects = [record for record in records if record["sql"].startswith("SELECT")]
+        self.assertTrue(selects)
+        for record in selects:
+            self.assertEqual(record["view"], "tweets.views.HomeView")
+            self.assertEqual(record["path"], reverse("tweets:home"))
+            self.assertTrue(record["explain"])
+            self.assertEqual(record["fingerprint"], fingerprint(record["sql"]))
+
+    def test_explain_is_not_counted(self):
+        queries = self.client.get(reverse("tweets:home")).performance.queries
+        response, _ = self.get_slow_queries(reverse("tweets:home"))
+        self.assertEqual(response.performance.queries, queries)
+
+    def test_sampling(self):
+        with self.settings(SLOW_QUERY_THRESHOLD_MS=0, SLOW_QUERY_SAMPLE_RATE=0):
+            with self.assertNoLogs("mysite.performance.slow_queries"):
+                self.client.get(reverse("tweets:home"))
+        with self.settings(SLOW_QUERY_THRESHOLD_MS=None):
+            with self.assertNoLogs("mysite.performance.slow_queries"):
+                self.client.get(reverse("tweets:home"))
+
+    def test_report(self):
+        _, records = self.get_slow_queries(reverse("tweets:home"))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "slow_queries.log")
+            handler = QueuedRotatingFileHandler(path)
+            logger = logging.getLogger("test_slow_query_report")
+            logger.addHandler(handler)
+            for record in records * 2:
+                logger.warning(json.dumps(record))
+            handler.close()
+            logger.removeHandler(handler)
+            out = StringIO()
+            call_command("slow_query_report", path, "--top=1", "--sort=count", stdout=out)
+        self.assertIn(f"{len(records) * 2}件", out.getvalue())
+        self.assertIn("2回", out.getvalue())
+        self.assertIn("ビュー: tweets.views.HomeView (2)", out.getvalue())
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.login(username="tester", password="testpassword")
+        self.async_client.force_login(self.user)
+        self.tweet = Tweet.objects.create(user=self.user, content="tweet")
+
+    def get_value(self, name, *labelvalues):
+        value = metrics.registry.collect().get((name, labelvalues), 0)
+        return value[-1] if isinstance(value, list) else value
+
+    def test_request(self):
+        count = self.get_value("http_request_duration_seconds", "tweets:home", "GET")
+        requests = self.get_value("http_requests_total", "tweets:home", "GET", "200")
+        self.client.get(reverse("tweets:home"))
+        self.assertEqual(self.get_value("http_request_duration_seconds", "tweets:home", "GET"), count + 1)
+        self.assertEqual(self.get_value("http_requests_total", "tweets:home", "GET", "200"), requests + 1)
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        content = response.content.decode()
+        self.assertIn(f'http_request_duration_seconds_count{{view="tweets:home",method="GET"}} {count + 1}', content)
+        self.assertIn('db_queries_per_request_bucket{view="tweets:home",le="+Inf"}', content)
+        self.assertIn("# TYPE stream_subscriptions gauge", content)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_access(self):
+        # 許可したアドレス以外からは、トークンを付けたときだけ取得できる
+        self.assertEqual(self.client.get(reverse("metrics"), REMOTE_ADDR="192.0.2.1").status_code, 403)
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="192.0.2.1", HTTP_AUTHORIZATION="Bearer wrong")
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="192.0.2.1", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        with self.settings(METRICS_TOKEN=None):
+            response = self.client.get(reverse("metrics"), REMOTE_ADDR="192.0.2.1", HTTP_AUTHORIZATION="Bearer ")
+            self.assertEqual(response.status_code, 403)
+
+    async def test_like(self):
+        likes = self.get_value("like_operations_total", "like")
+        await self.async_client.post(reverse("tweets:like", kwargs={"pk": self.tweet.pk}))
+        self.assertEqual(self.get_value("like_operations_total", "like"), likes + 1)
+
+    def test_follow(self):
+        follows = self.get_value("follow_operations_total", "follow")
+        other = User.objects.create(username="other")
+        self.client.post(reverse("accounts:follow", kwargs={"username": other.username}))
+        self.assertEqual(self.get_value("follow_operations_total", "follow"), follows + 1)
+
+    def test_cache(self):
+        for cache in caches.all():
+            cache.clear()
+        counts = {
+            (name, result): self.get_value("cache_requests_total", name, result)
+            for name in ("default", "fragments")
+            for result in ("hit", "miss")
+        }
+        self.client.get(reverse("accounts:user_profile", kwargs={"username": "tester"}))
+        self.client.get(reverse("accounts:user_profile", kwargs={"username": "tester"}))
+        for (name, result), count in counts.items():
+            with self.subTest(cache=name, result=result):
+                self.assertEqual(self.get_value("cache_requests_total", name, result), count + 1)
+
+    def test_histogram(self):
+        registry = metrics.Registry()
+        histogram = registry.histogram("latency_seconds", "Latency.", ["view"], buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, 'a"b')
+        self.assertEqual(
+            registry.expose().splitlines(),
+            [
+                "# HELP latency_seconds Latency.",
+                "# TYPE latency_seconds histogram",
+                'latency_seconds_bucket{view="a\\"b",le="0.1"} 2',
+                'latency_seconds_bucket{view="a\\"b",le="1"} 3',
+                'latency_seconds_bucket{view="a\\"b",le="+Inf"} 4',
+                'latency_seconds_sum{view="a\\"b"} 3.65',
+                'latency_seconds_count{view="a\\"b"} 4',
+            ],
+        )
+
+    def test_threads(self):
+        # スレッドごとのシャードの値は、スレッドの終了後も失われずに合計される
+        registry = metrics.Registry()
+        counter = registry.counter("events_total", "Events.")
+
+        def work():
+            for _ in range(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc()
+        self.assertEqual(registry.collect()[("events_total", ())], 8001)
+        self.assertEqual(registry.collect()[("events_total", ())], 8001)
+
+    def test_multiprocess(self):
+        registry = metrics.Registry()
+        counter = registry.counter("events_total", "Events.")
+        registry.gauge("connections", "Connections.", lambda: 1)
+        counter.inc()
+        exited = subprocess.Popen(["true"])
+        exited.wait()
+        with tempfile.TemporaryDirectory() as directory, self.settings(METRICS_MULTIPROCESS_DIR=directory):
+            # 生存している別のプロセスと、終了したプロセスが書き出したファイル
+            for pid in (os.getppid(), exited.pid):
+                with open(os.path.join(directory, f"{pid}.json"), "w") as f:
+                    json.dump({"samples": [["events_total", [], 10]], "gauges": [["connections", [], 2]]}, f)
+            registry.flush(force=True)
+            self.assertTrue(os.path.exists(os.path.join(directory, f"{os.getpid()}.json")))
+            collected = registry.collect()
+        self.assertEqual(collected[("events_total", ())], 21)
+        self.assertEqual(collected[("connections", ())], 3)
+
+
+@override_settings(DATABASE_REPLICAS=["replica"])
+class TestReplicaRouting(TransactionTestCase):
+    # "replica"はテスト用にプライマリと同じDBを指す（settings.py）。どちらの接続でクエリが実行されたかで振り分けを確認する
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.client.force_login(self.user)
+        self.tweet = Tweet.objects.create(user=self.user, content="tweet")
+        timeline.fan_out_tweet(self.tweet)
+
+    def get(self, url):
+        with CaptureQueriesContext(connections["default"]) as primary, CaptureQueriesContext(
+            connections["replica"]
+        ) as replica:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, [query["sql"] for query in primary], [query["sql"] for query in replica]
+
+    def test_reads_from_replica(self):
+        for url in [
+            reverse("tweets:home"),
+            reverse("tweets:detail", kwargs={"pk": self.tweet.pk}),
+            reverse("accounts:user_profile", kwargs={"username": "tester"}),
+            reverse("accounts:following_list", kwargs={"username": "tester"}),
+            reverse("accounts:follower_list", kwargs={"username": "tester"}),
+        ]:
+            with self.subTest(url=url):
+                response, primary, replica = self.get(url)
+                self.assertTrue(replica)
+                # セッションだけはプライマリから読む
+                self.assertTrue(all("django_session" in sql for sql in primary))
+                self.assertNotIn(db_router.STICKY_COOKIE_NAME, response.cookies)
+
+    def test_other_views_read_from_primary(self):
+        _, primary, replica = self.get(reverse("tweets:mentions"))
+        self.assertTrue(primary)
+        self.assertEqual(replica, [])
+
+    def test_sticky_after_write(self):
+        response = self.client.post(reverse("tweets:like", kwargs={"pk": self.tweet.pk}))
+        self.assertIn(db_router.STICKY_COOKIE_NAME, response.cookies)
+        _, primary, replica = self.get(reverse("tweets:home"))
+        self.assertTrue(primary)
+        self.assertEqual(replica, [])
+        with self.settings(DATABASE_PRIMARY_STICKY_SECONDS=0):
+            self.client.post(reverse("tweets:unlike", kwargs={"pk": self.tweet.pk}))
+        _, _, replica = self.get(reverse("tweets:home"))
+        self.assertTrue(replica)
+
+    def test_tampered_cookie(self):
+        self.client.cookies[db_router.STICKY_COOKIE_NAME] = "9999999999"
+        _, _, replica = self.get(reverse("tweets:home"))
+        self.assertTrue(replica)
+
+    def test_without_replicas(self):
+        with self.settings(DATABASE_REPLICAS=[]):
+            response = self.client.post(reverse("tweets:like", kwargs={"pk": self.tweet.pk}))
+            _, primary, replica = self.get(reverse("tweets:home"))
+        self.assertNotIn(db_router.STICKY_COOKIE_NAME, response.cookies)
+        self.assertTrue(primary)
+        self.assertEqual(replica, [])
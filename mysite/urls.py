@@ -19,8 +19,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from mysite.views import metrics_view
+
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", metrics_view, name="metrics"),
     path("accounts/", include("accounts.urls")),
     path("tweets/", include("tweets.urls")),
     path("", include("welcome.urls")),
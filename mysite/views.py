@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from mysite import metrics
+
+
+def _can_read_metrics(request):
+    # 許可したアドレスからの取得か、METRICS_TOKENをBearerトークンとして付けた取得だけを許す
+    if request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS:
+        return True
+    token = settings.METRICS_TOKEN
+    authorization = request.headers.get("Authorization", "")
+    return bool(token) and constant_time_compare(authorization, f"Bearer {token}")
+
+
+def metrics_view(request):
+    # Prometheusのテキスト形式
+    if not _can_read_metrics(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.registry.expose(), content_type="text/plain; version=0.0.4; charset=utf-8")
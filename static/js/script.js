@@ -1,11 +1,3 @@
-const hearts = document.querySelectorAll('.heart');
-hearts.forEach(heart => {
-    heart.addEventListener('click', function() {
-        this.classList.toggle('is-active');
-      });
-
-})
-
 // CSRF対策
 const getCookie = (name) => {
     if (document.cookie && document.cookie !== '') {
@@ -26,24 +18,131 @@ const request =  {
                             },
                 }
 
+// 画面に表示されているツイートのいいねフォーム。いいねのポーリングでは表示中のツイートだけを問い合わせる
+const visibleLikeForms = new Set()
+const visibilityObserver = 'IntersectionObserver' in window
+    ? new IntersectionObserver(entries => {
+        for (const entry of entries) {
+            if (entry.isIntersecting) visibleLikeForms.add(entry.target)
+            else visibleLikeForms.delete(entry.target)
+        }
+    })
+    : null
+
+// 無限スクロールで追加したツイートにも登録できるよう、rootの中のまだ登録していないハートとフォームに登録する
+const bindLikeForms = (root) => {
+    root.querySelectorAll('.heart:not([data-bound])').forEach(heart => {
+        heart.dataset.bound = 'true'
+        heart.addEventListener('click', function() {
+            this.classList.toggle('is-active');
+          });
+    })
+    root.querySelectorAll('.like-form:not([data-bound])').forEach(likeForm => {
+        likeForm.dataset.bound = 'true'
+        if (visibilityObserver) visibilityObserver.observe(likeForm)
+        likeForm.addEventListener('submit', function(e) {
+            e.preventDefault()
+            const likeNumberElm = document.querySelector(`#like-number-${likeForm.id}`);
+            const changeLikeNumber =  (data) => {
+                    likeNumberElm.textContent =  data.like_number  
+            }
+            //　ハート押下時に付与される"is-active"クラスで分岐
+            if (likeForm.children[0].children[0].classList[1] == "is-active")
+                fetch(`http://127.0.0.1:8000/tweets/${likeForm.id}/like/`, request
+                    ).then(response => {
+                        return response.json()})
+                    .then(changeLikeNumber)
+            else
+                fetch(`http://127.0.0.1:8000/tweets/${likeForm.id}/unlike/`, request).then(response => {
+                        return response.json()})
+                    .then(changeLikeNumber)
+            
+          });
+    })
+}
+bindLikeForms(document)
 const likeForms = document.querySelectorAll('.like-form');
-likeForms.forEach(likeForm => {
-    likeForm.addEventListener('submit', function(e) {
-        e.preventDefault()
-        const likeNumberElm = document.querySelector(`#like-number-${likeForm.id}`);
-        const changeLikeNumber =  (data) => {
-                likeNumberElm.textContent =  data.like_number  
+
+// 無限スクロール。一覧の末尾が画面の下端から2画面分に近づいたら、次のツイートの<li>だけを読み込んで追加する。
+// 次のページのURLは応答のLinkヘッダーで受け取る。JavaScriptが動かない場合はページ送りのリンクをそのまま使う
+const tweetList = document.querySelector('.tweet-list[data-next-url]')
+if (tweetList && 'IntersectionObserver' in window) {
+    let nextUrl = tweetList.dataset.nextUrl
+    let loading = false
+    const pagination = document.querySelector('.pagination')
+    if (pagination) pagination.hidden = true
+    const sentinel = document.createElement('div')
+    tweetList.after(sentinel)
+    const observer = new IntersectionObserver(entries => {
+        if (!entries[0].isIntersecting || loading || !nextUrl) return
+        loading = true
+        fetch(nextUrl)
+            .then(response => {
+                if (!response.ok) throw new Error(response.status)
+                const link = (response.headers.get('Link') || '').match(/<([^>]+)>;\s*rel="next"/)
+                nextUrl = link ? link[1] : null
+                return response.text()
+            })
+            .then(html => {
+                tweetList.insertAdjacentHTML('beforeend', html)
+                bindLikeForms(tweetList)
+                // 追加した後もまだ末尾が近ければ続けて読み込むよう、監視し直す
+                observer.unobserve(sentinel)
+                if (nextUrl) observer.observe(sentinel)
+            })
+            .catch(() => {
+                observer.disconnect()
+                if (pagination) pagination.hidden = false
+            })
+            .finally(() => {
+                loading = false
+            })
+    }, {rootMargin: '0px 0px 200% 0px'})
+    observer.observe(sentinel)
+}
+
+// 表示中のツイートのいいね数といいね状態をまとめて取得して更新する
+// ETagによる条件付きGETのため、変化がなければサーバーは304を返す
+const LIKE_POLLING_INTERVAL = 30000
+// 1回のリクエストで問い合わせるツイートの上限（LikeStatusView.max_tweets）。超える分は分けて問い合わせる
+const LIKE_STATUS_MAX_TWEETS = 100
+const refreshLikes = () => {
+    const forms = visibilityObserver ? visibleLikeForms : document.querySelectorAll('.like-form')
+    const ids = Array.from(forms, likeForm => likeForm.id)
+    for (let i = 0; i < ids.length; i += LIKE_STATUS_MAX_TWEETS) {
+        fetch(`/tweets/likes/?ids=${ids.slice(i, i + LIKE_STATUS_MAX_TWEETS).join(',')}`)
+            .then(response => response.ok ? response.json() : null)
+            .then(data => {
+                if (!data) return
+                for (const [id, tweet] of Object.entries(data.tweets)) {
+                    document.querySelector(`#like-number-${id}`).textContent = tweet.like_count
+                    document.getElementById(id).querySelector('.heart').classList.toggle('is-active', tweet.liked)
+                }
+            })
+    }
+}
+setInterval(refreshLikes, LIKE_POLLING_INTERVAL)
+
+// ASGIで動いている場合はフォロー中のユーザーの新しいツイートと、表示中のツイートのいいね数の変化を受け取る
+// WSGIではサーバーが204を返すため接続せず、上のポーリングだけで更新する
+if (likeForms.length > 0 || location.pathname === '/tweets/home/') {
+    const ids = Array.from(likeForms, likeForm => likeForm.id)
+    const source = new EventSource(`/tweets/stream/?tweets=${ids.join(',')}`)
+    source.addEventListener('like', e => {
+        const data = JSON.parse(e.data)
+        const likeNumberElm = document.querySelector(`#like-number-${data.id}`)
+        if (likeNumberElm) likeNumberElm.textContent = data.like_count
+    })
+    let newTweetCount = 0
+    source.addEventListener('tweet', () => {
+        if (location.pathname !== '/tweets/home/') return
+        newTweetCount += 1
+        let banner = document.querySelector('#new-tweets')
+        if (!banner) {
+            banner = document.createElement('p')
+            banner.id = 'new-tweets'
+            document.querySelector('main').prepend(banner)
         }
-        //　ハート押下時に付与される"is-active"クラスで分岐
-        if (likeForm.children[0].children[0].classList[1] == "is-active")
-            fetch(`http://127.0.0.1:8000/tweets/${likeForm.id}/like/`, request
-                ).then(response => {
-                    return response.json()})
-                .then(changeLikeNumber)
-        else
-            fetch(`http://127.0.0.1:8000/tweets/${likeForm.id}/unlike/`, request).then(response => {
-                    return response.json()})
-                .then(changeLikeNumber)
-        
-      });
-})
+        banner.innerHTML = `<a href="/tweets/home/">新しいツイートが${newTweetCount}件あります</a>`
+    })
+}
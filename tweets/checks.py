@@ -0,0 +1,31 @@
+from django.core.checks import Error, Tags, register
+from django.db import DatabaseError
+
+from mysite.db_router import PRIMARY
+
+from . import sharding
+
+
+@register(Tags.database)
+def check_sharding_prepared(app_configs, databases=None, **kwargs):
+    # シャーディングを有効にする前に作成した行が、idから引けないまま残っていれば有効にさせない。
+    # テーブル全体を数えるため、DBを指定したチェック（migrateやcheck --database default）でだけ行う
+    if not sharding.is_enabled() or not databases or PRIMARY not in databases:
+        return []
+    try:
+        unreachable = sharding.unreachable_tweet_count()
+        stale = sharding.stale_sequences()
+    except DatabaseError:
+        # マイグレーションの前でテーブルが無い
+        return []
+    hint = "manage.py prepare_shardingを実行してください"
+    errors = []
+    if unreachable:
+        errors.append(
+            Error(f"defaultに、idから置き場所を引けないツイートが{unreachable}件あります", hint=hint, id="tweets.E001")
+        )
+    if stale:
+        errors.append(
+            Error(f"idの連番（{', '.join(stale)}）が既存のidに追いついていません", hint=hint, id="tweets.E002")
+        )
+    return errors
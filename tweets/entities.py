@@ -0,0 +1,57 @@
+import re
+import unicodedata
+
+from django.contrib.auth import get_user_model
+
+from .models import Hashtag, Mention, TweetHashtag
+
+# 英単語や文字参照（&#123;）の途中の"#"、メールアドレスの"@"は対象にしない。日本語の直後は区切りとみなす
+HASHTAG_PATTERN = re.compile(r"(?<![0-9A-Za-z_&#])#(\w+)")
+MENTION_PATTERN = re.compile(r"(?<![0-9A-Za-z_@])@([\w.+-]*\w)")
+HASHTAG_MAX_LENGTH = Hashtag._meta.get_field("name").max_length
+
+
+def normalize_hashtag(name):
+    return unicodedata.normalize("NFKC", name).lower()
+
+
+def extract_hashtags(text):
+    # 全角の"＃"も対象にするため、先に全体を正規化する
+    names = {name.lower() for name in HASHTAG_PATTERN.findall(unicodedata.normalize("NFKC", text))}
+    return {name for name in names if len(name) <= HASHTAG_MAX_LENGTH}
+
+
+def extract_mentions(text):
+    return set(MENTION_PATTERN.findall(text))
+
+
+def index_tweets(tweets):
+    # ツイートの件数によらず、まとめて数回のクエリでハッシュタグとメンションの索引を作る。何度実行しても結果は同じ
+    hashtag_names = {tweet.pk: extract_hashtags(tweet.content) for tweet in tweets}
+    mentioned_usernames = {tweet.pk: extract_mentions(tweet.content) for tweet in tweets}
+
+    names = set().union(*hashtag_names.values())
+    if names:
+        Hashtag.objects.bulk_create([Hashtag(name=name) for name in names], ignore_conflicts=True)
+        hashtag_ids = dict(Hashtag.objects.filter(name__in=names).values_list("name", "id"))
+        TweetHashtag.objects.bulk_create(
+            [
+                TweetHashtag(tweet_id=tweet.pk, hashtag_id=hashtag_ids[name], created_at=tweet.created_at)
+                for tweet in tweets
+                for name in hashtag_names[tweet.pk]
+            ],
+            ignore_conflicts=True,
+        )
+
+    usernames = set().union(*mentioned_usernames.values())
+    if usernames:
+        user_ids = dict(get_user_model().objects.filter(username__in=usernames).values_list("username", "id"))
+        Mention.objects.bulk_create(
+            [
+                Mention(tweet_id=tweet.pk, user_id=user_ids[username], created_at=tweet.created_at)
+                for tweet in tweets
+                for username in mentioned_usernames[tweet.pk]
+                if username in user_ids
+            ],
+            ignore_conflicts=True,
+        )
@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+# 閲覧者ごとに変わるいいねの状態は、キャッシュしたHTMLに残した目印を置き換えて埋める。
+# 目印の"<"はツイートの本文ではエスケープされるため、本文から目印を作ることはできない
+LIKED_PLACEHOLDER = mark_safe("<!--liked-->")
+LIKED_CLASS = " is-active "
+FRAGMENT_TEMPLATES = ("tweets/fragments/tweet.html", "tweets/fragments/profile_tweet.html")
+
+
+def get_cache():
+    return caches[settings.TWEET_FRAGMENT_CACHE]
+
+
+def fragment_key(template_name, tweet_id):
+    return f"tweets:fragment:{template_name}:{tweet_id}"
+
+
+def fragment_version(tweet):
+    # 描画結果のうち変わりうる値。いいね数が変わったツイートはキャッシュと一致しなくなり、描画し直す
+    return (tweet.like_count, tweet.user.username, tweet.created_at)
+
+
+def render_tweets(tweets, template_name):
+    # ページ内のツイートのHTMLをまとめて1回でキャッシュから取得し、無いか古いものだけを描画する
+    cache = get_cache()
+    keys = {tweet.pk: fragment_key(template_name, tweet.pk) for tweet in tweets}
+    cached = cache.get_many(keys.values())
+    rendered = {}
+    parts = []
+    for tweet in tweets:
+        version = fragment_version(tweet)
+        entry = cached.get(keys[tweet.pk])
+        if entry is None or entry[0] != version:
+            entry = (version, render_to_string(template_name, {"tweet": tweet, "liked_overlay": LIKED_PLACEHOLDER}))
+            rendered[keys[tweet.pk]] = entry
+        parts.append(entry[1].replace(LIKED_PLACEHOLDER, LIKED_CLASS if getattr(tweet, "liked", False) else ""))
+    if rendered:
+        cache.set_many(rendered, settings.TWEET_FRAGMENT_CACHE_TIMEOUT)
+    return mark_safe("".join(parts))
+
+
+def invalidate(tweet_ids):
+    get_cache().delete_many(
+        [fragment_key(template_name, tweet_id) for template_name in FRAGMENT_TEMPLATES for tweet_id in tweet_ids]
+    )
+
+
+def next_page_url(request, page):
+    # 同じ形式（HTMLかJSON）のまま次のページを指すURL。次のページが無ければNone
+    if not page.has_next():
+        return None
+    query = request.GET.copy()
+    query["cursor"] = page.next_cursor
+    return f"{request.path}?{query.urlencode()}"
+
+
+def tweet_json(tweet):
+    return {
+        "id": tweet.pk,
+        "user": tweet.user.username,
+        "content": tweet.content,
+        "created_at": tweet.created_at.isoformat(),
+        "like_count": tweet.like_count,
+        "liked": getattr(tweet, "liked", False),
+    }
+
+
+def fragment_response(request, tweets, template_name, next_url):
+    # 無限スクロールで追加するツイートだけを返す（format=jsonでは描画せずに値だけを返す）。
+    # 次のページはLinkヘッダーでも知らせ、クライアントが末尾に着く前に先読みできるようにする
+    if request.GET.get("format") == "json":
+        response = JsonResponse({"tweets": [tweet_json(tweet) for tweet in tweets], "next": next_url})
+    else:
+        response = HttpResponse(render_tweets(tweets, template_name))
+    if next_url is not None:
+        response["Link"] = f'<{next_url}>; rel="next"'
+    return response
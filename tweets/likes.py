@@ -0,0 +1,181 @@
+from asgiref.sync import sync_to_async
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from mysite import conditional, metrics
+
+from . import sharding
+from .models import Like, Tweet
+
+
+def _quote(connection, name):
+    return connection.ops.quote_name(name)
+
+
+def _can_return_from_update(connection):
+    if connection.vendor == "sqlite":
+        return connection.features.can_return_columns_from_insert
+    return connection.vendor == "postgresql"
+
+
+def _fetch_like_count(connection, cursor, tweet_id, delta):
+    # (いいね数, 投稿者のid)。ツイートが存在しなければNone
+    tweet_table = _quote(connection, Tweet._meta.db_table)
+    if delta and _can_return_from_update(connection):
+        # 更新と同時に更新後のいいね数を受け取る
+        cursor.execute(
+            f"UPDATE {tweet_table} SET like_count = like_count + %s WHERE id = %s AND like_count + %s >= 0 "
+            "RETURNING like_count, user_id",
+            [delta, tweet_id, delta],
+        )
+        row = cursor.fetchone()
+        if row is not None:
+            return row
+    elif delta:
+        cursor.execute(
+            f"UPDATE {tweet_table} SET like_count = like_count + %s WHERE id = %s AND like_count + %s >= 0",
+            [delta, tweet_id, delta],
+        )
+    cursor.execute(f"SELECT like_count, user_id FROM {tweet_table} WHERE id = %s", [tweet_id])
+    return cursor.fetchone()
+
+
+def _changed(user, tweet_id, row, delta):
+    # いいね数といいねの状態を表示するページの版数を新しくする（mysite.conditional）。戻り値はいいね数
+    if row is None:
+        return None
+    like_count, author_id = row
+    if delta:
+        conditional.bump(
+            conditional.tweet_key(tweet_id), conditional.user_key(author_id), conditional.user_key(user.pk)
+        )
+    return like_count
+
+
+def like_tweet(user, tweet_id):
+    # 既にいいねしていれば何もしない。戻り値は同じトランザクション内で確定したいいね数（ツイートが存在しなければNone）
+    database = sharding.db_for_tweet(tweet_id, write=True) or DEFAULT_DB_ALIAS
+    connection = connections[database]
+    like_table = _quote(connection, Like._meta.db_table)
+    tweet_table = _quote(connection, Tweet._meta.db_table)
+    created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    columns, values, params = "user_id, tweet_id, created_at", "%s, id, %s", [user.pk, created_at]
+    if sharding.is_enabled():
+        columns, values, params = f"id, {columns}", f"%s, {values}", [sharding.new_like_id(tweet_id), *params]
+    metrics.like_operations.inc("like")
+    with transaction.atomic(using=database), connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {like_table} ({columns}) SELECT {values} FROM {tweet_table} WHERE id = %s "
+            "ON CONFLICT (user_id, tweet_id) DO NOTHING",
+            [*params, tweet_id],
+        )
+        delta = cursor.rowcount
+        row = _fetch_like_count(connection, cursor, tweet_id, delta)
+    return _changed(user, tweet_id, row, delta)
+
+
+def unlike_tweet(user, tweet_id):
+    # いいねしていなければ何もしない。戻り値はlike_tweetと同じ
+    database = sharding.db_for_tweet(tweet_id, write=True) or DEFAULT_DB_ALIAS
+    metrics.like_operations.inc("unlike")
+    with transaction.atomic(using=database):
+        deleted, _ = Like.objects.using(database).filter(user=user, tweet_id=tweet_id).delete()
+        with connections[database].cursor() as cursor:
+            row = _fetch_like_count(connections[database], cursor, tweet_id, -deleted)
+    return _changed(user, tweet_id, row, deleted)
+
+
+# 非同期ORMではトランザクションを扱えないため、書き込みはまとめて1回のスレッド切り替えで行う
+alike_tweet = sync_to_async(like_tweet)
+aunlike_tweet = sync_to_async(unlike_tweet)
+
+
+LIKE_OPERATIONS = ("like", "unlike")
+
+
+def apply_like_operations(user, operations):
+    # operationsは(tweet_id, op)の並び。同じツイートへの操作は最後のものだけを適用する
+    final_operations = dict(operations)
+    result = {}
+    for database, tweet_ids in sharding.group_tweets(final_operations, write=True).items():
+        result.update(
+            _apply_like_operations(database, user, {tweet_id: final_operations[tweet_id] for tweet_id in tweet_ids})
+        )
+    return result
+
+
+def _insert_likes(connection, user, tweet_ids):
+    # 実際に追加したいいねのツイートid
+    like_table = _quote(connection, Like._meta.db_table)
+    created_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    columns = "user_id, tweet_id, created_at"
+    rows = [[user.pk, tweet_id, created_at] for tweet_id in tweet_ids]
+    if sharding.is_enabled():
+        columns = f"id, {columns}"
+        rows = [[sharding.new_like_id(tweet_id), *row] for tweet_id, row in zip(tweet_ids, rows)]
+    values = ", ".join(f"({', '.join(['%s'] * len(row))})" for row in rows)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {like_table} ({columns}) VALUES {values} "
+            "ON CONFLICT (user_id, tweet_id) DO NOTHING RETURNING tweet_id",
+            [param for row in rows for param in row],
+        )
+        return {tweet_id for (tweet_id,) in cursor.fetchall()}
+
+
+def _delete_likes(connection, user, tweet_ids):
+    # 実際に削除したいいねのツイートid
+    like_table = _quote(connection, Like._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {like_table} WHERE user_id = %s AND tweet_id IN ({', '.join(['%s'] * len(tweet_ids))}) "
+            "RETURNING tweet_id",
+            [user.pk, *tweet_ids],
+        )
+        return {tweet_id for (tweet_id,) in cursor.fetchall()}
+
+
+def _apply_like_operations(database, user, final_operations):
+    # シャーディングしているときは、ツイートを置くDBごとに1つのトランザクションで適用する
+    connection = connections[database or DEFAULT_DB_ALIAS]
+    tweets = Tweet.objects.using(database)
+    likes = Like.objects.using(database)
+    with transaction.atomic(using=database):
+        tweet_ids = set(tweets.filter(id__in=final_operations).values_list("id", flat=True))
+        like_ids = [tweet_id for tweet_id in tweet_ids if final_operations[tweet_id] == "like"]
+        unlike_ids = [tweet_id for tweet_id in tweet_ids if final_operations[tweet_id] == "unlike"]
+        metrics.like_operations.inc("like", amount=len(like_ids))
+        metrics.like_operations.inc("unlike", amount=len(unlike_ids))
+        # いいね数はlike_tweet・unlike_tweetと同じく、実際に追加・削除したツイートだけ1つずつ増減する
+        if _can_return_from_update(connection):
+            liked_ids = _insert_likes(connection, user, like_ids) if like_ids else set()
+            unliked_ids = _delete_likes(connection, user, unlike_ids) if unlike_ids else set()
+        else:
+            # RETURNINGを使えない古いSQLiteでは、先に既存のいいねを調べる
+            existing_ids = set(likes.filter(user=user, tweet_id__in=tweet_ids).values_list("tweet_id", flat=True))
+            liked_ids = set(like_ids) - existing_ids
+            unliked_ids = set(unlike_ids) & existing_ids
+            new_likes = [Like(user=user, tweet_id=tweet_id) for tweet_id in liked_ids]
+            for like in new_likes:
+                sharding.assign_like_id(like)
+            likes.bulk_create(new_likes, ignore_conflicts=True)
+            if unliked_ids:
+                likes.filter(user=user, tweet_id__in=unliked_ids).delete()
+        if liked_ids:
+            tweets.filter(id__in=liked_ids).update(like_count=F("like_count") + 1)
+        if unliked_ids:
+            tweets.filter(id__in=unliked_ids, like_count__gt=0).update(like_count=F("like_count") - 1)
+        rows = list(
+            tweets.filter(id__in=tweet_ids)
+            .annotate(liked=Exists(Like.objects.filter(user=user, tweet=OuterRef("id"))))
+            .values_list("id", "like_count", "liked", "user_id")
+        )
+    changed_ids = liked_ids | unliked_ids
+    if changed_ids:
+        conditional.bump(
+            conditional.user_key(user.pk),
+            *{conditional.tweet_key(tweet_id) for tweet_id in changed_ids},
+            *{conditional.user_key(author_id) for tweet_id, *_, author_id in rows if tweet_id in changed_ids},
+        )
+    return {tweet_id: {"like_count": count, "liked": liked} for tweet_id, count, liked, _ in rows}
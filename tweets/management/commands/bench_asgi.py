@@ -0,0 +1,87 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.urls import reverse
+
+from accounts.models import User
+from mysite.benchmark import benchmark_database, summarize
+from tweets.models import Tweet
+
+
+class Command(BaseCommand):
+    help = "いいね・フォロー・いいね状態の取得を同時に送り、WSGIとASGIのスループットとp99を比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=400)
+        parser.add_argument("--concurrency", type=int, default=16)
+
+    def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        rounds = max(1, options["requests"] // concurrency)
+        with benchmark_database():
+            users = User.objects.bulk_create([User(username=f"user{i}") for i in range(concurrency)])
+            author = User.objects.create(username="author")
+            tweets = Tweet.objects.bulk_create([Tweet(user=author, content=f"tweet {i}") for i in range(10)])
+            actions = [
+                ("post", reverse("tweets:like", kwargs={"pk": tweets[0].pk})),
+                ("get", f"{reverse('tweets:like_status')}?ids={','.join(str(tweet.pk) for tweet in tweets)}"),
+                ("post", reverse("tweets:unlike", kwargs={"pk": tweets[0].pk})),
+                ("post", reverse("accounts:follow", kwargs={"username": author.username})),
+                ("post", reverse("accounts:unfollow", kwargs={"username": author.username})),
+            ]
+            self.report("WSGI", *self.run_wsgi(users, actions, rounds))
+            self.report("ASGI", *self.run_asgi(users, actions, rounds))
+
+    def run_wsgi(self, users, actions, rounds):
+        def worker(client):
+            samples = []
+            try:
+                for i in range(rounds):
+                    method, url = actions[i % len(actions)]
+                    start = time.perf_counter()
+                    response = getattr(client, method)(url)
+                    samples.append((time.perf_counter() - start, response.status_code))
+            finally:
+                connection.close()
+            return samples
+
+        clients = [self.login(Client(), user) for user in users]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+            results = list(executor.map(worker, clients))
+        return time.perf_counter() - start, results
+
+    def run_asgi(self, users, actions, rounds):
+        async def worker(client):
+            samples = []
+            for i in range(rounds):
+                method, url = actions[i % len(actions)]
+                start = time.perf_counter()
+                response = await getattr(client, method)(url)
+                samples.append((time.perf_counter() - start, response.status_code))
+            return samples
+
+        async def main(clients):
+            return await asyncio.gather(*(worker(client) for client in clients))
+
+        clients = [self.login(AsyncClient(), user) for user in users]
+        start = time.perf_counter()
+        results = asyncio.run(main(clients))
+        return time.perf_counter() - start, results
+
+    def login(self, client, user):
+        client.force_login(user)
+        return client
+
+    def report(self, label, elapsed, results):
+        samples = [sample for result in results for sample in result]
+        errors = sum(1 for _, status in samples if status >= 400)
+        summary = summarize([seconds for seconds, _ in samples])
+        self.stdout.write(
+            f"{label}: {len(samples) / elapsed:.0f} req/s, p50 {summary['p50_ms']:.1f} ms, "
+            f"p99 {summary['p99_ms']:.1f} ms, errors {errors}/{len(samples)}"
+        )
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts.models import User
+from mysite.benchmark import benchmark_database, measure, summarize
+from tweets import timeline
+from tweets.models import Tweet
+
+# 変更前の設定（セッションはDBから読み、request.userは毎回Userの行を読む）
+UNCACHED = {
+    "SESSION_ENGINE": "django.contrib.sessions.backends.db",
+    "AUTHENTICATION_BACKENDS": ["django.contrib.auth.backends.ModelBackend"],
+}
+
+
+class Command(BaseCommand):
+    help = "セッションとrequest.userのキャッシュの有無で、ホームといいねの1リクエストあたりのクエリ数と時間を比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        with benchmark_database(), override_settings(DEBUG=False):
+            viewer = User.objects.create(username="viewer")
+            tweets = Tweet.objects.bulk_create([Tweet(user=viewer, content=f"tweet {i}") for i in range(20)])
+            for tweet in tweets:
+                timeline.fan_out_tweet(tweet)
+            like_urls = [reverse(f"tweets:{op}", kwargs={"pk": tweets[0].pk}) for op in ("like", "unlike")]
+            for label, overrides in (("キャッシュなし", UNCACHED), ("キャッシュあり", {})):
+                with override_settings(**overrides):
+                    client = Client()
+                    client.force_login(viewer)
+                    # キャッシュに載った後の定常状態を計測する
+                    client.get(reverse("tweets:home"))
+                    self.stdout.write(label)
+                    self.report("ホーム", options["repeat"], lambda: client.get(reverse("tweets:home")))
+                    self.report(
+                        "いいね/いいね解除",
+                        options["repeat"],
+                        lambda: [client.post(url) for url in like_urls],
+                        requests=len(like_urls),
+                    )
+
+    def report(self, label, repeat, func, requests=1):
+        with CaptureQueriesContext(connection) as context:
+            samples, _ = measure(func, repeat)
+        summary = summarize([sample / requests for sample in samples])
+        self.stdout.write(
+            f"  {label}: p50 {summary['p50_ms']:.2f} ms, p95 {summary['p95_ms']:.2f} ms, "
+            f"{len(context) / (repeat * requests):.1f} queries/リクエスト"
+        )
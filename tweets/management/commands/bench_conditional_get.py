@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts import follows
+from accounts.models import User
+from mysite.benchmark import benchmark_database, measure, summarize
+from tweets.models import Tweet
+
+
+class Command(BaseCommand):
+    help = "ツイートの詳細・プロフィール・フォローの一覧を、検証子なしで取得した場合と304で返る場合で比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        with benchmark_database(), override_settings(DEBUG=False):
+            viewer = User.objects.create(username="viewer")
+            author = User.objects.create(username="author")
+            tweets = [Tweet.objects.create(user=author, content=f"tweet {i}") for i in range(20)]
+            followers = User.objects.bulk_create([User(username=f"follower{i}") for i in range(20)])
+            for follower in followers:
+                follows.follow(follower, author)
+            follows.follow(viewer, author)
+            client = Client()
+            client.force_login(viewer)
+            for label, url in (
+                ("ツイートの詳細", reverse("tweets:detail", kwargs={"pk": tweets[0].pk})),
+                ("プロフィール", reverse("accounts:user_profile", kwargs={"username": "author"})),
+                ("フォロワーの一覧", reverse("accounts:follower_list", kwargs={"username": "author"})),
+            ):
+                etag = client.get(url)["ETag"]
+                self.stdout.write(label)
+                self.report("検証子なし（200）", options["repeat"], lambda: client.get(url))
+                self.report(
+                    "If-None-Match（304）", options["repeat"], lambda: client.get(url, HTTP_IF_NONE_MATCH=etag)
+                )
+
+    def report(self, label, repeat, func):
+        with CaptureQueriesContext(connection) as context:
+            samples, response = measure(func, repeat)
+        summary = summarize(samples)
+        self.stdout.write(
+            f"  {label}: p50 {summary['p50_ms']:.2f} ms, p95 {summary['p95_ms']:.2f} ms, "
+            f"{len(context) / repeat:.1f} queries/リクエスト, {len(response.content)} bytes"
+        )
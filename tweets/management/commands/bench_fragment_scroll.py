@@ -0,0 +1,63 @@
+from urllib.parse import quote
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts import follows
+from accounts.models import User
+from mysite.benchmark import benchmark_database, measure, summarize
+from tweets import timeline
+from tweets.models import Tweet
+
+
+class Command(BaseCommand):
+    help = "ホームとプロフィールの2ページ目を、ページ全体で取得した場合と無限スクロールの断片で取得した場合で比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tweets", type=int, default=100)
+        parser.add_argument("--repeat", type=int, default=100)
+
+    def handle(self, *args, **options):
+        with benchmark_database(), override_settings(DEBUG=False):
+            viewer = User.objects.create(username="viewer")
+            author = User.objects.create(username="author")
+            follows.follow(viewer, author)
+            for i in range(options["tweets"]):
+                timeline.fan_out_tweet(Tweet.objects.create(user=author, content=f"tweet {i}"))
+            client = Client()
+            client.force_login(viewer)
+            for label, page_url, fragment_url in (
+                ("ホーム", reverse("tweets:home"), reverse("tweets:home_fragment")),
+                (
+                    "プロフィール",
+                    reverse("accounts:user_profile", kwargs={"username": "author"}),
+                    reverse("accounts:user_tweets_fragment", kwargs={"username": "author"}),
+                ),
+            ):
+                cursor = client.get(page_url).context["page_obj"].next_cursor
+                if cursor is None:
+                    self.stdout.write(
+                        f"{label}: ツイートが1ページに収まるため、2ページ目はありません（--tweetsを増やしてください）"
+                    )
+                    continue
+                self.stdout.write(f"{label}の2ページ目")
+                for name, url in (
+                    ("ページ全体", page_url),
+                    ("断片（HTML）", fragment_url),
+                    ("断片（JSON）", f"{fragment_url}?format=json"),
+                ):
+                    self.report(name, options["repeat"], client, url, cursor)
+
+    def report(self, label, repeat, client, url, cursor):
+        separator = "&" if "?" in url else "?"
+        url = f"{url}{separator}cursor={quote(cursor)}"
+        with CaptureQueriesContext(connection) as context:
+            samples, response = measure(lambda: client.get(url), repeat)
+        summary = summarize(samples)
+        self.stdout.write(
+            f"  {label}: p50 {summary['p50_ms']:.2f} ms, p95 {summary['p95_ms']:.2f} ms, "
+            f"{len(context) / repeat:.1f} queries/リクエスト, {len(response.content)} bytes"
+        )
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+from django.template import engines
+from django.test import override_settings
+
+from accounts.models import User
+from mysite.benchmark import benchmark_database, measure, summarize
+from tweets import fragments
+from tweets.models import Like, Tweet
+
+# 変更前と同じく、ツイートごとにテンプレートを描画する
+UNCACHED = '{% for tweet in tweets %}{% include "tweets/fragments/tweet.html" %}{% endfor %}'
+CACHED = "{% load tweet_fragments %}{% render_tweets tweets %}"
+
+
+class Command(BaseCommand):
+    help = "1ページ分のツイートの描画時間を、ツイートごとの描画と描画済みHTMLのキャッシュで比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tweets", type=int, default=100)
+        parser.add_argument("--repeat", type=int, default=200)
+
+    def handle(self, *args, **options):
+        with benchmark_database(), override_settings(DEBUG=False):
+            viewer = User.objects.create(username="viewer")
+            authors = User.objects.bulk_create([User(username=f"author{i}") for i in range(10)])
+            tweets = Tweet.objects.bulk_create(
+                [
+                    Tweet(user=authors[i % len(authors)], content=f"tweet {i} " * 10, like_count=i)
+                    for i in range(options["tweets"])
+                ]
+            )
+            Like.objects.bulk_create([Like(user=viewer, tweet=tweet) for tweet in tweets[::2]])
+            page = list(
+                Tweet.objects.select_related("user").annotate(
+                    liked=Exists(Like.objects.filter(user=viewer, tweet=OuterRef("id")))
+                )
+            )
+            engine = engines["django"]
+            uncached = engine.from_string(UNCACHED)
+            cached = engine.from_string(CACHED)
+            cache = fragments.get_cache()
+
+            def render_cold():
+                cache.clear()
+                return cached.render({"tweets": page})
+
+            self.report("ツイートごとに描画", measure(lambda: uncached.render({"tweets": page}), options["repeat"])[0])
+            self.report("キャッシュなし（初回）", measure(render_cold, options["repeat"])[0])
+            cached.render({"tweets": page})
+            self.report("キャッシュあり", measure(lambda: cached.render({"tweets": page}), options["repeat"])[0])
+
+    def report(self, label, samples):
+        summary = summarize(samples)
+        self.stdout.write(f"{label}: p50 {summary['p50_ms']:.2f} ms, p95 {summary['p95_ms']:.2f} ms")
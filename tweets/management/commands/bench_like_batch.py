@@ -0,0 +1,54 @@
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from accounts.models import User
+from mysite.benchmark import benchmark_database, measure
+from tweets.models import Tweet
+
+
+class Command(BaseCommand):
+    help = "1件ずつのいいね/いいね解除と一括操作APIのスループットを比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--operations", type=int, default=200)
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        size = options["operations"]
+        repeat = options["repeat"]
+        with benchmark_database():
+            user = User.objects.create(username="viewer")
+            tweets = Tweet.objects.bulk_create([Tweet(user=user, content=f"tweet {i}") for i in range(size)])
+            client = Client()
+            client.force_login(user)
+            for op, reverse_op in (("like", "unlike"), ("unlike", "like")):
+                self.stdout.write(f"\n{op} x {size}")
+                urls = [reverse(f"tweets:{op}", kwargs={"pk": tweet.pk}) for tweet in tweets]
+                # 2回目以降の計測が変化のない操作にならないよう、毎回の計測の前に逆の操作で状態を戻す
+                reset = partial(self.toggle, client, tweets, reverse_op)
+                self.report("1件ずつ", size, repeat, lambda: [client.post(url) for url in urls], reset)
+                self.report("一括", size, repeat, lambda: self.toggle(client, tweets, op), reset)
+
+    def toggle(self, client, tweets, op):
+        operations = [{"tweet_id": tweet.pk, "op": op} for tweet in tweets]
+        return client.post(reverse("tweets:like_batch"), {"operations": operations}, content_type="application/json")
+
+    def report(self, label, size, repeat, func, reset):
+        query_counts = []
+
+        def run():
+            with CaptureQueriesContext(connection) as context:
+                func()
+            query_counts.append(len(context))
+
+        samples, _ = measure(run, repeat=repeat, setup=reset)
+        seconds = sum(samples) / len(samples)
+        self.stdout.write(
+            f"  {label}: {seconds * 1000:.1f} ms, {size / seconds:.0f} ops/s, "
+            f"{sum(query_counts) / repeat:.0f} queries"
+        )
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from accounts.models import FriendShip, User
+from mysite.benchmark import benchmark_database, measure, summarize
+from tweets.models import TimelineEntry, Tweet
+
+CHECKPOINTS = (1, 10, 100, 1000)
+
+
+class Command(BaseCommand):
+    help = "カーソルページネーションの1ページ目から深いページまでの応答時間を計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pages", type=int, default=1000)
+        parser.add_argument("--per-page", type=int, default=20)
+
+    def handle(self, *args, **options):
+        pages = options["pages"]
+        per_page = options["per_page"]
+        size = pages * per_page + 1
+        with benchmark_database(), override_settings(TIMELINE_MAX_LENGTH=size, TIMELINE_PAGE_SIZE=per_page):
+            viewer, author = self.seed(size)
+            client = Client()
+            client.force_login(viewer)
+            targets = [
+                ("tweets:home", reverse("tweets:home")),
+                ("accounts:user_profile", reverse("accounts:user_profile", kwargs={"username": author.username})),
+                ("accounts:follower_list", reverse("accounts:follower_list", kwargs={"username": author.username})),
+            ]
+            for name, url in targets:
+                self.stdout.write(f"\n{name}")
+                self.walk(client, url, pages)
+            self.stdout.write("\nOFFSET（比較用、ツイート一覧）")
+            tweets = Tweet.objects.filter(user=author).order_by("-created_at", "-id")
+            for page in CHECKPOINTS:
+                if page <= pages:
+                    offset = (page - 1) * per_page
+                    samples, _ = measure(lambda: list(tweets[offset : offset + per_page]), repeat=20)
+                    self.stdout.write(f"  page {page:>5}: p50 {summarize(samples)['p50_ms']:.2f} ms")
+
+    def seed(self, size):
+        viewer = User.objects.create(username="viewer")
+        author = User.objects.create(username="author")
+        FriendShip.objects.create(follower=viewer, following=author)
+        tweets = Tweet.objects.bulk_create(
+            [Tweet(user=author, content=f"tweet {i}") for i in range(size)], batch_size=1000
+        )
+        TimelineEntry.objects.bulk_create(
+            [TimelineEntry(user=viewer, tweet=tweet, created_at=tweet.created_at) for tweet in tweets],
+            batch_size=1000,
+        )
+        followers = User.objects.bulk_create([User(username=f"follower{i}") for i in range(size)], batch_size=1000)
+        FriendShip.objects.bulk_create(
+            [FriendShip(follower=follower, following=author) for follower in followers], batch_size=1000
+        )
+        return viewer, author
+
+    def walk(self, client, url, pages):
+        cursor = None
+        for page in range(1, pages + 1):
+            params = {"cursor": cursor} if cursor else {}
+            samples, response = measure(lambda: client.get(url, params))
+            if page in CHECKPOINTS:
+                samples += measure(lambda: client.get(url, params), repeat=19)[0]
+                self.stdout.write(f"  page {page:>5}: p50 {summarize(samples)['p50_ms']:.2f} ms")
+            cursor = response.context["page_obj"].next_cursor
+            if cursor is None:
+                break
@@ -0,0 +1,78 @@
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+
+from accounts.models import User
+from mysite.benchmark import benchmark_database, measure, summarize
+from tweets.models import Tweet
+from tweets.search import get_backend
+
+WORDS = (
+    "東京 京都 大阪 ラーメン コーヒー 今日 明日 仕事 勉強 映画 音楽 天気 電車 会議 週末 旅行 写真 ゲーム "
+    "Django Python プログラミング 猫 犬 桜"
+).split()
+PARTICLES = ["の", "は", "を", "に", "が", "で", "と", "、", "。", " "]
+# 出現頻度の低い語として、よく使われる漢字を組み合わせた語を作る
+KANJI = "日本人大年中出一国生子分上間自事者社会同時行地方長業下本前定力学場意開手見"
+
+
+class Command(BaseCommand):
+    help = "指定した件数のツイートで全文検索の応答時間を計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tweets", type=int, default=1_000_000)
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        # SQLのログ出力を含めないよう、本番と同じくDEBUG=Falseで計測する
+        with benchmark_database(), override_settings(DEBUG=False):
+            words = self.seed(options["tweets"])
+            backend = get_backend()
+            self.stdout.write(f"{settings.SEARCH_BACKEND}, {options['tweets']}件")
+            for query in ["京都", "ラーメン", "猫", "東京 コーヒー", "django", words[100], words[-1], "存在しない語"]:
+                samples, tweet_ids = measure(
+                    lambda: backend.search(query, settings.SEARCH_MAX_RESULTS), repeat=options["repeat"]
+                )
+                summary = summarize(samples)
+                self.stdout.write(
+                    f"  {query}: {len(tweet_ids)}件, p50 {summary['p50_ms']:.2f} ms, p99 {summary['p99_ms']:.2f} ms"
+                )
+            self.stdout.write("content__icontains（比較用）")
+            for query in ["京都", "存在しない語"]:
+                samples, _ = measure(
+                    lambda: list(
+                        Tweet.objects.filter(content__icontains=query)
+                        .order_by("-id")
+                        .values_list("id", flat=True)[: settings.SEARCH_MAX_RESULTS]
+                    ),
+                    repeat=3,
+                )
+                self.stdout.write(f"  {query}: p50 {summarize(samples)['p50_ms']:.2f} ms")
+
+    def seed(self, size):
+        rng = random.Random(0)
+        words = WORDS + ["".join(rng.sample(KANJI, rng.randint(2, 4))) for _ in range(2000)]
+        # 語の出現頻度を順位に反比例させる（Zipf分布）
+        weights = [1 / rank for rank in range(1, len(words) + 1)]
+        user = User.objects.create(username="author")
+        backend = get_backend()
+        batch_size = 10000
+        for start in range(0, size, batch_size):
+            with transaction.atomic():
+                tweets = Tweet.objects.bulk_create(
+                    [
+                        Tweet(
+                            user=user,
+                            content="".join(
+                                word + rng.choice(PARTICLES)
+                                for word in rng.choices(words, weights, k=rng.randint(4, 12))
+                            )[:140],
+                        )
+                        for _ in range(min(batch_size, size - start))
+                    ]
+                )
+                backend.index(tweets)
+        return words
@@ -0,0 +1,73 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from accounts.models import User
+from mysite import stampede
+from mysite.benchmark import benchmark_database, summarize
+from tweets import pages, sharding
+from tweets.models import Tweet
+
+
+class Command(BaseCommand):
+    help = "人気のツイートの詳細を同時に開いたときの、ツイートを読み込んだ回数と応答時間を計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=50)
+        parser.add_argument("--delay", type=float, default=0.05, help="ツイートの読み込みにかかる時間として足す秒数")
+
+    def handle(self, *args, **options):
+        with benchmark_database(), override_settings(DEBUG=False):
+            author = User.objects.create(username="celebrity")
+            tweet = Tweet.objects.create(user=author, content="popular tweet")
+            viewers = User.objects.bulk_create([User(username=f"viewer{i}") for i in range(options["clients"])])
+            clients = []
+            for viewer in viewers:
+                client = Client()
+                client.force_login(viewer)
+                clients.append(client)
+            url = reverse("tweets:detail", kwargs={"pk": tweet.pk})
+            key = pages.detail_key(tweet.pk)
+            for label, reset in (
+                ("キャッシュに無い（全員が計算を待つ）", stampede.invalidate),
+                ("期限切れ（古い値を返して裏で作り直す）", stampede.expire),
+            ):
+                clients[0].get(url)
+                reset(key)
+                self.report(label, clients, url, key, options["delay"])
+
+    def report(self, label, clients, url, key, delay):
+        select_user = sharding.select_user
+        computed = []
+        barrier = threading.Barrier(len(clients))
+
+        def slow_select_user(queryset):
+            computed.append(queryset)
+            time.sleep(delay)
+            return select_user(queryset)
+
+        def request(client):
+            barrier.wait()
+            start = time.perf_counter()
+            try:
+                client.get(url)
+                return time.perf_counter() - start
+            finally:
+                connection.close()
+
+        with mock.patch.object(sharding, "select_user", slow_select_user):
+            with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+                samples = list(executor.map(request, clients))
+            # 裏での作り直しも数える
+            stampede.wait(key)
+        summary = summarize(samples)
+        self.stdout.write(
+            f"{label}: {len(clients)}リクエストで読み込み{len(computed)}回, "
+            f"p50 {summary['p50_ms']:.2f} ms, p95 {summary['p95_ms']:.2f} ms"
+        )
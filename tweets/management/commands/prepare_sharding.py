@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.db.models.functions import Mod
+
+from mysite.db_router import PRIMARY
+from tweets import sharding
+from tweets.models import Like, Mention, ShardBucket, TimelineEntry, Tweet, TweetHashtag
+from tweets.search import get_backend
+
+# ツイートのidを参照するテーブルのカラム
+REFERENCES = ((Like, "tweet_id"), (TimelineEntry, "tweet_id"), (TweetHashtag, "tweet_id"), (Mention, "tweet_id"))
+
+
+class Command(BaseCommand):
+    help = (
+        "シャーディングを有効にする前に、defaultにある既存のツイートのidをバケットを持つidに振り直し、"
+        "既存の行のあるバケットをdefaultに割り当てる"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # 1. 払い出すidが既存のidと重ならないよう、連番を既存のidの後ろに進める
+        for allocator, model in sharding.ALLOCATED_MODELS:
+            max_id = model.objects.using(PRIMARY).aggregate(Max("id"))["id__max"] or 0
+            sharding.advance_sequence(allocator.name, max_id)
+
+        # 2. idにバケットを持たないツイートに投稿者のバケットのidを割り当て、参照しているテーブルと検索の索引も書き換える。
+        # Likeの外部キー制約はコミット時に確かめられるため、同じトランザクションの中であれば書き換える順は問わない
+        renumbered = 0
+        while True:
+            tweets = list(sharding.legacy_tweets().order_by("id")[: options["batch_size"]])
+            if not tweets:
+                break
+            old_ids = [tweet.pk for tweet in tweets]
+            with transaction.atomic(using=PRIMARY):
+                for tweet, old_id in zip(tweets, old_ids):
+                    tweet.pk = sharding.tweet_ids.allocate(sharding.bucket_for_user(tweet.user_id))
+                    for model, column in REFERENCES:
+                        model.objects.using(PRIMARY).filter(**{column: old_id}).update(**{column: tweet.pk})
+                    Tweet.objects.using(PRIMARY).filter(pk=old_id).update(id=tweet.pk)
+            get_backend().remove(old_ids)
+            get_backend().index(tweets)
+            renumbered += len(tweets)
+        self.stdout.write(f"{renumbered}件のツイートのidを振り直しました")
+
+        # 3. 既存の行のあるバケットは、reshardで移すまでdefaultで読み書きする
+        buckets = {
+            int(bucket)
+            for bucket in Tweet.objects.using(PRIMARY)
+            .annotate(bucket=Mod("id", sharding.BUCKETS))
+            .values_list("bucket", flat=True)
+            .distinct()
+        }
+        unassigned = sorted(buckets - set(ShardBucket.objects.using(PRIMARY).values_list("bucket", flat=True)))
+        for bucket in unassigned:
+            sharding.set_bucket(bucket, PRIMARY)
+        self.stdout.write(self.style.SUCCESS(f"{len(unassigned)}個のバケットをdefaultに割り当てました"))
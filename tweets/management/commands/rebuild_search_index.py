@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tweets.models import Tweet
+from tweets.search import get_backend
+
+
+class Command(BaseCommand):
+    help = "全文検索の索引を全ツイートから作り直す（bulk_createなどシグナルを経由しない追加の後に実行する）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        batch_size = options["batch_size"]
+        count = 0
+        with transaction.atomic():
+            backend.clear()
+            batch = []
+            for tweet in Tweet.objects.only("content").iterator(chunk_size=batch_size):
+                batch.append(tweet)
+                if len(batch) >= batch_size:
+                    backend.index(batch)
+                    count += len(batch)
+                    batch = []
+            backend.index(batch)
+            count += len(batch)
+        self.stdout.write(self.style.SUCCESS(f"{count}件のツイートを索引に登録しました。"))
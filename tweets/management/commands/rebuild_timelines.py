@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from accounts.models import User
+from tweets import timeline
+
+
+class Command(BaseCommand):
+    help = "ホームタイムラインを作り直す"
+
+    def add_arguments(self, parser):
+        parser.add_argument("usernames", nargs="*", help="対象のユーザー名（省略時は全ユーザー）")
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options["usernames"]:
+            users = users.filter(username__in=options["usernames"])
+        count = 0
+        for user in users.iterator():
+            timeline.rebuild_timeline(user)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"{count}件のタイムラインを作り直しました"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from tweets.models import Like, Tweet
+
+
+class Command(BaseCommand):
+    help = "Tweet.like_countとLikeの実際の件数のずれを修正する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="修正せずにずれている件数だけを表示する")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        like_counts = Like.objects.filter(tweet=OuterRef("pk")).values("tweet").annotate(count=Count("id"))
+        actual_like_count = Coalesce(Subquery(like_counts.values("count")), 0)
+        drifted_ids = list(
+            Tweet.objects.annotate(actual_like_count=actual_like_count)
+            .exclude(like_count=F("actual_like_count"))
+            .values_list("id", flat=True)
+        )
+        if not options["dry_run"]:
+            batch_size = options["batch_size"]
+            for i in range(0, len(drifted_ids), batch_size):
+                Tweet.objects.filter(id__in=drifted_ids[i : i + batch_size]).update(like_count=actual_like_count)
+        action = "見つかりました" if options["dry_run"] else "修正しました"
+        self.stdout.write(self.style.SUCCESS(f"いいね数のずれが{len(drifted_ids)}件{action}"))
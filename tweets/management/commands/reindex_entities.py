@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tweets.entities import index_tweets
+from tweets.models import Tweet
+
+
+class Command(BaseCommand):
+    help = (
+        "既存のツイートからハッシュタグとメンションの索引を作る。一定件数ずつ処理するためメモリ使用量は件数によらない"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        count = 0
+        batch = []
+        for tweet in Tweet.objects.only("content", "created_at").order_by("id").iterator(chunk_size=batch_size):
+            batch.append(tweet)
+            if len(batch) >= batch_size:
+                count += self.index(batch)
+                batch = []
+        count += self.index(batch)
+        self.stdout.write(self.style.SUCCESS(f"{count}件のツイートの索引を作りました。"))
+
+    def index(self, tweets):
+        with transaction.atomic():
+            index_tweets(tweets)
+        return len(tweets)
@@ -0,0 +1,141 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models.functions import Mod
+
+from accounts.models import User
+from tweets import sharding
+from tweets.models import Like, Tweet
+
+# 移動する行と、バケットを決めるカラム、移動中に変わりうるカラム。外部キーのため追加はこの順、削除は逆順に行う
+MOVED_MODELS = ((Tweet, "id", ("like_count",)), (Like, "tweet_id", ()))
+
+
+class Command(BaseCommand):
+    help = "ユーザーのバケット（TweetとLike）を書き込みを止めずに別のシャードへ移動する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("target", help="移動先のDBの別名（TWEET_SHARDSのいずれか）")
+        bucket = parser.add_mutually_exclusive_group(required=True)
+        bucket.add_argument(
+            "--user", help="このユーザーのバケットを移動する（同じバケットのユーザーも一緒に移動する）"
+        )
+        bucket.add_argument("--bucket", type=int)
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--wait",
+            type=float,
+            help="割り当てを変えた後、全プロセスに行き渡るまで待つ秒数（既定はSHARD_DIRECTORY_CACHE_SECONDS + 1）",
+        )
+
+    def handle(self, *args, **options):
+        if not sharding.is_enabled():
+            raise CommandError("TWEET_SHARDSにシャードが設定されていません")
+        target = options["target"]
+        if target not in settings.TWEET_SHARDS:
+            raise CommandError(f"{target}はTWEET_SHARDSにありません")
+        if options["user"] is not None:
+            user = User.objects.filter(username=options["user"]).first()
+            if user is None:
+                raise CommandError(f"ユーザー{options['user']}が見つかりません")
+            bucket = sharding.bucket_for_user(user.pk)
+        else:
+            bucket = options["bucket"]
+            if not 0 <= bucket < sharding.BUCKETS:
+                raise CommandError(f"バケットは0以上{sharding.BUCKETS}未満で指定してください")
+        source, read_only = sharding.directory.get_fresh(bucket)
+        if read_only:
+            raise CommandError(f"バケット{bucket}は移動中です")
+        if source == target:
+            self.stdout.write(f"バケット{bucket}は既に{target}にあります")
+            return
+        self.batch_size = options["batch_size"]
+        wait = options["wait"] if options["wait"] is not None else settings.SHARD_DIRECTORY_CACHE_SECONDS + 1
+
+        # 1. 書き込みを止めずに、その時点の行をまとめてコピーする
+        for model, key, _ in MOVED_MODELS:
+            copied = self.copy(model, key, bucket, source, target)
+            self.stdout.write(f"{model.__name__}: {copied}件をコピーしました")
+
+        # 2. 書き込みを止め、全プロセスの割り当てが更新されるのを待ってから、コピー中の変更を反映する
+        sharding.set_bucket(bucket, source, read_only=True)
+        try:
+            time.sleep(wait)
+            for model, key, _ in reversed(MOVED_MODELS):
+                deleted = self.ids(model, key, bucket, target) - self.ids(model, key, bucket, source)
+                self.delete(model, target, sorted(deleted))
+            for model, key, fields in MOVED_MODELS:
+                self.sync(model, key, fields, bucket, source, target)
+        except BaseException:
+            sharding.set_bucket(bucket, source)
+            raise
+
+        # 3. 割り当てを切り替え、古い割り当てで移動元を読んでいるプロセスがなくなってから移動元の行を消す
+        sharding.set_bucket(bucket, target)
+        time.sleep(wait)
+        for model, key, _ in reversed(MOVED_MODELS):
+            self.delete(model, source, sorted(self.ids(model, key, bucket, source)))
+        self.stdout.write(self.style.SUCCESS(f"バケット{bucket}を{source}から{target}へ移動しました"))
+
+    def rows(self, model, key, bucket, database):
+        return model.objects.using(database).annotate(bucket=Mod(key, sharding.BUCKETS)).filter(bucket=bucket)
+
+    def ids(self, model, key, bucket, database):
+        return set(self.rows(model, key, bucket, database).values_list("id", flat=True))
+
+    def copy(self, model, key, bucket, source, target):
+        copied = 0
+        last_id = 0
+        while True:
+            objects = list(
+                self.rows(model, key, bucket, source).filter(id__gt=last_id).order_by("id")[: self.batch_size]
+            )
+            if not objects:
+                return copied
+            self.insert(model, target, objects)
+            copied += len(objects)
+            last_id = objects[-1].pk
+
+    def sync(self, model, key, fields, bucket, source, target):
+        source_rows = {row[0]: row for row in self.rows(model, key, bucket, source).values_list("id", *fields)}
+        target_rows = {row[0]: row for row in self.rows(model, key, bucket, target).values_list("id", *fields)}
+        # コピーの後に追加された行をコピーし、変更された値（いいね数）を書き換える。削除された行は先に消しておく
+        missing = sorted(source_rows.keys() - target_rows.keys())
+        for i in range(0, len(missing), self.batch_size):
+            self.insert(
+                model, target, list(model.objects.using(source).filter(id__in=missing[i : i + self.batch_size]))
+            )
+        changed = [
+            model(**dict(zip(("id", *fields), row)))
+            for pk, row in source_rows.items()
+            if pk in target_rows and target_rows[pk] != row
+        ]
+        if changed:
+            model.objects.using(target).bulk_update(changed, fields, batch_size=self.batch_size)
+
+    def insert(self, model, database, objects):
+        # bulk_createはauto_now_addのcreated_atを現在時刻で上書きするため、値をそのまま書き込む
+        connection = connections[database]
+        fields = model._meta.concrete_fields
+        columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+        placeholders = ", ".join(["%s"] * len(fields))
+        rows = [
+            [field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields] for obj in objects
+        ]
+        with transaction.atomic(using=database), connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {connection.ops.quote_name(model._meta.db_table)} ({columns}) VALUES ({placeholders}) "
+                "ON CONFLICT DO NOTHING",
+                rows,
+            )
+
+    def delete(self, model, database, ids):
+        # 行の移動のための削除のため、削除のシグナル（索引やタイムラインの削除）を送らずに消す
+        connection = connections[database]
+        table = connection.ops.quote_name(model._meta.db_table)
+        for i in range(0, len(ids), self.batch_size):
+            batch = ids[i : i + self.batch_size]
+            with transaction.atomic(using=database), connection.cursor() as cursor:
+                cursor.execute(f"DELETE FROM {table} WHERE id IN ({', '.join(['%s'] * len(batch))})", batch)
@@ -0,0 +1,133 @@
+import json
+import platform
+import time
+
+import django
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import User
+from mysite.benchmark import benchmark_database, summarize
+from tweets.models import Tweet
+
+SEED_OPTIONS = ("users", "follows", "tweets", "likes", "exponent", "seed")
+
+
+class Command(BaseCommand):
+    help = "seed_dataで生成したデータで主要な画面とAPIを計測し、結果をJSONで保存・比較する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--follows", type=int, default=30)
+        parser.add_argument("--tweets", type=int, default=20000)
+        parser.add_argument("--likes", type=int, default=50000)
+        parser.add_argument("--exponent", type=float, default=1.0)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--repeat", type=int, default=30)
+        parser.add_argument("--save", help="結果を保存するJSONファイル")
+        parser.add_argument("--compare", help="比較の基準にするJSONファイル")
+        parser.add_argument("--threshold", type=float, default=20, help="p95がこの割合（%%）以上悪化したら失敗とする")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+        # SQLのログ出力を含めないよう、本番と同じくDEBUG=Falseで計測する
+        with benchmark_database(), override_settings(DEBUG=False):
+            call_command("seed_data", *[f"--{name}={options[name]}" for name in SEED_OPTIONS], stdout=self.stdout)
+            results = {name: self.measure(*scenario, repeat=options["repeat"]) for name, *scenario in self.scenarios()}
+        report = {
+            "meta": {
+                "created_at": timezone.now().isoformat(),
+                "options": {name: options[name] for name in (*SEED_OPTIONS, "repeat")},
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+            },
+            "results": results,
+        }
+        self.report(results, baseline)
+        if options["save"]:
+            with open(options["save"], "w") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        if baseline is not None:
+            self.check_regressions(results, baseline["results"], options["threshold"])
+
+    def scenarios(self):
+        # 閲覧者はフォロー数が中央値のユーザー、表示対象は最もフォロワーの多いユーザーと最もいいねの多いツイート
+        users = User.objects.order_by("following_count", "id")
+        viewer = users[users.count() // 2]
+        popular_user = User.objects.order_by("-follower_count", "id").first()
+        popular_tweet = Tweet.objects.order_by("-like_count", "id").first()
+        client = Client()
+        client.force_login(viewer)
+        profile_kwargs = {"username": popular_user.username}
+        like_url = reverse("tweets:like", kwargs={"pk": popular_tweet.pk})
+        unlike_url = reverse("tweets:unlike", kwargs={"pk": popular_tweet.pk})
+        return [
+            ("home", client, "get", reverse("tweets:home")),
+            ("tweet_detail", client, "get", reverse("tweets:detail", kwargs={"pk": popular_tweet.pk})),
+            ("user_profile", client, "get", reverse("accounts:user_profile", kwargs=profile_kwargs)),
+            ("following_list", client, "get", reverse("accounts:following_list", kwargs=profile_kwargs)),
+            ("follower_list", client, "get", reverse("accounts:follower_list", kwargs=profile_kwargs)),
+            # いいね（いいね解除）の前に毎回いいね解除（いいね）して、計測するリクエストで必ず追加（削除）と
+            # いいね数の更新が起きるようにする。戻すリクエストは計測に含めない
+            ("like", client, "post", like_url, unlike_url),
+            ("unlike", client, "post", unlike_url, like_url),
+        ]
+
+    def measure(self, client, method, url, reset_url=None, repeat=1):
+        queries = []
+
+        def count_queries(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        samples = []
+        query_counts = []
+        # 1回目はキャッシュなどの準備が含まれるため計測しない
+        if reset_url:
+            client.post(reset_url)
+        getattr(client, method)(url)
+        for _ in range(repeat):
+            if reset_url:
+                client.post(reset_url)
+            queries.clear()
+            with connection.execute_wrapper(count_queries):
+                start = time.perf_counter()
+                response = getattr(client, method)(url)
+                samples.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                raise CommandError(f"{url}: {response.status_code}")
+            query_counts.append(len(queries))
+        return {**summarize(samples), "queries": max(query_counts)}
+
+    def report(self, results, baseline):
+        for name, result in results.items():
+            line = (
+                f"{name:<15} p50 {result['p50_ms']:7.2f} ms  p95 {result['p95_ms']:7.2f} ms  "
+                f"p99 {result['p99_ms']:7.2f} ms  {result['queries']:3d} queries"
+            )
+            previous = baseline and baseline["results"].get(name)
+            if previous:
+                change = (result["p95_ms"] / previous["p95_ms"] - 1) * 100
+                line += f"  (p95 {change:+.0f}%, queries {result['queries'] - previous['queries']:+d})"
+            self.stdout.write(line)
+
+    def check_regressions(self, results, baseline, threshold):
+        regressions = [
+            name
+            for name, result in results.items()
+            if name in baseline
+            and (
+                result["p95_ms"] > baseline[name]["p95_ms"] * (1 + threshold / 100)
+                or result["queries"] > baseline[name]["queries"]
+            )
+        ]
+        if regressions:
+            raise CommandError(f"基準より悪化しました: {', '.join(regressions)}")
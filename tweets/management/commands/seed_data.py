@@ -0,0 +1,103 @@
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.models import FriendShip, User
+from tweets.models import Like, Tweet
+
+WORDS = (
+    "今日 明日 東京 京都 ラーメン コーヒー 仕事 勉強 映画 音楽 天気 電車 週末 旅行 写真 Django Python 猫 犬 桜".split()
+)
+
+
+def zipf_weights(size, exponent):
+    # 順位のexponent乗に反比例する重み。少数のユーザーにフォロワーやいいねが集中する分布を作る
+    return [1 / rank**exponent for rank in range(1, size + 1)]
+
+
+class Command(BaseCommand):
+    help = "性能計測用に、ユーザー・べき分布のフォロー関係・ツイート・いいねをまとめて生成する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--follows", type=int, default=30, help="1ユーザーあたりの平均フォロー数")
+        parser.add_argument("--tweets", type=int, default=20000)
+        parser.add_argument("--likes", type=int, default=50000)
+        parser.add_argument("--exponent", type=float, default=1.0, help="人気の偏りを表すべき分布の指数")
+        parser.add_argument("--days", type=int, default=30, help="ツイートの作成日時を分布させる日数")
+        parser.add_argument("--prefix", default="user", help="生成するユーザー名の接頭辞")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        users = self.create_users(options["users"], options["prefix"])
+        weights = zipf_weights(len(users), options["exponent"])
+        self.create_follows(users, weights, options["follows"])
+        tweets = self.create_tweets(users, weights, options["tweets"], options["days"])
+        self.create_likes(users, tweets, options["exponent"], options["likes"])
+        # bulk_createはシグナルや非正規化したカラムの更新を経由しないため、既存のコマンドで整える
+        for command in (
+            "reconcile_follow_counts",
+            "reconcile_like_counts",
+            "rebuild_timelines",
+            "rebuild_search_index",
+            "reindex_entities",
+        ):
+            call_command(command, stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f"{len(users)}人、{len(tweets)}件のツイートを生成しました"))
+
+    def bulk_create(self, model, objects, **kwargs):
+        created = []
+        for i in range(0, len(objects), self.batch_size):
+            with transaction.atomic():
+                created += model.objects.bulk_create(objects[i : i + self.batch_size], **kwargs)
+        return created
+
+    def create_users(self, size, prefix):
+        # パスワードのハッシュ化は重いため、全員同じハッシュを使う
+        password = make_password("password")
+        return self.bulk_create(User, [User(username=f"{prefix}{i}", password=password) for i in range(size)])
+
+    def create_follows(self, users, weights, follows):
+        # フォロー数は平均followsの指数分布、フォローする相手は人気の高いユーザーほど選ばれやすい
+        friendships = []
+        for follower in users:
+            count = min(len(users) - 1, int(self.rng.expovariate(1 / follows)))
+            followings = {user for user in self.rng.choices(users, weights, k=count) if user != follower}
+            friendships += [FriendShip(follower=follower, following=following) for following in followings]
+        self.bulk_create(FriendShip, friendships, ignore_conflicts=True)
+
+    def create_tweets(self, users, weights, size, days):
+        now = timezone.now()
+        span = timedelta(days=days) / max(size, 1)
+        tweets = []
+        for user in self.rng.choices(users, weights, k=size):
+            words = self.rng.choices(WORDS, k=self.rng.randint(3, 10))
+            if self.rng.random() < 0.2:
+                words.append(f"#{self.rng.choice(WORDS)}")
+            if self.rng.random() < 0.1:
+                words.append(f"@{self.rng.choice(users).username}")
+            tweets.append(Tweet(user=user, content=" ".join(words)[:140]))
+        tweets = self.bulk_create(Tweet, tweets)
+        # created_atはauto_now_addでbulk_createの時刻になるため、古いものから順に作成日時を散らす
+        for i, tweet in enumerate(tweets):
+            tweet.created_at = now - span * (size - i)
+        for i in range(0, len(tweets), self.batch_size):
+            with transaction.atomic():
+                Tweet.objects.bulk_update(tweets[i : i + self.batch_size], ["created_at"], batch_size=500)
+        return tweets
+
+    def create_likes(self, users, tweets, exponent, size):
+        if not tweets:
+            return
+        # 新しいツイートほど、また一部のツイートにいいねが集中するようにする
+        tweet_weights = zipf_weights(len(tweets), exponent)[::-1]
+        pairs = set(zip(self.rng.choices(users, k=size), self.rng.choices(tweets, tweet_weights, k=size)))
+        self.bulk_create(Like, [Like(user=user, tweet=tweet) for user, tweet in pairs], ignore_conflicts=True)
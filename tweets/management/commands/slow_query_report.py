@@ -0,0 +1,76 @@
+import glob
+import json
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+SORT_KEYS = ("total", "count", "max", "avg")
+
+
+class Command(BaseCommand):
+    help = "遅いクエリのログ（logs/slow_queries.log）を正規化したクエリごとに集計し、上位を表示する"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "files", nargs="*", help="集計するログファイル。省略時はローテーションされたものも含めて全て"
+        )
+        parser.add_argument("--top", type=int, default=10)
+        parser.add_argument("--sort", choices=SORT_KEYS, default="total", help="並べ替えに使う値")
+
+    def handle(self, *args, **options):
+        files = options["files"] or self.default_files()
+        if not files:
+            raise CommandError("遅いクエリのログが見つかりません")
+        groups = self.aggregate(files)
+        ranked = sorted(groups.values(), key=lambda group: group[options["sort"]], reverse=True)
+        self.stdout.write(f"{sum(group['count'] for group in groups.values())}件、{len(groups)}種類のクエリ")
+        for rank, group in enumerate(ranked[: options["top"]], 1):
+            self.stdout.write(
+                f"\n{rank}. [{group['fingerprint_id']}] {group['count']}回, 合計 {group['total']:.1f} ms, "
+                f"平均 {group['avg']:.1f} ms, 最大 {group['max']:.1f} ms"
+            )
+            self.stdout.write(f"   {group['fingerprint']}")
+            views = ", ".join(f"{view} ({count})" for view, count in group["views"].most_common(3))
+            self.stdout.write(f"   ビュー: {views}")
+            if group["explain"]:
+                self.stdout.write("   実行計画（最も遅かった実行）:")
+                for line in group["explain"]:
+                    self.stdout.write(f"     {line}")
+
+    def default_files(self):
+        for handler in settings.LOGGING["handlers"].values():
+            if handler["class"] == "mysite.log_handlers.QueuedRotatingFileHandler":
+                return sorted(glob.glob(f"{handler['filename']}*"))
+        return []
+
+    def aggregate(self, files):
+        groups = {}
+        for path in files:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    group = groups.setdefault(
+                        record["fingerprint_id"],
+                        {
+                            "fingerprint_id": record["fingerprint_id"],
+                            "fingerprint": record["fingerprint"],
+                            "count": 0,
+                            "total": 0.0,
+                            "max": 0.0,
+                            "views": Counter(),
+                            "explain": None,
+                        },
+                    )
+                    group["count"] += 1
+                    group["total"] += record["duration_ms"]
+                    group["views"][record["view"] or "（リクエスト外）"] += 1
+                    if record["duration_ms"] >= group["max"]:
+                        group["max"] = record["duration_ms"]
+                        group["explain"] = record["explain"]
+        for group in groups.values():
+            group["avg"] = group["total"] / group["count"]
+        return groups
@@ -0,0 +1,106 @@
+import asyncio
+import gc
+import threading
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.urls import reverse
+
+from accounts import follows
+from accounts.models import User
+from mysite.benchmark import benchmark_database, summarize
+from mysite.handlers import StreamingASGIHandler
+from tweets import streaming
+from tweets.models import Tweet
+
+
+class Command(BaseCommand):
+    help = "ASGIアプリケーションにSSEの接続を大量に張ったまま保持し、1接続あたりのメモリと配信の遅延を計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=5000)
+        parser.add_argument("--hold", type=float, default=5, help="接続を保持する秒数")
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            viewer = User.objects.create(username="viewer")
+            author = User.objects.create(username="author")
+            follows.follow(viewer, author)
+            tweet = Tweet.objects.create(user=author, content="soak")
+            client = Client()
+            client.force_login(viewer)
+            session_id = client.cookies[settings.SESSION_COOKIE_NAME].value
+            asyncio.run(self.soak(session_id, tweet, options["connections"], options["hold"]))
+
+    async def soak(self, session_id, tweet, connections, hold):
+        application = StreamingASGIHandler()
+        received = {}
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        threads = threading.active_count()
+
+        start = time.perf_counter()
+        tasks = [
+            asyncio.create_task(self.connect(application, session_id, index, received)) for index in range(connections)
+        ]
+        while len(streaming.hub) < connections:
+            await asyncio.sleep(0.1)
+        self.stdout.write(f"{connections}接続を確立: {time.perf_counter() - start:.1f} 秒")
+
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+        self.stdout.write(f"1接続あたりのメモリ: {(after - before) / connections / 1024:.1f} KiB")
+        self.stdout.write(f"スレッド数: {threads} → {threading.active_count()}")
+        tracemalloc.stop()
+
+        await asyncio.sleep(hold)
+        published_at = time.perf_counter()
+        await streaming.apublish(
+            streaming.author_topic(tweet.user_id), {"type": "tweet", "id": tweet.pk, "user_id": tweet.user_id}
+        )
+        while len(received) < connections:
+            await asyncio.sleep(0.01)
+        summary = summarize([received_at - published_at for received_at in received.values()])
+        self.stdout.write(f"全接続への配信: p50 {summary['p50_ms']:.1f} ms, p99 {summary['p99_ms']:.1f} ms")
+
+        streaming.hub.close_all()
+        await asyncio.gather(*tasks)
+
+    async def connect(self, application, session_id, index, received):
+        path = reverse("tweets:stream")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": b"",
+            "root_path": "",
+            "headers": [
+                (b"host", b"testserver"),
+                (b"cookie", f"{settings.SESSION_COOKIE_NAME}={session_id}".encode()),
+            ],
+            "client": ("127.0.0.1", 0),
+            "server": ("testserver", 80),
+        }
+        request_sent = False
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            # クライアントからは切断しない
+            await asyncio.Future()
+
+        async def send(message):
+            if message["type"] == "http.response.body" and b"event: tweet" in message.get("body", b""):
+                received.setdefault(index, time.perf_counter())
+
+        await application(scope, receive, send)
@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from mysite.db_router import PRIMARY
+
+
+class Command(BaseCommand):
+    help = "ローカルでレプリカの代わりに使うSQLiteのファイルへ、プライマリの内容を複製する"
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError("DATABASE_REPLICASにレプリカが設定されていません")
+        primary = connections[PRIMARY]
+        if primary.vendor != "sqlite":
+            raise CommandError("SQLite以外ではDBのレプリケーション機能を使ってください")
+        primary.ensure_connection()
+        for alias in settings.DATABASE_REPLICAS:
+            replica = connections[alias]
+            replica.ensure_connection()
+            # SQLiteのオンラインバックアップで、書き込み中のプライマリからも一貫した内容を複製する
+            primary.connection.backup(replica.connection)
+            self.stdout.write(f"{alias}: {replica.settings_dict['NAME']}")
+        self.stdout.write(self.style.SUCCESS(f"{len(settings.DATABASE_REPLICAS)}件のレプリカを更新しました"))
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:18
+
+from django.conf import settings
+from django.db import migrations
+
+
+def backfill_timelines(apps, schema_editor):
+    User = apps.get_model("accounts", "User")
+    FriendShip = apps.get_model("accounts", "FriendShip")
+    Tweet = apps.get_model("tweets", "Tweet")
+    TimelineEntry = apps.get_model("tweets", "TimelineEntry")
+    for user_id in User.objects.values_list("id", flat=True).iterator():
+        author_ids = [user_id, *FriendShip.objects.filter(follower_id=user_id).values_list("following_id", flat=True)]
+        tweets = (
+            Tweet.objects.filter(user_id__in=author_ids)
+            .order_by("-created_at", "-id")
+            .values_list("id", "created_at")[: settings.TIMELINE_MAX_LENGTH]
+        )
+        TimelineEntry.objects.bulk_create(
+            [TimelineEntry(user_id=user_id, tweet_id=tweet_id, created_at=created_at) for tweet_id, created_at in tweets],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+    # スキーマの変更（0004_timelineentry）とは別のトランザクションで行を更新する。
+    # PostgreSQLでは、行を変更したトランザクションの中でALTER TABLEを実行できない（pending trigger events）
+
+    dependencies = [
+        ("tweets", "0004_timelineentry"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_timelines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tweets", "0004_backfill_timelines"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="tweet",
+            index=models.Index(fields=["user", "created_at", "id"], name="tweet_user_created_idx"),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-17 19:31
+
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_like_count(apps, schema_editor):
+    Tweet = apps.get_model("tweets", "Tweet")
+    Like = apps.get_model("tweets", "Like")
+    like_counts = Like.objects.filter(tweet=OuterRef("pk")).values("tweet").annotate(count=Count("id"))
+    Tweet.objects.update(like_count=Coalesce(Subquery(like_counts.values("count")), 0))
+
+
+class Migration(migrations.Migration):
+    # 列の追加（0006_tweet_like_count）とは別のトランザクションで行を更新する。
+    # PostgreSQLでは、行を変更したトランザクションの中でALTER TABLEを実行できない（pending trigger events）
+
+    dependencies = [
+        ("tweets", "0006_tweet_like_count"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_like_count, migrations.RunPython.noop),
+    ]
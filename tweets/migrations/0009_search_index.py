@@ -0,0 +1,61 @@
+import re
+import unicodedata
+
+from django.db import migrations
+
+# tweets.searchの変更がこのマイグレーションに影響しないよう、作成時点のテーブル名とトークナイザをここに持つ
+FTS_TABLE = "tweets_tweet_fts"
+RUN_PATTERN = re.compile(r"[^\W_]+")
+
+
+def tokenize(text):
+    # 文字と数字の並びを2文字ずつ（bi-gram）に区切り、並びの最後の1文字も加える
+    tokens = []
+    for run in RUN_PATTERN.findall(unicodedata.normalize("NFKC", text).lower()):
+        tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+        tokens.append(run[-1])
+    return " ".join(tokens)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(terms, prefix='1')")
+        Tweet = apps.get_model("tweets", "Tweet")
+        rows = []
+        for tweet in Tweet.objects.only("content").iterator(chunk_size=2000):
+            rows.append((tweet.pk, tokenize(tweet.content)))
+            if len(rows) >= 2000:
+                _insert_terms(schema_editor, rows)
+                rows = []
+        _insert_terms(schema_editor, rows)
+    elif vendor == "postgresql":
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        schema_editor.execute(
+            "CREATE INDEX tweet_content_trgm_idx ON tweets_tweet USING gin (content gin_trgm_ops)"
+        )
+
+
+def _insert_terms(schema_editor, rows):
+    if rows:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(f"INSERT INTO {FTS_TABLE} (rowid, terms) VALUES (%s, %s)", rows)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(f"DROP TABLE {FTS_TABLE}")
+    elif vendor == "postgresql":
+        schema_editor.execute("DROP INDEX tweet_content_trgm_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("tweets", "0008_streamevent"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("tweets", "0010_hashtag_mention"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdSequence",
+            fields=[
+                ("name", models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ("next_value", models.BigIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ShardBucket",
+            fields=[
+                ("bucket", models.PositiveIntegerField(primary_key=True, serialize=False)),
+                ("database", models.CharField(max_length=100)),
+                ("read_only", models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="like",
+            name="user",
+            field=models.ForeignKey(
+                db_constraint=False,
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="mention",
+            name="tweet",
+            field=models.ForeignKey(
+                db_constraint=False,
+                db_index=False,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="mentions",
+                to="tweets.tweet",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="timelineentry",
+            name="tweet",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="timeline_entries",
+                to="tweets.tweet",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="tweet",
+            name="user",
+            field=models.ForeignKey(
+                db_constraint=False,
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="tweethashtag",
+            name="tweet",
+            field=models.ForeignKey(
+                db_constraint=False,
+                db_index=False,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="tweet_hashtags",
+                to="tweets.tweet",
+            ),
+        ),
+    ]
@@ -3,23 +3,155 @@ from django.db import models
 
 
 class Tweet(models.Model):
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    # 単独のインデックスはtweet_user_created_idxで代用できるため作成しない。
+    # シャーディングではユーザーと別のDBに置くため、DBの外部キー制約は作らない（tweets.sharding）
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_index=False, db_constraint=False)
     content = models.TextField(max_length=140)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Likeの件数を非正規化して保持する。LikeView/UnlikeViewで同じトランザクション内で更新する
+    like_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"{self.user.username} - {self.content} ({self.created_at})"
 
+    def save(self, *args, **kwargs):
+        from .sharding import assign_tweet_id
+
+        # 保存先のシャードはidで決まるため、DBを選ぶ前にidを割り当てる
+        database = assign_tweet_id(self)
+        if database is not None:
+            kwargs["using"] = database
+        super().save(*args, **kwargs)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created_at", "id"], name="tweet_user_created_idx"),
+        ]
+
 
 class Like(models.Model):
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    tweet = models.ForeignKey(Tweet, related_name="likes", on_delete=models.CASCADE)
+    # 単独のインデックスはlike_uniqueとlike_tweet_user_idxで代用できるため作成しない
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_index=False, db_constraint=False)
+    tweet = models.ForeignKey(Tweet, related_name="likes", on_delete=models.CASCADE, db_index=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"{self.user.username} → {self.tweet} ({self.created_at})"
 
+    def save(self, *args, **kwargs):
+        from .sharding import assign_like_id
+
+        database = assign_like_id(self)
+        if database is not None:
+            kwargs["using"] = database
+        super().save(*args, **kwargs)
+
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=["user", "tweet"], name="like_unique"),
         ]
+        indexes = [
+            models.Index(fields=["tweet", "user"], name="like_tweet_user_idx"),
+        ]
+
+
+class TimelineEntry(models.Model):
+    # 単独のインデックスはtimeline_user_created_idxで代用できるため作成しない
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name="timeline_entries", on_delete=models.CASCADE, db_index=False
+    )
+    # ツイートはシャードに置くことがあるため、DBの制約と削除の連鎖を使わず、Tweetの削除のシグナルで消す（tweets.signals）
+    tweet = models.ForeignKey(Tweet, related_name="timeline_entries", on_delete=models.DO_NOTHING, db_constraint=False)
+    # ツイートの作成日時を複製しておき、タイムラインの並び替えをこのテーブルだけで完結させる
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.user.username} ← {self.tweet_id} ({self.created_at})"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "tweet"], name="timeline_entry_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "created_at", "tweet"], name="timeline_user_created_idx"),
+        ]
+
+
+class StreamEvent(models.Model):
+    # 複数のワーカープロセスでライブ配信のイベントを共有するためのログ（streaming.DatabaseBackendで使用）
+    topic = models.CharField(max_length=100)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.topic}: {self.payload}"
+
+
+class Hashtag(models.Model):
+    # nameは正規化（NFKC、小文字）したもの。"#"は含まない
+    name = models.CharField(max_length=100, unique=True)
+
+    def __str__(self):
+        return f"#{self.name}"
+
+
+class TweetHashtag(models.Model):
+    # 単独のインデックスはtweet_hashtag_uniqueとtweet_hashtag_created_idxで代用できるため作成しない
+    tweet = models.ForeignKey(
+        Tweet, related_name="tweet_hashtags", on_delete=models.DO_NOTHING, db_index=False, db_constraint=False
+    )
+    hashtag = models.ForeignKey(Hashtag, related_name="tweet_hashtags", on_delete=models.CASCADE, db_index=False)
+    # ツイートの作成日時を複製しておき、ハッシュタグごとの一覧をこのテーブルだけで並べ替える
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.hashtag_id} ← {self.tweet_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["tweet", "hashtag"], name="tweet_hashtag_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["hashtag", "created_at", "tweet"], name="tweet_hashtag_created_idx"),
+        ]
+
+
+class Mention(models.Model):
+    tweet = models.ForeignKey(
+        Tweet, related_name="mentions", on_delete=models.DO_NOTHING, db_index=False, db_constraint=False
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name="mentions", on_delete=models.CASCADE, db_index=False
+    )
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.user_id} ← {self.tweet_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["tweet", "user"], name="mention_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "created_at", "tweet"], name="mention_user_created_idx"),
+        ]
+
+
+class ShardBucket(models.Model):
+    # バケットを置くシャードの割り当て（tweets.sharding）。行の無いバケットは既定の割り当てに従う。
+    # read_onlyは移動中（reshardコマンド）で、書き込みは移動が終わるまで503で断る（tweets.sharding）
+    bucket = models.PositiveIntegerField(primary_key=True)
+    database = models.CharField(max_length=100)
+    read_only = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.bucket} → {self.database}"
+
+
+class IdSequence(models.Model):
+    # シャードをまたいで一意なidを払い出すための連番。プロセスごとにまとめて予約する（tweets.sharding.IdAllocator）
+    name = models.CharField(max_length=50, primary_key=True)
+    next_value = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
@@ -0,0 +1,64 @@
+from mysite import conditional, stampede
+from mysite.pagination import paginate
+
+from . import sharding
+from .models import Like, Tweet
+
+# 多くの利用者が同時に開くページ（ツイートの詳細、プロフィールの最初のページ）のうち、閲覧者によらない部分を
+# mysite.stampedeでキャッシュする。閲覧者ごとのいいねの状態は、キャッシュした値に別のクエリで重ねる。
+# いいね数はHOT_CACHE_TIMEOUT秒まで遅れて反映され、ツイートの投稿・削除とユーザーの変更ではキャッシュを消す。
+# 値は計算する前の版数（mysite.conditional）と組にして返し、古い値を返すときも内容と検証子が一致するようにする
+
+
+def detail_key(tweet_id):
+    return f"tweets:detail:{tweet_id}"
+
+
+def profile_key(user_id):
+    return f"tweets:profile:{user_id}"
+
+
+def get_tweet(tweet_id):
+    # (版数, ツイート)。存在しないツイートはNone
+    def compute():
+        (version,) = conditional.get_versions(conditional.tweet_key(tweet_id))
+        tweets = sharding.select_user(Tweet.objects.using(sharding.db_for_tweet(tweet_id)))
+        return version, tweets.filter(pk=tweet_id).first()
+
+    return stampede.get_or_compute(detail_key(tweet_id), compute)
+
+
+def get_profile_page(user_id, per_page):
+    # (版数, 最初のページ)
+    def compute():
+        (version,) = conditional.get_versions(conditional.user_key(user_id))
+        tweets = sharding.select_user(Tweet.objects.using(sharding.db_for_user(user_id))).filter(user_id=user_id)
+        return version, paginate(tweets, None, per_page)
+
+    return stampede.get_or_compute(profile_key(user_id), compute)
+
+
+def overlay_liked(tweets, user, database=None):
+    # tweetsのいいねはすべてdatabaseにある（同じ投稿者のツイート）
+    tweet_ids = [tweet.pk for tweet in tweets]
+    liked_ids = set()
+    if tweet_ids:
+        liked_ids = set(
+            Like.objects.using(database).filter(user=user, tweet_id__in=tweet_ids).values_list("tweet_id", flat=True)
+        )
+    for tweet in tweets:
+        tweet.liked = tweet.pk in liked_ids
+
+
+def invalidate_tweet(tweet):
+    stampede.invalidate(detail_key(tweet.pk), profile_key(tweet.user_id))
+
+
+def invalidate_profile(user_id):
+    stampede.invalidate(profile_key(user_id))
+
+
+def invalidate_author(user_id):
+    # 投稿者（ユーザー名）を含むプロフィールと、投稿者のすべてのツイートの詳細を消す
+    tweet_ids = Tweet.objects.using(sharding.db_for_user(user_id)).filter(user_id=user_id).values_list("id", flat=True)
+    stampede.invalidate(profile_key(user_id), *(detail_key(tweet_id) for tweet_id in tweet_ids))
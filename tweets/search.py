@@ -0,0 +1,112 @@
+import re
+import unicodedata
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from .models import Tweet
+
+FTS_TABLE = "tweets_tweet_fts"
+
+# FTS5のunicode61トークナイザが単語の一部とみなす文字（文字と数字）の並び
+_RUN_PATTERN = re.compile(r"[^\W_]+")
+
+
+def _runs(text):
+    return _RUN_PATTERN.findall(unicodedata.normalize("NFKC", text).lower())
+
+
+def tokenize(text):
+    # 日本語は単語の区切りが無いため、文字の並びを2文字ずつ（bi-gram）に区切る。
+    # 1文字での検索に備えて、並びの最後の1文字も加えておく
+    tokens = []
+    for run in _runs(text):
+        tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+        tokens.append(run[-1])
+    return " ".join(tokens)
+
+
+def build_match_query(query):
+    # 空白で区切った語をすべて含むツイートを探すFTS5のクエリ。語はbi-gramの連続（フレーズ）として照合する
+    phrases = []
+    for run in _runs(query):
+        if len(run) == 1:
+            phrases.append(f'"{run}"*')
+        else:
+            phrases.append('"' + " ".join(run[i : i + 2] for i in range(len(run) - 1)) + '"')
+    return " AND ".join(phrases) or None
+
+
+class SQLiteSearchBackend:
+    # FTS5の仮想テーブル（rowidはツイートのid）。トークン化はPythonで行い、シグナルで同期する
+    def index(self, tweets):
+        rows = [(tweet.pk, tokenize(tweet.content)) for tweet in tweets]
+        if rows:
+            with connection.cursor() as cursor:
+                cursor.executemany(f"INSERT OR REPLACE INTO {FTS_TABLE} (rowid, terms) VALUES (%s, %s)", rows)
+
+    def remove(self, tweet_ids):
+        tweet_ids = list(tweet_ids)
+        if tweet_ids:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(tweet_ids))})", tweet_ids
+                )
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+    def search(self, query, limit):
+        match = build_match_query(query)
+        if match is None:
+            return []
+        # 一致するツイートのうち新しいものからlimit件だけを関連度（bm25）で並べ替える。
+        # よく使われる語でも全件を並べ替えずに済む
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM (SELECT rowid, rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+                "ORDER BY rowid DESC LIMIT %s) ORDER BY rank, rowid DESC",
+                [match, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgreSQLSearchBackend:
+    # pg_trgmのGINインデックス（tweet_content_trgm_idx）を使う。インデックスはDBが更新するため同期は不要
+    def index(self, tweets):
+        pass
+
+    def remove(self, tweet_ids):
+        pass
+
+    def clear(self):
+        pass
+
+    def search(self, query, limit):
+        from django.contrib.postgres.search import TrigramWordSimilarity
+
+        terms = query.split()
+        if not terms:
+            return []
+        tweets = Tweet.objects.all()
+        for term in terms:
+            tweets = tweets.filter(content__icontains=term)
+        recent = tweets.order_by("-id").values("id")[:limit]
+        return list(
+            Tweet.objects.filter(id__in=recent)
+            .annotate(similarity=TrigramWordSimilarity(query, "content"))
+            .order_by("-similarity", "-id")
+            .values_list("id", flat=True)
+        )
+
+
+_backends = {}
+
+
+def get_backend():
+    backend = _backends.get(settings.SEARCH_BACKEND)
+    if backend is None:
+        backend = _backends[settings.SEARCH_BACKEND] = import_string(settings.SEARCH_BACKEND)()
+    return backend
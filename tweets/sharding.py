@@ -0,0 +1,299 @@
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import Count, F, Max
+from django.db.models.functions import Mod
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+
+from mysite.db_router import PRIMARY
+
+from .models import IdSequence, Like, ShardBucket, Tweet
+
+# TweetとLikeを投稿者ごとにsettings.TWEET_SHARDSのDBへ分散して置く。
+# 投稿者はuser_id % BUCKETSの論理的なバケットに属し、バケットを置くDBはShardBucketの表で決める（行が無ければ既定の割り当て）。
+# ツイートのidは下位にバケットの番号を持つため、idだけで置き場所が分かる。Likeはいいねされたツイートと同じDBに置く。
+# TWEET_SHARDSが空のときは何もせず、すべてdefaultに置く。
+# 既存の行があるDBで有効にする前には、prepare_shardingコマンドでidにバケットを持たせ、既存のバケットをdefaultに割り当てる
+BUCKETS = 1024
+SHARDED_MODELS = ("tweets.tweet", "tweets.like")
+
+
+class ShardUnavailable(Exception):
+    pass
+
+
+class ShardUnavailableMiddleware(MiddlewareMixin):
+    # 移動中のバケットへの書き込みはリクエストのスレッドで待たずに503を返し、Retry-Afterの秒数の後にやり直させる
+    def process_exception(self, request, exception):
+        if not isinstance(exception, ShardUnavailable):
+            return None
+        response = HttpResponse(str(exception), status=503, content_type="text/plain; charset=utf-8")
+        response["Retry-After"] = str(settings.SHARD_RETRY_AFTER_SECONDS)
+        return response
+
+
+def is_enabled():
+    return bool(settings.TWEET_SHARDS)
+
+
+def bucket_for_user(user_id):
+    return user_id % BUCKETS
+
+
+def bucket_for_tweet(tweet_id):
+    return tweet_id % BUCKETS
+
+
+def default_database(bucket):
+    # ShardBucketに行の無いバケットの割り当て
+    return settings.TWEET_SHARDS[bucket % len(settings.TWEET_SHARDS)]
+
+
+class Directory:
+    # バケットの割り当てをプロセスごとにSHARD_DIRECTORY_CACHE_SECONDSの間だけ保持する
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._loaded_at = None
+
+    def clear(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _load(self):
+        buckets = {
+            bucket: (database, read_only)
+            for bucket, database, read_only in ShardBucket.objects.using(PRIMARY).values_list(
+                "bucket", "database", "read_only"
+            )
+        }
+        with self._lock:
+            self._buckets = buckets
+            self._loaded_at = time.monotonic()
+
+    def get(self, bucket):
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at >= settings.SHARD_DIRECTORY_CACHE_SECONDS:
+            self._load()
+        return self._buckets.get(bucket) or (default_database(bucket), False)
+
+    def get_fresh(self, bucket):
+        row = ShardBucket.objects.using(PRIMARY).filter(bucket=bucket).values_list("database", "read_only").first()
+        return row or (default_database(bucket), False)
+
+
+directory = Directory()
+
+
+@receiver(setting_changed)
+def clear_directory(setting, **kwargs):
+    if setting in ("TWEET_SHARDS", "SHARD_DIRECTORY_CACHE_SECONDS"):
+        directory.clear()
+
+
+def set_bucket(bucket, database, read_only=False):
+    ShardBucket.objects.using(PRIMARY).update_or_create(
+        bucket=bucket, defaults={"database": database, "read_only": read_only}
+    )
+    directory.clear()
+
+
+def all_databases():
+    # バケットを置いているすべてのDB（既定の割り当てとreshardで移した先）
+    moved = ShardBucket.objects.using(PRIMARY).values_list("database", flat=True).distinct()
+    return sorted({*settings.TWEET_SHARDS, *moved})
+
+
+def database_for_bucket(bucket, write=False):
+    database, read_only = directory.get(bucket)
+    if write and read_only:
+        # 保持している割り当てが古いことがあるため、プライマリで確かめてから移動中のバケットへの書き込みを断る
+        database, read_only = directory.get_fresh(bucket)
+        if read_only:
+            raise ShardUnavailable(f"バケット{bucket}は移動中です")
+    return database
+
+
+def db_for_user(user_id, write=False):
+    # シャーディングしていなければNoneを返す。QuerySet.using(None)は通常の振り分け（mysite.db_router）に従う
+    if not is_enabled():
+        return None
+    return database_for_bucket(bucket_for_user(user_id), write)
+
+
+def db_for_tweet(tweet_id, write=False):
+    if not is_enabled():
+        return None
+    return database_for_bucket(bucket_for_tweet(tweet_id), write)
+
+
+def _group(ids, bucket_function, write):
+    if not is_enabled():
+        return {None: list(ids)}
+    groups = {}
+    for value in ids:
+        groups.setdefault(database_for_bucket(bucket_function(value), write), []).append(value)
+    return groups
+
+
+def group_tweets(tweet_ids, write=False):
+    # {DBの別名: ツイートidのリスト}。シャーディングしていなければ{None: すべてのid}
+    return _group(tweet_ids, bucket_for_tweet, write)
+
+
+def group_users(user_ids, write=False):
+    return _group(user_ids, bucket_for_user, write)
+
+
+async def agroup_tweets(tweet_ids):
+    # 割り当ての読み込みはDBに問い合わせることがあるため、シャーディングしているときだけスレッドを切り替える
+    if not is_enabled():
+        return {None: list(tweet_ids)}
+    return await sync_to_async(group_tweets)(tweet_ids)
+
+
+class IdAllocator:
+    # 連番をSHARD_ID_BLOCK_SIZE個ずつ予約し、プロセスの中で順に払い出す。
+    # idは連番 * BUCKETS + バケットで、JavaScriptの数値で正確に扱える2**53未満に収まる
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._next = self._end = 0
+
+    def _reserve(self, size):
+        sequences = IdSequence.objects.using(PRIMARY)
+        with transaction.atomic(using=PRIMARY):
+            if not sequences.filter(name=self.name).update(next_value=F("next_value") + size):
+                sequences.get_or_create(name=self.name, defaults={"next_value": 1})
+                sequences.filter(name=self.name).update(next_value=F("next_value") + size)
+            end = sequences.get(name=self.name).next_value
+        return end - size, end
+
+    def allocate(self, bucket):
+        with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = self._reserve(settings.SHARD_ID_BLOCK_SIZE)
+            value = self._next
+            self._next += 1
+        return value * BUCKETS + bucket
+
+
+tweet_ids = IdAllocator("tweet")
+like_ids = IdAllocator("like")
+ALLOCATED_MODELS = ((tweet_ids, Tweet), (like_ids, Like))
+
+
+def advance_sequence(name, max_id):
+    # 払い出すidが既存のid（max_id以下）と重ならないよう、連番をmax_idより後ろに進める
+    start = max_id // BUCKETS + 1
+    sequences = IdSequence.objects.using(PRIMARY)
+    with transaction.atomic(using=PRIMARY):
+        sequences.get_or_create(name=name, defaults={"next_value": start})
+        sequences.filter(name=name, next_value__lt=start).update(next_value=start)
+
+
+def legacy_tweets():
+    # defaultにある、idにバケットを持たないツイート（シャーディングを有効にする前に作成したもの）
+    return Tweet.objects.using(PRIMARY).annotate(bucket=Mod("id", BUCKETS)).exclude(bucket=Mod("user_id", BUCKETS))
+
+
+def unreachable_tweet_count():
+    # defaultにあるツイートのうち、idから決まるDBがdefaultでないもの（idにバケットを持たないものと、
+    # 他のシャードに割り当てたバケットのもの）の件数
+    tweets = Tweet.objects.using(PRIMARY).annotate(bucket=Mod("id", BUCKETS))
+    count = legacy_tweets().count()
+    assigned = dict(ShardBucket.objects.using(PRIMARY).values_list("bucket", "database"))
+    placed = tweets.filter(bucket=Mod("user_id", BUCKETS)).values_list("bucket").annotate(count=Count("id"))
+    for bucket, bucket_count in placed:
+        # SQLiteのMODは実数を返すため整数に戻す
+        bucket = int(bucket)
+        if assigned.get(bucket, default_database(bucket)) != PRIMARY:
+            count += bucket_count
+    return count
+
+
+def stale_sequences():
+    # 払い出すidが、defaultにある既存のidと重なりうる連番の名前
+    next_values = dict(IdSequence.objects.using(PRIMARY).values_list("name", "next_value"))
+    stale = []
+    for allocator, model in ALLOCATED_MODELS:
+        max_id = model.objects.using(PRIMARY).aggregate(Max("id"))["id__max"] or 0
+        if next_values.get(allocator.name, 1) * BUCKETS <= max_id:
+            stale.append(allocator.name)
+    return stale
+
+
+def assign_tweet_id(tweet):
+    # 新しいツイートにidを割り当て、保存先のDBを返す。QuerySet.create()はDBを指定して保存するため、呼び出し側で差し替える
+    if not is_enabled() or tweet.pk is not None:
+        return None
+    tweet.pk = tweet_ids.allocate(bucket_for_user(tweet.user_id))
+    return db_for_tweet(tweet.pk, write=True)
+
+
+def new_like_id(tweet_id):
+    return like_ids.allocate(bucket_for_tweet(tweet_id))
+
+
+def assign_like_id(like):
+    if not is_enabled() or like.pk is not None:
+        return None
+    like.pk = new_like_id(like.tweet_id)
+    return db_for_tweet(like.tweet_id, write=True)
+
+
+def select_user(queryset):
+    # シャードにはユーザーのテーブルが無いためJOINせず、投稿者は別のクエリでまとめて取得する
+    if is_enabled():
+        return queryset.prefetch_related("user")
+    return queryset.select_related("user")
+
+
+def fetch_tweets(queryset, tweet_ids):
+    # ツイートを置き場所ごとにまとめて取得し、新しい順に合流させる。シャーディングしていなければ1回のクエリのまま
+    if not is_enabled():
+        return queryset.filter(id__in=tweet_ids)
+    tweets = []
+    for database, ids in group_tweets(tweet_ids).items():
+        tweets += queryset.using(database).filter(id__in=ids)
+    return sorted(tweets, key=lambda tweet: (tweet.created_at, tweet.pk), reverse=True)
+
+
+class ShardRouter:
+    # idの分かるTweetとLike（関連の先を含む）を置き場所のシャードに送る。それ以外はmysite.db_routerに任せる
+    def _db_for_instance(self, model, hints, write):
+        if not is_enabled() or model._meta.label_lower not in SHARDED_MODELS:
+            return None
+        instance = hints.get("instance")
+        if instance is None:
+            return None
+        label = instance._meta.label_lower
+        if label == "tweets.tweet":
+            if instance.pk is not None:
+                return db_for_tweet(instance.pk, write)
+            if instance.user_id is not None:
+                return db_for_user(instance.user_id, write)
+        elif label == "tweets.like":
+            if instance.tweet_id is not None:
+                return db_for_tweet(instance.tweet_id, write)
+        if label == settings.AUTH_USER_MODEL.lower() and model._meta.label_lower == "tweets.tweet":
+            return db_for_user(instance.pk, write)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_instance(model, hints, write=False)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_instance(model, hints, write=True)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # シャードにはTweetとLikeのテーブルだけを作る。データを移行する処理（RunPython）はdefaultでだけ行う
+        if db not in settings.DATABASE_SHARDS:
+            return None
+        return f"{app_label}.{model_name}" in SHARDED_MODELS
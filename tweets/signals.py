@@ -0,0 +1,49 @@
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from accounts.models import User
+from mysite import conditional
+
+from . import fragments, pages, sharding
+from .models import Like, Mention, TimelineEntry, Tweet, TweetHashtag
+from .search import get_backend
+
+
+@receiver(post_save, sender=Tweet)
+def index_tweet(sender, instance, created=False, update_fields=None, **kwargs):
+    # いいね数などの更新では本文が変わらないため索引を作り直さない
+    if update_fields is None or "content" in update_fields:
+        get_backend().index([instance])
+        # 本文はバージョン（fragments.fragment_version）に含めないため、描画済みのHTMLを消す
+        if not created:
+            fragments.invalidate([instance.pk])
+
+
+@receiver(post_delete, sender=Tweet)
+def remove_tweet(sender, instance, **kwargs):
+    get_backend().remove([instance.pk])
+    fragments.invalidate([instance.pk])
+    # タイムラインと索引のテーブルはツイートと別のDB（シャード）にあることがあり、削除を連鎖させないためここで消す
+    for model in (TimelineEntry, TweetHashtag, Mention):
+        model.objects.filter(tweet_id=instance.pk).delete()
+
+
+@receiver(post_save, sender=Tweet)
+@receiver(post_delete, sender=Tweet)
+def invalidate_pages(sender, instance, **kwargs):
+    # 投稿者のプロフィールに新しいツイートをすぐに表示する。idが再利用されても以前のツイートを表示しないようにもする
+    pages.invalidate_tweet(instance)
+    conditional.bump(conditional.tweet_key(instance.pk), conditional.user_key(instance.user_id))
+
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_rows(sender, instance, using, **kwargs):
+    # シャーディングではTweetとLikeがユーザーと別のDBにあり、ユーザーの削除が連鎖しないため、他のすべてのシャードから消す。
+    # ツイートへのいいねはツイートと同じDBにあるため、ツイートの削除で連鎖して消える
+    if not sharding.is_enabled():
+        return
+    for database in sharding.all_databases():
+        if database == using:
+            continue
+        Like.objects.using(database).filter(user_id=instance.pk).delete()
+        Tweet.objects.using(database).filter(user_id=instance.pk).delete()
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import threading
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from mysite import metrics
+
+from .models import StreamEvent
+
+# 接続を終了させるための目印
+CLOSE = object()
+
+
+class Subscription:
+    def __init__(self, hub, topics, loop):
+        self.hub = hub
+        self.topics = frozenset(topics)
+        self.loop = loop
+        self.queue = asyncio.Queue(settings.STREAM_QUEUE_SIZE)
+
+    def put(self, event):
+        # 購読者のイベントループ上で呼ばれる。遅いクライアントのために溜め込まず、古いイベントから捨てる
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class Hub:
+    # トピックごとの購読者の集合。接続ごとにスレッドを持たず、イベントループ上のキューで待たせる
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+
+    def __len__(self):
+        with self.lock:
+            return len({subscription for subscribers in self.subscriptions.values() for subscription in subscribers})
+
+    def subscribe(self, topics):
+        subscription = Subscription(self, topics, asyncio.get_running_loop())
+        with self.lock:
+            for topic in subscription.topics:
+                self.subscriptions[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for topic in subscription.topics:
+                subscribers = self.subscriptions.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscriptions[topic]
+
+    def dispatch(self, topic, event):
+        # どのスレッドからでも呼べる。イベントループごとにまとめて1回だけ起こす
+        with self.lock:
+            subscribers = list(self.subscriptions.get(topic, ()))
+        self._deliver(subscribers, event)
+
+    def close_all(self):
+        with self.lock:
+            subscribers = list({s for subscribers in self.subscriptions.values() for s in subscribers})
+        self._deliver(subscribers, CLOSE)
+
+    def _deliver(self, subscribers, event):
+        by_loop = defaultdict(list)
+        for subscription in subscribers:
+            by_loop[subscription.loop].append(subscription)
+        for loop, subscriptions in by_loop.items():
+            loop.call_soon_threadsafe(_put_all, subscriptions, event)
+
+
+def _put_all(subscriptions, event):
+    for subscription in subscriptions:
+        subscription.put(event)
+
+
+class LocalBackend:
+    # 同じプロセス内の購読者にだけ配信する
+    def __init__(self, hub):
+        self.hub = hub
+
+    def publish(self, topic, event):
+        self.hub.dispatch(topic, event)
+
+    def start(self):
+        pass
+
+
+class DatabaseBackend:
+    # StreamEventテーブルを介して同じDBを使う全ワーカープロセスに配信する（Redisなどのpub/subの代わり）。
+    # 各プロセスでは購読者がいる間だけ1つのタスクがテーブルをポーリングする
+    def __init__(self, hub):
+        self.hub = hub
+        self.tasks = {}
+
+    def publish(self, topic, event):
+        stream_event = StreamEvent.objects.create(topic=topic, payload=event)
+        if stream_event.pk % 100 == 0:
+            StreamEvent.objects.filter(pk__lte=stream_event.pk - settings.STREAM_EVENT_RETENTION).delete()
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        task = self.tasks.get(loop)
+        if task is None or task.done():
+            self.tasks[loop] = loop.create_task(self.poll())
+
+    async def poll(self):
+        last_event = await StreamEvent.objects.order_by("-pk").afirst()
+        last_id = last_event.pk if last_event else 0
+        # 購読者がいなくなったら終了し、次の購読時に再開する
+        while True:
+            await asyncio.sleep(settings.STREAM_POLL_INTERVAL)
+            if not len(self.hub):
+                break
+            last_id = await self.poll_once(last_id)
+
+    async def poll_once(self, last_id):
+        async for stream_event in StreamEvent.objects.filter(pk__gt=last_id).order_by("pk")[:1000]:
+            self.hub.dispatch(stream_event.topic, stream_event.payload)
+            last_id = stream_event.pk
+        return last_id
+
+
+hub = Hub()
+metrics.registry.gauge("stream_subscriptions", "Open live stream connections.", lambda: len(hub))
+_backends = {}
+
+
+def get_backend():
+    backend = _backends.get(settings.STREAM_BACKEND)
+    if backend is None:
+        backend = _backends[settings.STREAM_BACKEND] = import_string(settings.STREAM_BACKEND)(hub)
+    return backend
+
+
+def publish(topic, event):
+    get_backend().publish(topic, event)
+
+
+apublish = sync_to_async(publish)
+
+
+def subscribe(topics):
+    get_backend().start()
+    return hub.subscribe(topics)
+
+
+def author_topic(user_id):
+    return f"author:{user_id}"
+
+
+def tweet_topic(tweet_id):
+    return f"tweet:{tweet_id}"
+
+
+def publish_tweet(tweet):
+    publish(author_topic(tweet.user_id), {"type": "tweet", "id": tweet.pk, "user_id": tweet.user_id})
+
+
+async def apublish_like_count(tweet_id, like_count):
+    await apublish(tweet_topic(tweet_id), {"type": "like", "id": tweet_id, "like_count": like_count})
+
+
+async def stream_events(topics):
+    # SSEの形式でイベントを送り続ける。何も無い間はコメント行を送って接続を保つ
+    subscription = subscribe(topics)
+    try:
+        yield f"retry: {settings.STREAM_RETRY_MS}\n\n"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.STREAM_MAX_DURATION
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                event = await subscription.get(min(settings.STREAM_KEEPALIVE_INTERVAL, remaining))
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if event is CLOSE:
+                break
+            yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        subscription.close()
@@ -0,0 +1,10 @@
+from django import template
+
+from tweets import fragments
+
+register = template.Library()
+
+
+@register.simple_tag
+def render_tweets(tweets, template_name="tweets/fragments/tweet.html"):
+    return fragments.render_tweets(tweets, template_name)
@@ -1,8 +1,26 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from .models import Like, Tweet
+from accounts import follows
+from mysite import conditional
+
+from . import checks, entities, fragments, pages, search, sharding, streaming, timeline
+from .likes import like_tweet, unlike_tweet
+from .models import Hashtag, Like, Mention, StreamEvent, TimelineEntry, Tweet, TweetHashtag
 
 User = get_user_model()
 
@@ -19,11 +37,14 @@ class AbstractTestCase(TestCase):
         # ツイートを作成
         self.tweet1 = Tweet.objects.create(user=self.user, content="Test tweet 1")
         self.tweet2 = Tweet.objects.create(user=self.user, content="Test tweet 2")
+        timeline.fan_out_tweet(self.tweet1)
+        timeline.fan_out_tweet(self.tweet2)
         if self.is_need_kwargs:
             self.url = reverse(self.url_name, kwargs={"pk": self.tweet1.pk})
         else:
             self.url = reverse(self.url_name)
         Like.objects.create(user=self.user, tweet=self.tweet1)
+        Tweet.objects.filter(pk=self.tweet1.pk).update(like_count=1)
 
 
 class TestHomeView(AbstractTestCase):
@@ -39,6 +60,167 @@ class TestHomeView(AbstractTestCase):
         self.assertQuerysetEqual(context_tweets, db_tweets, ordered=False)
 
 
+class TestHomeFragmentView(AbstractTestCase):
+    url_name = "tweets:home_fragment"
+
+    @override_settings(TIMELINE_PAGE_SIZE=1)
+    def test_success_get(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        # ページ全体ではなく、ツイートの<li>だけを返す
+        self.assertNotContains(response, "<html")
+        self.assertContains(response, 'class="tweet-container"', count=1)
+        next_url = response["Link"].removeprefix("<").removesuffix('>; rel="next"')
+        response = self.client.get(next_url)
+        self.assertContains(response, 'class="tweet-container"', count=1)
+        self.assertFalse(response.has_header("Link"))
+
+    def test_success_get_json(self):
+        response = self.client.get(self.url, {"format": "json"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(tweet["id"], tweet["user"], tweet["liked"]) for tweet in response.json()["tweets"]],
+            [(self.tweet2.pk, "tester", False), (self.tweet1.pk, "tester", True)],
+        )
+        self.assertIsNone(response.json()["next"])
+
+
+class TestTweetFragments(AbstractTestCase):
+    url_name = "tweets:home"
+
+    def setUp(self):
+        super().setUp()
+        fragments.get_cache().clear()
+
+    def render(self, tweet, liked):
+        tweet.liked = liked
+        return fragments.render_tweets([tweet], "tweets/fragments/tweet.html")
+
+    def test_cached(self):
+        with mock.patch("tweets.fragments.render_to_string", wraps=fragments.render_to_string) as render_to_string:
+            first = self.client.get(self.url)
+            second = self.client.get(self.url)
+        # 2件のツイートは1回目だけ描画する
+        self.assertEqual(render_to_string.call_count, 2)
+        for response in (first, second):
+            self.assertContains(response, 'class="tweet-container"', count=2)
+            self.assertContains(response, 'class="heart  is-active "', count=1)
+
+    def test_liked_overlay(self):
+        tweet = Tweet.objects.select_related("user").get(pk=self.tweet1.pk)
+        with mock.patch("tweets.fragments.render_to_string", wraps=fragments.render_to_string) as render_to_string:
+            liked = self.render(tweet, True)
+            not_liked = self.render(tweet, False)
+        self.assertEqual(render_to_string.call_count, 1)
+        self.assertIn('class="heart  is-active "', liked)
+        self.assertNotIn("is-active", not_liked)
+        self.assertNotIn(fragments.LIKED_PLACEHOLDER, liked + not_liked)
+
+    def test_placeholder_in_content(self):
+        tweet = Tweet.objects.create(user=self.user, content="<!--liked--><b>")
+        html = self.render(tweet, True)
+        self.assertIn("&lt;!--liked--&gt;&lt;b&gt;", html)
+        self.assertEqual(html.count("is-active"), 1)
+
+    def test_like_count_change(self):
+        self.client.get(self.url)
+        self.client.post(reverse("tweets:like", kwargs={"pk": self.tweet2.pk}))
+        response = self.client.get(self.url)
+        self.assertContains(response, f'<span id="like-number-{self.tweet2.pk}">1</span>')
+
+    def test_delete(self):
+        self.client.get(self.url)
+        key = fragments.fragment_key("tweets/fragments/tweet.html", self.tweet2.pk)
+        self.assertIsNotNone(fragments.get_cache().get(key))
+        self.tweet2.delete()
+        self.assertIsNone(fragments.get_cache().get(key))
+
+    def test_content_change(self):
+        self.client.get(self.url)
+        self.tweet2.content = "edited"
+        self.tweet2.save()
+        self.assertContains(self.client.get(self.url), "edited")
+
+
+class TestHomeTimeline(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.author = User.objects.create_user(username="author", password="testpassword")
+        self.client.login(username="tester", password="testpassword")
+        self.url = reverse("tweets:home")
+
+    def follow(self, username):
+        self.client.post(reverse("accounts:follow", kwargs={"username": username}))
+
+    def test_fan_out_on_create(self):
+        self.follow("author")
+        self.client.login(username="author", password="testpassword")
+        self.client.post(reverse("tweets:create"), {"content": "fan out"})
+        tweet = Tweet.objects.get(content="fan out")
+        # 投稿者とフォロワーのタイムラインに書き込まれている
+        self.assertTrue(TimelineEntry.objects.filter(user=self.user, tweet=tweet).exists())
+        self.assertTrue(TimelineEntry.objects.filter(user=self.author, tweet=tweet).exists())
+
+    def test_follow_and_unfollow(self):
+        tweet = Tweet.objects.create(user=self.author, content="before follow")
+        self.follow("author")
+        # フォロー時に過去のツイートが取り込まれている
+        response = self.client.get(self.url)
+        self.assertIn(tweet, response.context["tweets"])
+        self.client.post(reverse("accounts:unfollow", kwargs={"username": "author"}))
+        # フォロー解除でタイムラインから取り除かれている
+        response = self.client.get(self.url)
+        self.assertNotIn(tweet, response.context["tweets"])
+
+    def test_not_followed_tweet(self):
+        tweet = Tweet.objects.create(user=self.author, content="not followed")
+        timeline.fan_out_tweet(tweet)
+        response = self.client.get(self.url)
+        self.assertNotIn(tweet, response.context["tweets"])
+
+    @override_settings(TIMELINE_FANOUT_MAX_FOLLOWERS=0)
+    def test_pull_author(self):
+        follows.follow(self.user, self.author)
+        tweet = Tweet.objects.create(user=self.author, content="pulled")
+        timeline.fan_out_tweet(tweet)
+        # フォロワーのタイムラインには書き込まれず、読み込み時に取得される
+        self.assertFalse(TimelineEntry.objects.filter(user=self.user).exists())
+        response = self.client.get(self.url)
+        self.assertIn(tweet, response.context["tweets"])
+
+    @override_settings(TIMELINE_FANOUT_MAX_FOLLOWERS=0, TIMELINE_PAGE_SIZE=2)
+    def test_cursor_pagination(self):
+        follows.follow(self.user, self.author)
+        tweets = []
+        for i in range(5):
+            tweet = Tweet.objects.create(user=self.user if i % 2 else self.author, content=f"tweet {i}")
+            timeline.fan_out_tweet(tweet)
+            tweets.append(tweet)
+        # 自分のツイートと読み込み時に取得するツイートが新しい順にページをまたいで並んでいる
+        pages = []
+        cursor = None
+        while True:
+            response = self.client.get(self.url, {"cursor": cursor} if cursor else {})
+            pages.append(list(response.context["tweets"]))
+            cursor = response.context["page_obj"].next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(pages, [tweets[4:2:-1], tweets[2:0:-1], tweets[:1]])
+
+    @override_settings(TIMELINE_MAX_LENGTH=2)
+    def test_trim_timeline(self):
+        tweets = [Tweet.objects.create(user=self.user, content=f"tweet {i}") for i in range(4)]
+        for tweet in tweets:
+            timeline.fan_out_tweet(tweet)
+        timeline.trim_timeline(self.user.pk)
+        # 新しいものから上限件数だけ残っている
+        self.assertQuerysetEqual(
+            TimelineEntry.objects.filter(user=self.user).values_list("tweet_id", flat=True),
+            [tweets[3].pk, tweets[2].pk],
+            ordered=False,
+        )
+
+
 class TestTweetCreateView(AbstractTestCase):
     url_name = "tweets:create"
 
@@ -98,6 +280,165 @@ class TestTweetDetailView(AbstractTestCase):
         # context内に含まれるツイートがDBと同一である
         self.assertTrue(Tweet.objects.filter(content=self.tweet1.content).exists())
 
+    def test_cached_with_liked_per_viewer(self):
+        self.assertTrue(self.client.get(self.url).context["tweet"].liked)
+        # 2回目はツイートをキャッシュから返し、いいねの状態だけを閲覧者ごとに問い合わせる
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url)
+        self.assertEqual(response.context["tweet"], self.tweet1)
+        self.assertFalse(any('FROM "tweets_tweet"' in query["sql"] for query in context))
+        self.client.login(username="tester2", password="testpassword2")
+        self.assertFalse(self.client.get(self.url).context["tweet"].liked)
+
+    def test_deleted_tweet(self):
+        self.client.get(self.url)
+        self.tweet1.delete()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_conditional_get(self):
+        etag = self.client.get(self.url)["ETag"]
+        # 変化がなければ、ツイートといいねの状態を問い合わせずに304を返す
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse(any("tweets_" in query["sql"] for query in context))
+        # 閲覧者のいいねの状態が変わると検証子も変わる
+        unlike_tweet(self.user, self.tweet1.pk)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context["tweet"].liked)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_author_renamed(self):
+        tweet = Tweet.objects.create(user=self.user2, content="author tweet")
+        url = reverse(self.url_name, kwargs={"pk": tweet.pk})
+        etag = self.client.get(url)["ETag"]
+        # 投稿者のユーザー名が変わると、キャッシュした詳細を作り直し、検証子も変わる
+        self.user2.username = "renamed"
+        self.user2.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Username: renamed")
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_if_modified_since(self):
+        # 1秒以上前に変わった版数からLast-Modifiedを返す
+        version = time.time_ns() - 10**10
+        with mock.patch("time.time_ns", return_value=version):
+            conditional.bump(conditional.tweet_key(self.tweet1.pk), conditional.user_key(self.user.pk))
+        pages.stampede.invalidate(pages.detail_key(self.tweet1.pk))
+        last_modified = self.client.get(self.url)["Last-Modified"]
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        like_tweet(self.user2, self.tweet1.pk)
+        unlike_tweet(self.user, self.tweet1.pk)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Last-Modified", response)
+
+
+class TestTweetSearchView(AbstractTestCase):
+    url_name = "tweets:search"
+
+    def setUp(self):
+        super().setUp()
+        self.tokyo = Tweet.objects.create(user=self.user2, content="東京都庁に行きました")
+        self.kyoto = Tweet.objects.create(user=self.user2, content="京都で Django の勉強会")
+
+    def search(self, query, **params):
+        response = self.client.get(self.url, {"q": query, **params})
+        return list(response.context["tweets"])
+
+    def test_tokenize(self):
+        # 2文字ずつに区切り、並びの最後の1文字を加える。全角英数字は半角の小文字にそろえる
+        self.assertEqual(search.tokenize("東京都庁、ＡＢ"), "東京 京都 都庁 庁 ab b")
+
+    def test_success_get(self):
+        response = self.client.get(self.url)
+        # Response Status Code: 200
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.search("京都"), [self.tokyo, self.kyoto])
+        self.assertEqual(self.search("都庁"), [self.tokyo])
+        self.assertEqual(self.search("庁"), [self.tokyo])
+        self.assertEqual(self.search("DJANGO"), [self.kyoto])
+        # 空白で区切った語はすべて含むものだけが一致する
+        self.assertEqual(self.search("京都 勉強"), [self.kyoto])
+        self.assertEqual(self.search("東京 大阪"), [])
+
+    def test_index_is_updated(self):
+        self.tokyo.content = "大阪城に行きました"
+        self.tokyo.save()
+        self.kyoto.delete()
+        # 本文の更新と削除が索引に反映されている
+        self.assertEqual(self.search("京都"), [])
+        self.assertEqual(self.search("大阪"), [self.tokyo])
+
+    @override_settings(SEARCH_PAGE_SIZE=1)
+    def test_pagination(self):
+        self.assertEqual(self.search("京都"), [self.tokyo])
+        self.assertEqual(self.search("京都", page=2), [self.kyoto])
+
+    def test_rebuild_search_index_command(self):
+        Tweet.objects.bulk_create([Tweet(user=self.user, content="一括で追加した京都のツイート")])
+        call_command("rebuild_search_index", stdout=StringIO())
+        # シグナルを経由せずに追加したツイートも索引に登録されている
+        self.assertEqual(len(self.search("京都")), 3)
+
+
+class TestHashtagAndMention(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.other_user = User.objects.create_user(username="other.user", password="testpassword")
+        self.client.login(username="tester", password="testpassword")
+
+    def create_tweet(self, content):
+        self.client.post(reverse("tweets:create"), {"content": content})
+        return Tweet.objects.get(content=content)
+
+    def test_extract(self):
+        text = "#Django と＃ＰＹＴＨＯＮ #勉強会 の話 a#b &#35; @other.user. mail@example.com"
+        # 全角の"＃"やタグ名は正規化され、単語の途中やメールアドレスは対象にならない
+        self.assertEqual(entities.extract_hashtags(text), {"django", "python", "勉強会"})
+        self.assertEqual(entities.extract_mentions(text), {"other.user"})
+
+    def test_index_on_create(self):
+        tweet = self.create_tweet("#Django の勉強会 @other.user @not_exist_user")
+        # 投稿時にハッシュタグとメンションの索引が作られ、存在しないユーザーへのメンションは無視される
+        self.assertQuerysetEqual(
+            TweetHashtag.objects.filter(tweet=tweet).values_list("hashtag__name", flat=True), ["django"]
+        )
+        self.assertQuerysetEqual(
+            Mention.objects.filter(tweet=tweet).values_list("user", flat=True), [self.other_user.pk]
+        )
+
+    def test_hashtag_view(self):
+        tweets = [self.create_tweet(f"tweet {i} #django") for i in range(3)]
+        self.create_tweet("#python")
+        response = self.client.get(reverse("tweets:hashtag", kwargs={"name": "DJANGO"}))
+        # Response Status Code: 200
+        self.assertEqual(response.status_code, 200)
+        # ハッシュタグを含むツイートだけが新しい順に並んでいる
+        self.assertEqual(list(response.context["tweets"]), tweets[::-1])
+        response = self.client.get(reverse("tweets:hashtag", kwargs={"name": "not_exist"}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_mention_list_view(self):
+        self.client.login(username="other.user", password="testpassword")
+        tweet = self.create_tweet("@tester こんにちは")
+        self.create_tweet("@other.user 自分宛て")
+        self.client.login(username="tester", password="testpassword")
+        response = self.client.get(reverse("tweets:mentions"))
+        # 自分宛てのツイートだけが含まれている
+        self.assertEqual(list(response.context["tweets"]), [tweet])
+
+    def test_reindex_entities_command(self):
+        Tweet.objects.bulk_create([Tweet(user=self.user, content=f"#tag{i % 2} @other.user") for i in range(5)])
+        call_command("reindex_entities", "--batch-size", "2", stdout=StringIO())
+        call_command("reindex_entities", stdout=StringIO())
+        # 一定件数ずつ処理され、繰り返し実行しても重複しない
+        self.assertEqual(TweetHashtag.objects.count(), 5)
+        self.assertEqual(Mention.objects.filter(user=self.other_user).count(), 5)
+        self.assertEqual(Hashtag.objects.count(), 2)
+
 
 class TestTweetDeleteView(AbstractTestCase):
     is_need_kwargs = True
@@ -140,6 +481,14 @@ class TestLikeView(AbstractTestCase):
         # DBにデータが追加されている
         self.assertTrue(Like.objects.filter(user=self.user, tweet=self.tweet1).exists())
 
+    def test_success_post_increments_like_count(self):
+        self.client.login(username="tester2", password="testpassword2")
+        response = self.client.post(self.url)
+        # いいね数のカラムが更新され、その値が返されている
+        self.tweet1.refresh_from_db()
+        self.assertEqual(self.tweet1.like_count, 2)
+        self.assertEqual(response.json(), {"like_number": 2})
+
     def test_failure_post_with_not_exist_tweet(self):
         queryset_before_like = Like.objects.all()
         response = self.client.post(reverse(self.url_name, kwargs={"pk": self.not_exist_tweet_pk}))
@@ -158,6 +507,34 @@ class TestLikeView(AbstractTestCase):
         self.assertQuerySetEqual(Like.objects.all(), queryset_before_like)
 
 
+class TestAsyncLikeView(AbstractTestCase):
+    is_need_kwargs = True
+    url_name = "tweets:like"
+
+    def setUp(self):
+        super().setUp()
+        self.async_client.force_login(self.user2)
+
+    async def test_success_post(self):
+        response = await self.async_client.post(self.url)
+        # ASGI経由でもいいね数が更新され、その値が返されている
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"like_number": 2})
+        self.assertTrue(await Like.objects.filter(user=self.user2, tweet=self.tweet1).aexists())
+        response = await self.async_client.post(reverse("tweets:unlike", kwargs={"pk": self.tweet1.pk}))
+        self.assertEqual(response.json(), {"like_number": 1})
+
+    async def test_success_get_like_status(self):
+        response = await self.async_client.get(reverse("tweets:like_status"), {"ids": str(self.tweet1.pk)})
+        self.assertEqual(response.json(), {"tweets": {str(self.tweet1.pk): {"like_count": 1, "liked": False}}})
+
+    async def test_failure_post_without_login(self):
+        response = await AsyncClient().post(self.url)
+        # ログインしていなければログイン画面にリダイレクトされ、いいねは追加されない
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(await Like.objects.filter(tweet=self.tweet1).acount(), 1)
+
+
 class TestUnLikeView(AbstractTestCase):
     is_need_kwargs = True
     url_name = "tweets:unlike"
@@ -168,6 +545,10 @@ class TestUnLikeView(AbstractTestCase):
         self.assertEqual(response.status_code, 200)
         # DBにデータが削除されている
         self.assertFalse(Like.objects.filter(user=self.user, tweet=self.tweet1).exists())
+        # いいね数のカラムが更新され、その値が返されている
+        self.tweet1.refresh_from_db()
+        self.assertEqual(self.tweet1.like_count, 0)
+        self.assertEqual(response.json(), {"like_number": 0})
 
     def test_failure_post_with_not_exist_tweet(self):
         queryset_before_delete = Like.objects.all()
@@ -182,3 +563,450 @@ class TestUnLikeView(AbstractTestCase):
         response = self.client.post(self.url)
         # Response Status Code: 200
         self.assertEqual(response.status_code, 200)
+
+
+class TestLikeStatusView(AbstractTestCase):
+    url_name = "tweets:like_status"
+
+    def test_success_get(self):
+        response = self.client.get(self.url, {"ids": f"{self.tweet1.pk},{self.tweet2.pk},{self.not_exist_tweet_pk}"})
+        # Response Status Code: 200
+        self.assertEqual(response.status_code, 200)
+        # 存在するツイートのいいね数と閲覧者のいいね状態が返されている
+        self.assertEqual(
+            response.json(),
+            {
+                "tweets": {
+                    str(self.tweet1.pk): {"like_count": 1, "liked": True},
+                    str(self.tweet2.pk): {"like_count": 0, "liked": False},
+                }
+            },
+        )
+
+    def test_success_get_with_etag(self):
+        params = {"ids": f"{self.tweet1.pk},{self.tweet2.pk}"}
+        etag = self.client.get(self.url, params)["ETag"]
+        # 変化がなければ304が返される
+        response = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # いいね数が変わるとETagも変わる
+        self.client.post(reverse("tweets:like", kwargs={"pk": self.tweet2.pk}))
+        response = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_failure_get_with_invalid_ids(self):
+        response = self.client.get(self.url, {"ids": "1,abc"})
+        # Response Status Code: 400
+        self.assertEqual(response.status_code, 400)
+
+    def test_failure_get_with_too_many_ids(self):
+        response = self.client.get(self.url, {"ids": ",".join(str(i) for i in range(1, 102))})
+        # Response Status Code: 400
+        self.assertEqual(response.status_code, 400)
+
+
+class TestLikeBatchView(AbstractTestCase):
+    url_name = "tweets:like_batch"
+
+    def post_operations(self, operations):
+        return self.client.post(self.url, {"operations": operations}, content_type="application/json")
+
+    def test_success_post(self):
+        response = self.post_operations(
+            [
+                {"tweet_id": self.tweet1.pk, "op": "unlike"},
+                {"tweet_id": self.tweet2.pk, "op": "unlike"},
+                # 同じツイートへの操作は最後のものが適用される
+                {"tweet_id": self.tweet2.pk, "op": "like"},
+                {"tweet_id": self.not_exist_tweet_pk, "op": "like"},
+            ]
+        )
+        # Response Status Code: 200
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {
+                "tweets": {
+                    str(self.tweet1.pk): {"like_count": 0, "liked": False},
+                    str(self.tweet2.pk): {"like_count": 1, "liked": True},
+                },
+                "missing": [self.not_exist_tweet_pk],
+            },
+        )
+        self.assertFalse(Like.objects.filter(user=self.user, tweet=self.tweet1).exists())
+        self.assertTrue(Like.objects.filter(user=self.user, tweet=self.tweet2).exists())
+
+    def test_success_post_is_idempotent(self):
+        operations = [{"tweet_id": self.tweet1.pk, "op": "like"}, {"tweet_id": self.tweet2.pk, "op": "like"}]
+        self.post_operations(operations)
+        response = self.post_operations(operations)
+        # 同じ操作を繰り返してもいいね数は増えない
+        self.assertEqual(response.json()["tweets"][str(self.tweet2.pk)], {"like_count": 1, "liked": True})
+        self.assertEqual(Like.objects.filter(user=self.user).count(), 2)
+
+    def test_counts_only_changed_likes(self):
+        # いいね数は数え直さず、実際に追加・削除したいいねの分だけ増減する（他のリクエストの増減を上書きしない）
+        Tweet.objects.filter(pk=self.tweet1.pk).update(like_count=5)
+        Tweet.objects.filter(pk=self.tweet2.pk).update(like_count=5)
+        operations = [{"tweet_id": self.tweet1.pk, "op": "unlike"}, {"tweet_id": self.tweet2.pk, "op": "like"}]
+        for can_return in (True, False):
+            with self.subTest(can_return=can_return), mock.patch(
+                "tweets.likes._can_return_from_update", return_value=can_return
+            ):
+                tweets = self.post_operations(operations).json()["tweets"]
+                self.assertEqual(tweets[str(self.tweet1.pk)], {"like_count": 4, "liked": False})
+                self.assertEqual(tweets[str(self.tweet2.pk)], {"like_count": 6, "liked": True})
+                # 変化のない操作ではいいね数は変わらない
+                self.assertEqual(self.post_operations(operations).json()["tweets"], tweets)
+                Like.objects.filter(user=self.user, tweet=self.tweet2).delete()
+                Like.objects.create(user=self.user, tweet=self.tweet1)
+                Tweet.objects.filter(pk__in=[self.tweet1.pk, self.tweet2.pk]).update(like_count=5)
+
+    def test_query_count_does_not_depend_on_batch_size(self):
+        tweets = Tweet.objects.bulk_create([Tweet(user=self.user, content=f"tweet {i}") for i in range(50)])
+        with CaptureQueriesContext(connection) as small:
+            self.post_operations([{"tweet_id": tweets[0].pk, "op": "like"}])
+        with CaptureQueriesContext(connection) as large:
+            self.post_operations([{"tweet_id": tweet.pk, "op": "like"} for tweet in tweets])
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(Tweet.objects.filter(pk__in=[tweet.pk for tweet in tweets], like_count=1).count(), 50)
+
+    def test_failure_post_with_invalid_operations(self):
+        for operations in (
+            None,
+            [],
+            [{"tweet_id": "abc", "op": "like"}],
+            [{"tweet_id": self.tweet1.pk, "op": "star"}],
+        ):
+            with self.subTest(operations=operations):
+                response = self.post_operations(operations)
+                # Response Status Code: 400
+                self.assertEqual(response.status_code, 400)
+
+    def test_failure_post_with_too_many_operations(self):
+        response = self.post_operations([{"tweet_id": i, "op": "like"} for i in range(1, 502)])
+        # Response Status Code: 400
+        self.assertEqual(response.status_code, 400)
+
+
+class TestTimelineStream(AbstractTestCase):
+    url_name = "tweets:stream"
+
+    def setUp(self):
+        super().setUp()
+        self.async_client.force_login(self.user2)
+        follows.follow(self.user2, self.user)
+
+    async def read_event(self, content):
+        return (await asyncio.wait_for(anext(content), 2)).decode()
+
+    async def close_stream(self, content):
+        streaming.hub.close_all()
+        async for _ in content:
+            pass
+        self.assertEqual(len(streaming.hub), 0)
+
+    async def test_hub_dispatch(self):
+        subscription = streaming.subscribe(["author:1", "tweet:1"])
+        streaming.hub.dispatch("author:2", {"type": "tweet", "id": 1})
+        streaming.hub.dispatch("tweet:1", {"type": "like", "id": 1})
+        # 購読しているトピックのイベントだけが届く
+        self.assertEqual(await subscription.get(1), {"type": "like", "id": 1})
+        self.assertTrue(subscription.queue.empty())
+        subscription.close()
+        self.assertEqual(len(streaming.hub), 0)
+
+    @override_settings(STREAM_QUEUE_SIZE=2)
+    async def test_hub_drops_oldest_event(self):
+        subscription = streaming.subscribe(["tweet:1"])
+        for i in range(3):
+            subscription.put({"type": "like", "like_count": i})
+        # 溢れた分は古いものから捨てられる
+        self.assertEqual((await subscription.get(1))["like_count"], 1)
+        subscription.close()
+
+    async def test_success_get(self):
+        response = await self.async_client.get(self.url, {"tweets": str(self.tweet1.pk)})
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        content = aiter(response.streaming_content)
+        self.assertTrue((await self.read_event(content)).startswith("retry:"))
+        # 表示中のツイートのいいね数の変化が届く
+        await self.async_client.post(reverse("tweets:like", kwargs={"pk": self.tweet1.pk}))
+        self.assertEqual(
+            await self.read_event(content),
+            f'event: like\ndata: {{"type": "like", "id": {self.tweet1.pk}, "like_count": 2}}\n\n',
+        )
+        # フォロー中のユーザーの新しいツイートが届く
+        tweet = await Tweet.objects.acreate(user=self.user, content="streamed")
+        await sync_to_async(streaming.publish_tweet)(tweet)
+        self.assertIn(f'"id": {tweet.pk}', await self.read_event(content))
+        await self.close_stream(content)
+
+    @override_settings(STREAM_BACKEND="tweets.streaming.DatabaseBackend", STREAM_POLL_INTERVAL=0.01)
+    async def test_success_get_with_database_backend(self):
+        response = await self.async_client.get(self.url)
+        content = aiter(response.streaming_content)
+        await self.read_event(content)
+        # 他のワーカープロセスが書き込んだイベントもポーリングで届く
+        await sync_to_async(StreamEvent.objects.create)(
+            topic=streaming.author_topic(self.user.pk), payload={"type": "tweet", "id": self.tweet2.pk}
+        )
+        self.assertIn(f'"id": {self.tweet2.pk}', await self.read_event(content))
+        await self.close_stream(content)
+        # 購読者がいなくなるとポーリングも止まる
+        await asyncio.sleep(0.05)
+        self.assertTrue(all(task.done() for task in streaming.get_backend().tasks.values()))
+
+    def test_no_content_under_wsgi(self):
+        response = self.client.get(self.url)
+        # Response Status Code: 204
+        self.assertEqual(response.status_code, 204)
+
+
+class TestLikeConcurrency(TransactionTestCase):
+    def setUp(self):
+        author = User.objects.create(username="author")
+        self.tweet = Tweet.objects.create(user=author, content="popular tweet")
+        self.users = User.objects.bulk_create([User(username=f"user{i}") for i in range(300)])
+
+    def run_concurrently(self, func, users):
+        def target(user):
+            try:
+                return func(user, self.tweet.pk)
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            return list(executor.map(target, users))
+
+    def test_concurrent_likes(self):
+        # 全員が2回ずつ同時にいいねしても、いいねは1人1件で件数が正確である
+        results = self.run_concurrently(like_tweet, self.users * 2)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.like_count, 300)
+        self.assertEqual(Like.objects.filter(tweet=self.tweet).count(), 300)
+        self.assertEqual(max(results), 300)
+
+    def test_concurrent_likes_and_unlikes(self):
+        self.run_concurrently(like_tweet, self.users)
+        # 半数のいいね取り消しと残り半数の重複いいねを同時に行う
+        results = self.run_concurrently(
+            lambda user, tweet_id: (unlike_tweet if user.pk % 2 else like_tweet)(user, tweet_id), self.users
+        )
+        self.tweet.refresh_from_db()
+        expected = Like.objects.filter(tweet=self.tweet).count()
+        self.assertEqual(expected, len([user for user in self.users if user.pk % 2 == 0]))
+        self.assertEqual(self.tweet.like_count, expected)
+        self.assertEqual(min(results), expected)
+
+
+class TestHotPageStampede(TransactionTestCase):
+    def setUp(self):
+        pages.stampede.get_cache().clear()
+        author = User.objects.create(username="celebrity")
+        self.tweet = Tweet.objects.create(user=author, content="popular tweet")
+
+    def test_concurrent_misses_compute_once(self):
+        # 同時にキャッシュに無いツイートを開いても、DBに問い合わせるのは1回だけで、全員が同じツイートを受け取る
+        select_user = sharding.select_user
+        barrier = threading.Barrier(20)
+        computed = []
+
+        def slow_select_user(queryset):
+            computed.append(queryset)
+            time.sleep(0.2)
+            return select_user(queryset)
+
+        def target(_):
+            barrier.wait()
+            try:
+                return pages.get_tweet(self.tweet.pk)
+            finally:
+                connection.close()
+
+        with mock.patch.object(sharding, "select_user", slow_select_user):
+            with ThreadPoolExecutor(max_workers=20) as executor:
+                tweets = [tweet for _, tweet in executor.map(target, range(20))]
+        self.assertEqual(len(computed), 1)
+        self.assertEqual(tweets, [self.tweet] * 20)
+        # 閲覧者ごとにいいねの状態を重ねるため、別々のオブジェクトを返す
+        self.assertEqual(len({id(tweet) for tweet in tweets}), 20)
+
+
+class TestReconcileLikeCountsCommand(AbstractTestCase):
+    url_name = "tweets:home"
+
+    def test_reconcile(self):
+        Tweet.objects.filter(pk=self.tweet1.pk).update(like_count=5)
+        Tweet.objects.filter(pk=self.tweet2.pk).update(like_count=3)
+        call_command("reconcile_like_counts", stdout=StringIO())
+        # 実際のLikeの件数に修正されている
+        self.assertEqual(Tweet.objects.get(pk=self.tweet1.pk).like_count, 1)
+        self.assertEqual(Tweet.objects.get(pk=self.tweet2.pk).like_count, 0)
+
+
+class TestSeedDataCommand(TestCase):
+    def test_seed(self):
+        call_command("seed_data", "--users=20", "--tweets=100", "--likes=200", "--batch-size=30", stdout=StringIO())
+        self.assertEqual(User.objects.count(), 20)
+        self.assertEqual(Tweet.objects.count(), 100)
+        # 非正規化したカラムとタイムラインが生成したデータと一致している
+        call_command("reconcile_like_counts", "--dry-run", stdout=(output := StringIO()))
+        self.assertIn("ずれが0件", output.getvalue())
+        call_command("reconcile_follow_counts", "--dry-run", stdout=(output := StringIO()))
+        self.assertIn("ずれが0件", output.getvalue())
+        self.assertTrue(TimelineEntry.objects.exists())
+        # 作成日時はツイートの順に散らばっている
+        created_ats = list(Tweet.objects.order_by("id").values_list("created_at", flat=True))
+        self.assertEqual(created_ats, sorted(created_ats))
+        self.assertGreater(created_ats[-1] - created_ats[0], timedelta(days=1))
+
+
+# クエリ数の上限はシャーディングしない構成のもの。シャードごとのクエリが加わるため、ここでは確認しない
+@override_settings(TWEET_SHARDS=["default", "shard1", "shard2"], QUERY_BUDGET_STRICT=False)
+class TestSharding(TestCase):
+    databases = {"default", "shard1", "shard2"}
+
+    def setUp(self):
+        # 連続したidのユーザーは別々のシャードに割り当てられる
+        self.user = User.objects.create_user(username="tester", password="testpassword")
+        self.author1 = User.objects.create_user(username="author1", password="testpassword")
+        self.author2 = User.objects.create_user(username="author2", password="testpassword")
+        self.client.login(username="tester", password="testpassword")
+
+    def create_tweet(self, user, content):
+        tweet = Tweet.objects.create(user=user, content=content)
+        timeline.fan_out_tweet(tweet)
+        return tweet
+
+    def databases_with(self, model, **filters):
+        return [database for database in sorted(self.databases) if model.objects.using(database).filter(**filters)]
+
+    def test_tweet_is_placed_on_author_shard(self):
+        self.client.post(reverse("tweets:create"), {"content": "sharded"})
+        tweet = Tweet.objects.using(sharding.db_for_user(self.user.pk)).get(content="sharded")
+        # idがバケットを表し、投稿者のシャードにだけ保存されている
+        self.assertEqual(sharding.bucket_for_tweet(tweet.pk), sharding.bucket_for_user(self.user.pk))
+        self.assertEqual(self.databases_with(Tweet, pk=tweet.pk), [sharding.db_for_user(self.user.pk)])
+        self.assertTrue(TimelineEntry.objects.filter(user=self.user, tweet_id=tweet.pk).exists())
+
+    def test_ids_are_unique_across_shards(self):
+        tweets = [self.create_tweet(user, "tweet") for user in (self.user, self.author1, self.author2) * 3]
+        self.assertEqual(len({tweet.pk for tweet in tweets}), len(tweets))
+        self.assertEqual(len({tweet._state.db for tweet in tweets}), 3)
+        # JavaScriptの数値で正確に扱える範囲に収まっている
+        self.assertLess(max(tweet.pk for tweet in tweets), 2**53)
+
+    def test_home_merges_shards_in_order(self):
+        follows.follow(self.user, self.author1)
+        follows.follow(self.user, self.author2)
+        tweets = [self.create_tweet(user, "tweet") for user in (self.author1, self.author2, self.user) * 2]
+        response = self.client.get(reverse("tweets:home"))
+        self.assertEqual([tweet.pk for tweet in response.context["tweets"]], [tweet.pk for tweet in reversed(tweets)])
+        self.assertEqual(response.context["tweets"][0].user, self.user)
+
+    @override_settings(TIMELINE_FANOUT_MAX_FOLLOWERS=0)
+    def test_home_merges_pulled_authors(self):
+        follows.follow(self.user, self.author1)
+        follows.follow(self.user, self.author2)
+        tweets = [self.create_tweet(user, "pulled") for user in (self.author1, self.author2) * 2]
+        response = self.client.get(reverse("tweets:home"))
+        self.assertEqual([tweet.pk for tweet in response.context["tweets"]], [tweet.pk for tweet in reversed(tweets)])
+
+    def test_detail_and_like(self):
+        tweet = self.create_tweet(self.author1, "liked")
+        response = self.client.get(reverse("tweets:detail", kwargs={"pk": tweet.pk}))
+        self.assertEqual(response.context["tweet"], tweet)
+        response = self.client.post(reverse("tweets:like", kwargs={"pk": tweet.pk}))
+        self.assertEqual(response.json(), {"like_number": 1})
+        # いいねはツイートと同じシャードに保存されている
+        self.assertEqual(self.databases_with(Like, tweet_id=tweet.pk), [tweet._state.db])
+        response = self.client.post(reverse("tweets:unlike", kwargs={"pk": tweet.pk}))
+        self.assertEqual(response.json(), {"like_number": 0})
+        response = self.client.get(reverse("tweets:like_status"), {"ids": f"{tweet.pk}"})
+        self.assertEqual(response.json(), {"tweets": {str(tweet.pk): {"like_count": 0, "liked": False}}})
+
+    def test_like_batch_across_shards(self):
+        tweet1 = self.create_tweet(self.author1, "batch")
+        tweet2 = self.create_tweet(self.author2, "batch")
+        response = self.client.post(
+            reverse("tweets:like_batch"),
+            {"operations": [{"tweet_id": tweet1.pk, "op": "like"}, {"tweet_id": tweet2.pk, "op": "like"}]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["tweets"][str(tweet2.pk)], {"like_count": 1, "liked": True})
+        self.assertEqual(self.databases_with(Like, user=self.user), sorted([tweet1._state.db, tweet2._state.db]))
+
+    def test_profile_and_delete(self):
+        tweet = self.create_tweet(self.user, "mine")
+        response = self.client.get(reverse("accounts:user_profile", kwargs={"username": "tester"}))
+        self.assertEqual(list(response.context["tweets"]), [tweet])
+        self.client.post(reverse("tweets:delete", kwargs={"pk": tweet.pk}))
+        # defaultにあるタイムラインからも取り除かれている
+        self.assertEqual(self.databases_with(Tweet, pk=tweet.pk), [])
+        self.assertFalse(TimelineEntry.objects.filter(tweet_id=tweet.pk).exists())
+
+    def test_delete_user(self):
+        tweet = self.create_tweet(self.user, "mine")
+        like_tweet(self.author1, tweet.pk)
+        for author in (self.author1, self.author2):
+            like_tweet(self.user, self.create_tweet(author, "liked").pk)
+        self.assertEqual(len(self.databases_with(Like, user=self.user)), 2)
+        # ユーザーのツイートといいねは、ユーザーと別のシャードにあるものも消える
+        self.user.delete()
+        self.assertEqual(self.databases_with(Tweet, user_id=self.user.pk), [])
+        self.assertEqual(self.databases_with(Like, user_id=self.user.pk), [])
+        self.assertEqual(self.databases_with(Like, tweet_id=tweet.pk), [])
+        self.assertFalse(TimelineEntry.objects.filter(tweet_id=tweet.pk).exists())
+
+    def test_prepare_legacy_tweets(self):
+        # シャーディングを有効にする前に、idにバケットを持たないidで作成したツイート
+        with self.settings(TWEET_SHARDS=[]):
+            legacy = Tweet.objects.create(
+                id=sharding.BUCKETS * 10**6 + (self.author1.pk + 1) % sharding.BUCKETS,
+                user=self.author1,
+                content="legacy",
+            )
+            timeline.fan_out_tweet(legacy)
+            like_tweet(self.user, legacy.pk)
+        errors = checks.check_sharding_prepared(None, databases=["default"])
+        self.assertEqual({error.id for error in errors}, {"tweets.E001", "tweets.E002"})
+        call_command("prepare_sharding", stdout=StringIO())
+        self.assertEqual(checks.check_sharding_prepared(None, databases=["default"]), [])
+        # 投稿者のバケットのidに振り直し、行は移動せずにバケットをdefaultに割り当てる
+        tweet = Tweet.objects.using("default").get(content="legacy")
+        self.assertEqual(sharding.bucket_for_tweet(tweet.pk), sharding.bucket_for_user(self.author1.pk))
+        self.assertEqual(sharding.db_for_user(self.author1.pk), "default")
+        self.assertTrue(TimelineEntry.objects.filter(user=self.author1, tweet_id=tweet.pk).exists())
+        self.assertTrue(self.client.get(reverse("tweets:detail", kwargs={"pk": tweet.pk})).context["tweet"].liked)
+        self.assertEqual(unlike_tweet(self.user, tweet.pk), 0)
+        self.assertEqual(self.client.get(reverse("tweets:detail", kwargs={"pk": legacy.pk})).status_code, 404)
+
+    def test_reshard(self):
+        tweet = self.create_tweet(self.author1, "moved")
+        like_tweet(self.user, tweet.pk)
+        source = tweet._state.db
+        target = next(database for database in settings.TWEET_SHARDS if database != source)
+        call_command("reshard", target, "--user=author1", "--wait=0", stdout=StringIO())
+        # 行が移動先だけにあり、以降の読み書きは移動先に送られる
+        self.assertEqual(sharding.db_for_user(self.author1.pk), target)
+        self.assertEqual(self.databases_with(Tweet, pk=tweet.pk), [target])
+        self.assertEqual(self.databases_with(Like, tweet_id=tweet.pk), [target])
+        moved = Tweet.objects.using(target).get(pk=tweet.pk)
+        self.assertEqual((moved.created_at, moved.like_count), (tweet.created_at, 1))
+        self.assertEqual(unlike_tweet(self.user, tweet.pk), 0)
+        response = self.client.get(reverse("tweets:detail", kwargs={"pk": tweet.pk}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_write_to_moving_bucket(self):
+        tweet = self.create_tweet(self.author1, "moving")
+        sharding.set_bucket(sharding.bucket_for_tweet(tweet.pk), tweet._state.db, read_only=True)
+        with self.assertRaises(sharding.ShardUnavailable):
+            like_tweet(self.user, tweet.pk)
+        # ビューでは移動が終わるのを待たずに503を返し、やり直すまでの秒数を伝える
+        response = self.client.post(reverse("tweets:like", kwargs={"pk": tweet.pk}))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], str(settings.SHARD_RETRY_AFTER_SECONDS))
+        # 読み込みは移動中も移動元から行える
+        self.assertEqual(sharding.db_for_tweet(tweet.pk), tweet._state.db)
@@ -0,0 +1,138 @@
+import heapq
+
+from django.conf import settings
+from django.db.models import Q
+
+from accounts.models import FriendShip, User
+from mysite.pagination import keyset_queryset
+
+from . import sharding
+from .models import TimelineEntry, Tweet
+
+
+def is_pull_author(user_id):
+    # フォロワーが多すぎるユーザーは書き込み時の配信を行わない
+    return User.objects.filter(pk=user_id, follower_count__gt=settings.TIMELINE_FANOUT_MAX_FOLLOWERS).exists()
+
+
+def get_pull_author_ids(user):
+    following_ids = FriendShip.objects.filter(follower=user).values("following_id")
+    return list(
+        User.objects.filter(
+            pk__in=following_ids, follower_count__gt=settings.TIMELINE_FANOUT_MAX_FOLLOWERS
+        ).values_list("id", flat=True)
+    )
+
+
+def trim_timeline(user_id):
+    cutoff = (
+        TimelineEntry.objects.filter(user_id=user_id)
+        .order_by("-created_at", "-tweet_id")
+        .values_list("created_at", "tweet_id")[settings.TIMELINE_MAX_LENGTH : settings.TIMELINE_MAX_LENGTH + 1]
+    )
+    if not cutoff:
+        return
+    created_at, tweet_id = cutoff[0]
+    TimelineEntry.objects.filter(
+        Q(created_at__lt=created_at) | Q(created_at=created_at, tweet_id__lte=tweet_id), user_id=user_id
+    ).delete()
+
+
+def fan_out_tweet(tweet):
+    # 投稿者自身のタイムラインには常に書き込む
+    recipient_ids = [tweet.user_id]
+    if not is_pull_author(tweet.user_id):
+        recipient_ids += FriendShip.objects.filter(following_id=tweet.user_id).values_list("follower_id", flat=True)
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(user_id=user_id, tweet=tweet, created_at=tweet.created_at) for user_id in recipient_ids],
+        batch_size=settings.TIMELINE_FANOUT_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    # 毎回全員分を切り詰めると書き込みが重くなるため、配信先ごとにおおよそTIMELINE_TRIM_INTERVAL回に1回だけ行う
+    for user_id in recipient_ids:
+        if (user_id + tweet.pk) % settings.TIMELINE_TRIM_INTERVAL == 0:
+            trim_timeline(user_id)
+
+
+def backfill_author(user, author):
+    if is_pull_author(author.pk):
+        return
+    tweets = (
+        Tweet.objects.using(sharding.db_for_user(author.pk))
+        .filter(user=author)
+        .order_by("-created_at", "-id")
+        .values_list("id", "created_at")[: settings.TIMELINE_MAX_LENGTH]
+    )
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(user=user, tweet_id=tweet_id, created_at=created_at) for tweet_id, created_at in tweets],
+        batch_size=settings.TIMELINE_FANOUT_BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    trim_timeline(user.pk)
+
+
+def remove_author(user, author):
+    if not sharding.is_enabled():
+        TimelineEntry.objects.filter(user=user, tweet__user=author).delete()
+        return
+    # ツイートは別のDBにありJOINできないため、タイムラインのツイートのうち投稿者のものを投稿者のシャードで調べる
+    tweet_ids = [
+        tweet_id
+        for tweet_id in TimelineEntry.objects.filter(user=user).values_list("tweet_id", flat=True)
+        if sharding.bucket_for_tweet(tweet_id) == sharding.bucket_for_user(author.pk)
+    ]
+    author_tweet_ids = list(
+        Tweet.objects.using(sharding.db_for_user(author.pk))
+        .filter(user=author, id__in=tweet_ids)
+        .values_list("id", flat=True)
+    )
+    TimelineEntry.objects.filter(user=user, tweet_id__in=author_tweet_ids).delete()
+
+
+def rebuild_timeline(user):
+    TimelineEntry.objects.filter(user=user).delete()
+    author_ids = [user.pk, *FriendShip.objects.filter(follower=user).values_list("following_id", flat=True)]
+    pull_author_ids = set(get_pull_author_ids(user))
+    # 投稿者のシャードごとに新しいものから取得し、作成日時の順に合流させる
+    queries = [
+        Tweet.objects.using(database)
+        .filter(user_id__in=user_ids)
+        .exclude(user_id__in=pull_author_ids)
+        .order_by("-created_at", "-id")
+        .values_list("created_at", "id")[: settings.TIMELINE_MAX_LENGTH]
+        for database, user_ids in sharding.group_users(author_ids).items()
+    ]
+    tweets = [(tweet_id, created_at) for created_at, tweet_id in heapq.merge(*queries, reverse=True)]
+    tweets = tweets[: settings.TIMELINE_MAX_LENGTH]
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(user=user, tweet_id=tweet_id, created_at=created_at) for tweet_id, created_at in tweets],
+        batch_size=settings.TIMELINE_FANOUT_BATCH_SIZE,
+    )
+
+
+def get_home_timeline(user, cursor, limit):
+    # (作成日時, ツイートid)を進行方向の順にlimit件まで返す
+    pushed = keyset_queryset(TimelineEntry.objects.filter(user=user), cursor, ("created_at", "tweet_id"))
+    pushed = pushed.values_list("created_at", "tweet_id")[:limit]
+    pull_author_ids = get_pull_author_ids(user)
+    if not pull_author_ids:
+        return list(pushed)
+    # フォロワーの多いユーザーのツイートは読み込み時に取得して合流させる
+    # 投稿者のシャードが分かれていれば、シャードごとに取得して作成日時の順に合流させる
+    pulled = [
+        keyset_queryset(Tweet.objects.using(database).filter(user_id__in=user_ids), cursor).values_list(
+            "created_at", "id"
+        )[:limit]
+        for database, user_ids in sharding.group_users(pull_author_ids).items()
+    ]
+    reverse = cursor is None or not cursor.reverse
+    rows = []
+    tweet_ids = set()
+    for created_at, tweet_id in heapq.merge(pushed, *pulled, reverse=reverse):
+        # 配信方式が切り替わったユーザーのツイートは両方に含まれることがある
+        if tweet_id not in tweet_ids:
+            tweet_ids.add(tweet_id)
+            rows.append((created_at, tweet_id))
+        if len(rows) == limit:
+            break
+    return rows
@@ -6,9 +6,16 @@ app_name = "tweets"
 
 urlpatterns = [
     path("home/", views.HomeView.as_view(), name="home"),
+    path("home/fragment/", views.HomeFragmentView.as_view(), name="home_fragment"),
+    path("search/", views.TweetSearchView.as_view(), name="search"),
+    path("hashtag/<str:name>/", views.HashtagView.as_view(), name="hashtag"),
+    path("mentions/", views.MentionListView.as_view(), name="mentions"),
     path("create/", views.TweetCreateView.as_view(), name="create"),
     path("<int:pk>/", views.TweetDetailView.as_view(), name="detail"),
     path("<int:pk>/delete/", views.TweetDeleteView.as_view(), name="delete"),
     path("<int:pk>/like/", views.LikeView.as_view(), name="like"),
     path("<int:pk>/unlike/", views.UnlikeView.as_view(), name="unlike"),
+    path("likes/", views.LikeStatusView.as_view(), name="like_status"),
+    path("likes/batch/", views.LikeBatchView.as_view(), name="like_batch"),
+    path("stream/", views.TimelineStreamView.as_view(), name="stream"),
 ]
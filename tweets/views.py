@@ -1,34 +1,129 @@
+import hashlib
+import json
+
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.db.models import Count, Exists, OuterRef
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Exists, OuterRef
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse_lazy
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
 from django.views import View
 from django.views.generic import CreateView, DeleteView, DetailView, ListView
 
+from accounts.models import FriendShip
+from mysite import conditional
+from mysite.mixins import AsyncLoginRequiredMixin, ConditionalGetMixin, ReplicaReadMixin
+from mysite.pagination import CursorPaginationMixin, build_page, decode_cursor, paginate
+from tweets import entities, fragments, pages, search, sharding, streaming, timeline
 from tweets.forms import CreateTweetForm
+from tweets.likes import LIKE_OPERATIONS, alike_tweet, apply_like_operations, aunlike_tweet
+
+from .models import Hashtag, Like, Mention, Tweet, TweetHashtag
 
-from .models import Like, Tweet
 
+def _parse_tweet_ids(value, max_tweets):
+    # カンマ区切りのツイートidを昇順のリストにする。不正な値や件数が上限を超える場合はNone
+    try:
+        tweet_ids = sorted({int(tweet_id) for tweet_id in value.split(",") if tweet_id})
+    except ValueError:
+        return None
+    if len(tweet_ids) > max_tweets:
+        return None
+    return tweet_ids
 
-class HomeView(LoginRequiredMixin, ListView):
+
+class HomeView(ReplicaReadMixin, LoginRequiredMixin, CursorPaginationMixin, ListView):
     model = Tweet
     template_name = "tweets/home.html"
     context_object_name = "tweets"
+    query_budget = 6
+
+    def get_paginate_by(self, queryset):
+        return settings.TIMELINE_PAGE_SIZE
 
     def get_queryset(self):
         tweets = (
-            Tweet.objects.all()
-            .select_related("user")
-            .annotate(
-                liked=Exists(Like.objects.filter(user=self.request.user, tweet=OuterRef("id"))),
-                like_count=Count("likes"),
-            )
-            .order_by("-created_at")
+            sharding.select_user(Tweet.objects.all())
+            .annotate(liked=Exists(Like.objects.filter(user=self.request.user, tweet=OuterRef("id"))))
+            .order_by("-created_at", "-id")
+        )
+        return tweets
+
+    def paginate_queryset(self, queryset, page_size):
+        # タイムラインのテーブル上でページを決めてから、そのページのツイートだけを取得する
+        cursor = decode_cursor(self.get_cursor_token())
+        rows = timeline.get_home_timeline(self.request.user, cursor, page_size + 1)
+        page = build_page(rows, cursor, page_size, lambda row: row)
+        page.object_list = sharding.fetch_tweets(queryset, [tweet_id for _, tweet_id in page.object_list])
+        return None, page, page.object_list, page.has_other_pages()
+
+
+class HomeFragmentView(HomeView):
+    # 無限スクロールの続き。base.htmlなどのページ全体は描画せず、ツイートの<li>だけを返す
+    def render_to_response(self, context, **response_kwargs):
+        return fragments.fragment_response(
+            self.request,
+            context["tweets"],
+            "tweets/fragments/tweet.html",
+            fragments.next_page_url(self.request, context["page_obj"]),
+        )
+
+
+class IndexedTweetListView(LoginRequiredMixin, CursorPaginationMixin, ListView):
+    # 索引のテーブル（TweetHashtag、Mention）の上でページを決めてから、そのページのツイートだけを取得する
+    model = Tweet
+    context_object_name = "tweets"
+    cursor_keys = ("created_at", "tweet_id")
+    query_budget = 5
+    # ページを決める索引のモデル。get_entry_filter()の条件で絞り込む
+    entries_model = None
+
+    def get_entry_filter(self):
+        return {}
+
+    def get_entries(self):
+        return self.entries_model.objects.filter(**self.get_entry_filter())
+
+    def get_queryset(self):
+        tweets = (
+            sharding.select_user(Tweet.objects.all())
+            .annotate(liked=Exists(Like.objects.filter(user=self.request.user, tweet=OuterRef("id"))))
+            .order_by("-created_at", "-id")
         )
         return tweets
 
+    def paginate_queryset(self, queryset, page_size):
+        page = paginate(
+            self.get_entries().only("created_at", "tweet_id"), self.get_cursor_token(), page_size, self.cursor_keys
+        )
+        page.object_list = sharding.fetch_tweets(queryset, [entry.tweet_id for entry in page.object_list])
+        return None, page, page.object_list, page.has_other_pages()
+
+
+class HashtagView(IndexedTweetListView):
+    template_name = "tweets/hashtag.html"
+    entries_model = TweetHashtag
+
+    def get_entry_filter(self):
+        self.hashtag = get_object_or_404(Hashtag, name=entities.normalize_hashtag(self.kwargs["name"]))
+        return {"hashtag": self.hashtag}
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["hashtag"] = self.hashtag
+        return context
+
+
+class MentionListView(IndexedTweetListView):
+    template_name = "tweets/mentions.html"
+    entries_model = Mention
+
+    def get_entry_filter(self):
+        return {"user": self.request.user}
+
 
 class TweetCreateView(LoginRequiredMixin, CreateView):
     model = Tweet
@@ -38,25 +133,64 @@ class TweetCreateView(LoginRequiredMixin, CreateView):
 
     def form_valid(self, form):
         form.instance.user = self.request.user
-        return super().form_valid(form)
+        response = super().form_valid(form)
+        entities.index_tweets([self.object])
+        timeline.fan_out_tweet(self.object)
+        streaming.publish_tweet(self.object)
+        return response
 
 
-class TweetDetailView(LoginRequiredMixin, DetailView):
+class TweetDetailView(ReplicaReadMixin, LoginRequiredMixin, ConditionalGetMixin, DetailView):
     model = Tweet
     template_name = "tweets/detail.html"
     context_object_name = "tweet"
+    query_budget = 4
+
+    def get_validators(self):
+        # 表示はツイート（キャッシュした版数）、投稿者（ユーザー名）と閲覧者のいいねの状態で決まる
+        self.version, self.tweet = pages.get_tweet(self.kwargs["pk"])
+        if self.tweet is None:
+            raise Http404("ツイートが見つかりません")
+        keys = conditional.user_key(self.request.user.pk), conditional.user_key(self.tweet.user_id)
+        return self.tweet.pk, conditional.get_versions(*keys) + [self.version]
+
+    def get_object(self, queryset=None):
+        # ツイートは多くの閲覧者で共有するキャッシュから返し、いいねの状態だけを閲覧者ごとに問い合わせる。
+        # シャーディングしているときは、idの示すシャードだけに問い合わせる
+        if not hasattr(self, "tweet"):
+            self.get_validators()
+        pages.overlay_liked([self.tweet], self.request.user, sharding.db_for_tweet(self.tweet.pk))
+        return self.tweet
+
+
+class TweetSearchView(LoginRequiredMixin, ListView):
+    template_name = "tweets/search.html"
+    context_object_name = "tweets"
+    query_budget = 4
+
+    def get_paginate_by(self, queryset):
+        return settings.SEARCH_PAGE_SIZE
 
     def get_queryset(self):
-        tweets = (
-            Tweet.objects.all()
-            .select_related("user")
-            .annotate(
-                liked=Exists(Like.objects.filter(user=self.request.user, tweet=OuterRef("id"))),
-                like_count=Count("likes"),
-            )
-            .order_by("-created_at")
+        # 関連度順のツイートidの並び。ページを決めてから、そのページのツイートだけを取得する
+        self.query = self.request.GET.get("q", "").strip()
+        if not self.query:
+            return []
+        return search.get_backend().search(self.query, settings.SEARCH_MAX_RESULTS)
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator, page, tweet_ids, is_paginated = super().paginate_queryset(queryset, page_size)
+        tweets = sharding.select_user(Tweet.objects.all()).annotate(
+            liked=Exists(Like.objects.filter(user=self.request.user, tweet=OuterRef("id")))
         )
-        return tweets
+        tweets = {tweet.pk: tweet for tweet in sharding.fetch_tweets(tweets, tweet_ids)}
+        page.object_list = [tweets[tweet_id] for tweet_id in tweet_ids if tweet_id in tweets]
+        return paginator, page, page.object_list, is_paginated
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.query
+        return context
 
 
 class TweetDeleteView(UserPassesTestMixin, DeleteView):
@@ -64,37 +198,114 @@ class TweetDeleteView(UserPassesTestMixin, DeleteView):
     template_name = "tweets/delete.html"
     success_url = reverse_lazy(settings.LOGIN_REDIRECT_URL)
 
+    def get_queryset(self):
+        return Tweet.objects.using(sharding.db_for_tweet(self.kwargs["pk"], write=self.request.method == "POST"))
+
     def test_func(self):
         object = self.get_object()
         return object.user == self.request.user
 
 
-class LikeView(View):
-
-    def post(self, *args, **kwargs):
-        tweet_pk = kwargs["pk"]
-        self.tweet = get_object_or_404(Tweet, id=tweet_pk)
-        is_liked = Like.objects.filter(tweet=self.tweet, user=self.request.user).exists()
-        like_number = Like.objects.filter(tweet=self.tweet).count()
-        if is_liked:
-            return JsonResponse({"like_number": like_number})
-        else:
-            like = Like(tweet=self.tweet, user=self.request.user)
-            like.save()
-            new_like_number = like_number + 1
-            return JsonResponse({"like_number": new_like_number})
-
-
-class UnlikeView(View):
-
-    def post(self, *args, **kwargs):
-        tweet_pk = kwargs["pk"]
-        self.tweet = get_object_or_404(Tweet, id=tweet_pk)
-        like = Like.objects.filter(user=self.request.user, tweet=tweet_pk)
-        like_number = Like.objects.filter(tweet=self.tweet).count()
-        if like:
-            like.delete()
-            new_like_number = like_number - 1
-            return JsonResponse({"like_number": new_like_number})
-        else:
-            return JsonResponse({"like_number": like_number})
+class LikeView(AsyncLoginRequiredMixin, View):
+    query_budget = 5
+
+    async def post(self, request, *args, **kwargs):
+        like_number = await alike_tweet(request.user, kwargs["pk"])
+        if like_number is None:
+            raise Http404
+        await streaming.apublish_like_count(kwargs["pk"], like_number)
+        return JsonResponse({"like_number": like_number})
+
+
+class UnlikeView(AsyncLoginRequiredMixin, View):
+    query_budget = 5
+
+    async def post(self, request, *args, **kwargs):
+        like_number = await aunlike_tweet(request.user, kwargs["pk"])
+        if like_number is None:
+            raise Http404
+        await streaming.apublish_like_count(kwargs["pk"], like_number)
+        return JsonResponse({"like_number": like_number})
+
+
+class LikeStatusView(AsyncLoginRequiredMixin, View):
+    max_tweets = 100
+    query_budget = 4
+
+    async def get(self, request, *args, **kwargs):
+        tweet_ids = _parse_tweet_ids(request.GET.get("ids", ""), self.max_tweets)
+        if not tweet_ids:
+            return HttpResponseBadRequest()
+        # いいね数はカラムから、閲覧者のいいね状態はlike_uniqueを使ったEXISTSでまとめて1回のクエリで取得する
+        rows = []
+        for database, ids in (await sharding.agroup_tweets(tweet_ids)).items():
+            rows += [
+                row
+                async for row in Tweet.objects.using(database)
+                .filter(id__in=ids)
+                .annotate(liked=Exists(Like.objects.filter(user=request.user, tweet=OuterRef("id"))))
+                .order_by("id")
+                .values_list("id", "like_count", "liked")
+            ]
+        rows.sort()
+        etag = quote_etag(hashlib.md5(repr((request.user.pk, rows)).encode()).hexdigest())
+        # 前回から変化がなければ本文を作らずに304を返す
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = JsonResponse(
+                {"tweets": {str(tweet_id): {"like_count": count, "liked": liked} for tweet_id, count, liked in rows}}
+            )
+        response["ETag"] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ["Cookie"])
+        return response
+
+
+class LikeBatchView(LoginRequiredMixin, View):
+    max_operations = 500
+
+    def post(self, request, *args, **kwargs):
+        try:
+            operations = [
+                (int(operation["tweet_id"]), operation["op"]) for operation in json.loads(request.body)["operations"]
+            ]
+        except (ValueError, KeyError, TypeError):
+            return JsonResponse({"error": "operationsの形式が正しくありません。"}, status=400)
+        if not operations or len(operations) > self.max_operations:
+            return JsonResponse(
+                {"error": f"operationsは1件以上{self.max_operations}件以下にしてください。"}, status=400
+            )
+        if any(op not in LIKE_OPERATIONS for _, op in operations):
+            return JsonResponse({"error": "opはlikeまたはunlikeを指定してください。"}, status=400)
+        tweets = apply_like_operations(request.user, operations)
+        for tweet_id, tweet in tweets.items():
+            streaming.publish(streaming.tweet_topic(tweet_id), {"type": "like", "id": tweet_id, **tweet})
+        missing = sorted({tweet_id for tweet_id, _ in operations} - tweets.keys())
+        return JsonResponse(
+            {"tweets": {str(tweet_id): tweet for tweet_id, tweet in tweets.items()}, "missing": missing}
+        )
+
+
+class TimelineStreamView(AsyncLoginRequiredMixin, View):
+    max_tweets = 100
+
+    async def get(self, request, *args, **kwargs):
+        # 接続を保ち続けるためASGIでのみ配信する。204を返すとEventSourceは再接続しない
+        if not isinstance(request, ASGIRequest):
+            return HttpResponse(status=204)
+        tweet_ids = _parse_tweet_ids(request.GET.get("tweets", ""), self.max_tweets)
+        if tweet_ids is None:
+            return HttpResponseBadRequest()
+        # フォロー中のユーザー（と自分）の新しいツイートと、表示中のツイートのいいね数の変化を購読する
+        author_ids = [request.user.pk] + [
+            user_id
+            async for user_id in FriendShip.objects.filter(follower_id=request.user.pk).values_list(
+                "following_id", flat=True
+            )
+        ]
+        topics = [streaming.author_topic(user_id) for user_id in author_ids]
+        topics += [streaming.tweet_topic(tweet_id) for tweet_id in tweet_ids]
+        response = StreamingHttpResponse(streaming.stream_events(topics), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response